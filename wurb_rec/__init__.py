@@ -3,7 +3,32 @@ __version__ = "0.9.0"
 
 from .wurb_logging import WurbLogging
 from .lib.pettersson_m500_batmic import PetterssonM500BatMic
+from .lib.pettersson_m500_batmic import PetterssonM500StreamReader
 from .lib.solartime import SolarTime
+from .wurb_audio_buffer import AudioRingBuffer
+from .wurb_audio_buffer import CopyRateCounter
+from .wurb_audio_buffer import AudioBufferPool
+from .wurb_audio_buffer import SharedAudioBlock
+from .wurb_audio_buffer import get_channel_data
+from .wurb_audio_block import BlockFlags
+from .wurb_audio_block import AudioBlock
+from .wurb_audio_block import StreamSentinel
+from .wurb_audio_block import TERMINATE
+from .wurb_audio_block import FLUSH
+from .wurb_audio_block import release_item
+from .wurb_loop_bridge import ThreadToLoopBridge
+from .wurb_queue_policy import QueuePolicy
+from .wurb_pipeline_stats import LatencyHistogram
+from .wurb_pipeline_stats import PipelineStats
+from .wurb_stream_graph import StreamConsumer
+from .wurb_stream_graph import StreamFanOut
+from .wurb_executors import RoleExecutor
+from .wurb_executors import ExecutorRegistry
+from .wurb_capture_profiles import CaptureProfiles
+from .wurb_capture_profiles import CaptureProfileStats
+from .wurb_capture_clock import CaptureClock
+from .wurb_device_inventory import HotplugWatcher
+from .wurb_device_inventory import DeviceInventory
 from .sound_stream_manager import SoundStreamManager
 from .wurb_rpi import WurbRaspberryPi
 from .wurb_settings import WurbSettings
@@ -14,9 +39,23 @@ from .wurb_audio_alsa import AlsaMixer
 from .wurb_audio_alsa import AlsaSoundCapture
 from .wurb_audio_alsa import AlsaSoundPlayback
 from .wurb_audio_m500 import PetterssonM500
+from .wurb_audio_replay import WavFileReplay
+from .wurb_audio_synthetic import SyntheticScenes
+from .wurb_audio_synthetic import BatCallGenerator
+from .wurb_audio_synthetic import SyntheticSoundSource
+from .wurb_capture_process import SharedMemoryBlockRing
+from .wurb_capture_process import ProcessSoundCapture
 
 from .wurb_audiofeedback import WurbPitchShifting
+from .wurb_detection_gate import DetectionGate
+from .wurb_noise_floor import NoiseFloor
 from .wurb_sound_detection import SoundDetection
+from .wurb_sound_detection import DetectionAlgorithms
+from .wurb_sound_detection import SoundDetectionSimple
+from .wurb_sound_detection import detection_algorithms
+from .wurb_detection_algorithms import SoundDetectionFlatness
+from .wurb_detection_algorithms import SoundDetectionBandRatio
+from .wurb_detection_algorithms import SoundDetectionFmSweep
 from .wurb_recorder import UltrasoundDevices
 from .wurb_recorder import WaveFileWriter
 from .wurb_recorder import WurbRecorder
@@ -154,6 +154,8 @@ async def get_status():
             "location_status": location_status,
             "device_name": status_dict.get("device_name", ""),
             "detector_time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "noise_floor_dbfs": status_dict.get("noise_floor_dbfs", None),
+            "suppressed_triggers": status_dict.get("suppressed_triggers", 0),
         }
     except Exception as e:
         # Logging error.
@@ -161,6 +163,50 @@ async def get_status():
         wurb_rec_manager.wurb_logging.error(message, short_message=message)
 
 
+@app.get("/get-device-stats/")
+async def get_device_stats():
+    try:
+        global wurb_rec_manager
+        # Logging debug.
+        wurb_rec_manager.wurb_logging.debug(message="API called: get-device-stats.")
+        device_stats = await wurb_rec_manager.get_device_stats()
+        return {"devices": device_stats}
+    except Exception as e:
+        # Logging error.
+        message = "Called: get_device_stats: " + str(e)
+        wurb_rec_manager.wurb_logging.error(message, short_message=message)
+
+
+@app.get("/get-pipeline-stats/")
+async def get_pipeline_stats():
+    try:
+        global wurb_rec_manager
+        # Logging debug.
+        wurb_rec_manager.wurb_logging.debug(message="API called: get-pipeline-stats.")
+        pipeline_stats = await wurb_rec_manager.get_pipeline_stats()
+        executor_stats = await wurb_rec_manager.get_executor_stats()
+        return {"pipelines": pipeline_stats, "executors": executor_stats}
+    except Exception as e:
+        # Logging error.
+        message = "Called: get_pipeline_stats: " + str(e)
+        wurb_rec_manager.wurb_logging.error(message, short_message=message)
+
+
+@app.get("/get-detection-algorithms/")
+async def get_detection_algorithms():
+    try:
+        global wurb_rec_manager
+        # Logging debug.
+        wurb_rec_manager.wurb_logging.debug(
+            message="API called: get-detection-algorithms."
+        )
+        return await wurb_rec_manager.get_detection_algorithms()
+    except Exception as e:
+        # Logging error.
+        message = "Called: get_detection_algorithms: " + str(e)
+        wurb_rec_manager.wurb_logging.error(message, short_message=message)
+
+
 @app.post("/save-location/")
 async def save_location(settings: LocationSettings):
     try:
@@ -8,6 +8,8 @@ import time
 import datetime
 import wave
 import array
+import queue
+import threading
 import usb.core
 
 
@@ -122,7 +124,7 @@ class PetterssonM500BatMic(object):
             print("EXCEPTION: M500 init_sound_card: ", e)
             return False
 
-    def read_stream(self):
+    def read_stream(self, transfer_size=0x20000):
         """ Returns empty list if not ok. """
         try:
             if not self.endpoint_in:
@@ -131,8 +133,8 @@ class PetterssonM500BatMic(object):
                 # Buffer must be an exponent of 2.
                 # buffer = self.endpoint_in.read(0x10000, 2000) # Size = 65536, timeout = 2 sec.
                 buffer = self.endpoint_in.read(
-                    0x20000, 2000
-                )  # Size = 131072, timeout = 2 sec.
+                    transfer_size, 2000
+                )  # Default size = 131072, timeout = 2 sec.
                 # buffer = self.endpoint_in.read(0x40000, 4000) # Size = 262144, timeout = 2 sec.
                 return buffer
             else:
@@ -141,6 +143,23 @@ class PetterssonM500BatMic(object):
             # print("EXCEPTION: M500 read_stream: ", e)
             return array.array("B")  # Empty array.
 
+    def read_stream_into(self, buffer):
+        """ Reads directly into a preallocated array.array("B"), no new
+            buffer is allocated. The size of the buffer is used as transfer size.
+            Returns number of bytes read, 0 if not ok.
+        """
+        try:
+            if not self.endpoint_in:
+                self.init_sound_card()
+            if self.endpoint_in:
+                # Timeout = 2 sec.
+                return self.endpoint_in.read(buffer, 2000)
+            else:
+                return 0
+        except Exception as e:
+            # print("EXCEPTION: M500 read_stream_into: ", e)
+            return 0
+
     def send_command(self, command):
         """ Commands: '01': Stream on, '02': LED flash, '03': LED on, '04': Stream off. 
             Returns True if ok. 
@@ -174,6 +193,106 @@ class PetterssonM500BatMic(object):
             return False
 
 
+class PetterssonM500StreamReader(object):
+    """ Reads bulk transfers from the M500 in a dedicated thread.
+        Transfers are read into a number of preallocated buffers, so a new 
+        transfer is always pending on the bus while earlier transfers wait to be 
+        processed. Buffers are returned by the consumer with put_back(). 
+        If no free buffer is available the transfer is read into a spare 
+        buffer and counted as lost, the number of lost bytes is delivered 
+        together with the next transfer. The time when each transfer was 
+        completed is also delivered. 
+    """
+
+    def __init__(self, batmic, transfer_size=0x20000, number_of_buffers=8):
+        """ """
+        self.batmic = batmic
+        self.transfer_size = transfer_size
+        self.free_queue = queue.Queue()
+        self.filled_queue = queue.Queue()
+        for _index in range(number_of_buffers):
+            self.free_queue.put(array.array("B", bytes(transfer_size)))
+        self.spare_buffer = array.array("B", bytes(transfer_size))
+        self.reader_thread = None
+        self.active = False
+        # Counters.
+        self.transfer_counter = 0
+        self.short_transfer_counter = 0
+        self.lost_transfer_counter = 0
+        self.lost_bytes = 0
+
+    def start(self):
+        """ """
+        self.active = True
+        self.reader_thread = threading.Thread(
+            target=self.run, name="m500-reader", daemon=True
+        )
+        self.reader_thread.start()
+
+    def stop(self):
+        """ """
+        self.active = False
+        if self.reader_thread:
+            self.reader_thread.join(timeout=3.0)
+            self.reader_thread = None
+
+    def run(self):
+        """ Reader thread. Ends when a read fails, as for read_stream(). """
+        lost_bytes = 0
+        try:
+            while self.active:
+                try:
+                    buffer = self.free_queue.get_nowait()
+                except queue.Empty:
+                    buffer = None
+                if buffer is not None:
+                    number_of_bytes = self.batmic.read_stream_into(buffer)
+                else:
+                    # The consumer is behind. Read to keep the device running.
+                    number_of_bytes = self.batmic.read_stream_into(self.spare_buffer)
+                if number_of_bytes <= 0:
+                    if buffer is not None:
+                        self.free_queue.put(buffer)
+                    break
+                self.transfer_counter += 1
+                if number_of_bytes < self.transfer_size:
+                    self.short_transfer_counter += 1
+                if buffer is None:
+                    self.lost_transfer_counter += 1
+                    self.lost_bytes += number_of_bytes
+                    lost_bytes += number_of_bytes
+                    continue
+                self.filled_queue.put(
+                    (buffer, number_of_bytes, lost_bytes, time.time())
+                )
+                lost_bytes = 0
+        finally:
+            # End of stream.
+            self.filled_queue.put((None, 0, lost_bytes, time.time()))
+
+    def get_transfer(self, timeout_s=5.0):
+        """ Returns (buffer, number of bytes, lost bytes before the transfer, 
+            time when completed). Buffer is None at end of stream. 
+        """
+        try:
+            return self.filled_queue.get(timeout=timeout_s)
+        except queue.Empty:
+            return (None, 0, 0, time.time())
+
+    def put_back(self, buffer):
+        """ """
+        self.free_queue.put(buffer)
+
+    def get_counters(self):
+        """ """
+        return {
+            "transfers": self.transfer_counter,
+            "short_transfers": self.short_transfer_counter,
+            "lost_transfers": self.lost_transfer_counter,
+            "lost_bytes": self.lost_bytes,
+        }
+
+
 ### FOR TEST. ###
 if __name__ == "__main__":
     """ """
@@ -5,6 +5,10 @@
 # License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
 
 import asyncio
+import time
+
+# CloudedBats.
+import wurb_rec
 
 
 class SoundStreamManager(object):
@@ -20,6 +24,9 @@ class SoundStreamManager(object):
         """ """
         try:
             self.queue_max_size = queue_max_size
+            # Kept when streaming is restarted.
+            self.pipeline_stats = wurb_rec.PipelineStats()
+            self.stream_fan_out = wurb_rec.StreamFanOut()
             self.clear()
         except Exception as e:
             print("Exception: SoundStreamManager: init:", e)
@@ -61,10 +68,82 @@ class SoundStreamManager(object):
                 # finish their work.
                 if self.source_task:
                     self.source_task.cancel()
-                await self.from_source_queue.put(None)  # Terminate.
+                await self.put_sentinel(self.from_source_queue, wurb_rec.TERMINATE)
         except Exception as e:
             print("Exception: SoundStreamManager: stop_streaming:", e)
 
+    async def drain_streaming(self, timeout_s=5.0):
+        """ Stops the source and lets process and target finish the blocks
+        in flight. Tasks still running after timeout_s are cancelled.
+        Returns drain time and discarded audio seconds. """
+        start_time_s = time.monotonic()
+        discarded_s = 0.0
+        process_running = (self.process_task is not None) and (
+            not self.process_task.done()
+        )
+
+        async def drain():
+            if self.source_task:
+                self.source_task.cancel()
+                try:
+                    await self.source_task
+                except asyncio.CancelledError:
+                    pass
+            await self.put_sentinel(self.from_source_queue, wurb_rec.TERMINATE)
+            if self.process_task:
+                await self.process_task
+            if (not process_running) and self.target_task:
+                # The process worker already ended, the target is not terminated.
+                await self.put_sentinel(self.to_target_queue, wurb_rec.TERMINATE)
+            if self.target_task:
+                await self.target_task
+
+        try:
+            drain_task = asyncio.create_task(drain())
+            done, _pending = await asyncio.wait([drain_task], timeout=timeout_s)
+            if done:
+                drain_task.result()
+            else:
+                discarded_s = self.get_queued_s()
+                await self.stop_streaming(stop_immediate=True)
+                drain_task.cancel()
+                tasks = [drain_task, self.source_task, self.process_task]
+                tasks += [self.target_task]
+                await asyncio.wait([task for task in tasks if task is not None])
+        except Exception as e:
+            print("Exception: SoundStreamManager: drain_streaming:", e)
+        return time.monotonic() - start_time_s, discarded_s
+
+    def get_queued_s(self):
+        """ Audio seconds waiting in the queues. Used by subclasses. """
+        return 0.0
+
+    def get_queue_policy(self, queue):
+        """ Overflow policy for the queue, or None. Used by subclasses. """
+        return None
+
+    async def get_from_queue(self, queue):
+        """ Next item. Gaps for items dropped by the queue policy at the
+        head of the queue are added. """
+        queue_policy = self.get_queue_policy(queue)
+        if queue_policy is not None:
+            return await queue_policy.get()
+        return await queue.get()
+
+    async def put_sentinel(self, queue, sentinel):
+        """ Terminate or flush, after items held by the queue policy. """
+        queue_policy = self.get_queue_policy(queue)
+        if queue_policy is not None:
+            await queue_policy.put_sentinel(sentinel)
+        else:
+            await queue.put(sentinel)
+
+    async def flush_queue(self, queue):
+        """ Items in the queue are removed, and flush is sent. Items held
+        by the queue policy are discarded by the flush. """
+        await self.remove_items_from_queue(queue)
+        await self.put_sentinel(queue, wurb_rec.FLUSH)
+
     async def wait_for_shutdown(self):
         """ To be called after stop_streaming. """
         try:
@@ -92,7 +171,7 @@ class SoundStreamManager(object):
                         self.from_source_queue.put_nowait(" A-" + str(counter))
                     except asyncio.QueueFull:
                         await self.remove_items_from_queue(self.from_source_queue)
-                        await self.from_source_queue.put(False)  # Flush.
+                        await self.from_source_queue.put(wurb_rec.FLUSH)
                 except asyncio.CancelledError:
                     print("DEBUG: ", "sound_source_worker cancelled.")
                     break
@@ -110,15 +189,15 @@ class SoundStreamManager(object):
         try:
             while True:
                 try:
-                    item = await self.from_source_queue.get()
-                    if item == None:
-                        await self.to_target_queue.put(None)  # Terminate.
+                    item = await self.get_from_queue(self.from_source_queue)
+                    if item is wurb_rec.TERMINATE:
+                        await self.to_target_queue.put(wurb_rec.TERMINATE)
                         print("DEBUG-2: Terminated by source.")
                         break
-                    if item == False:
+                    if item is wurb_rec.FLUSH:
                         print("DEBUG-2: Flush.")
                         await self.remove_items_from_queue(self.to_target_queue)
-                        await self.to_target_queue.put(False)  # Flush.
+                        await self.to_target_queue.put(wurb_rec.FLUSH)
                     print("DEBUG-2: Item: ", item)
                     self.from_source_queue.task_done()
                     await asyncio.sleep(0.1)
@@ -126,7 +205,7 @@ class SoundStreamManager(object):
                         self.to_target_queue.put_nowait(item)
                     except asyncio.QueueFull:
                         await self.remove_items_from_queue(self.to_target_queue)
-                        await self.to_target_queue.put(False)  # Flush.
+                        await self.to_target_queue.put(wurb_rec.FLUSH)
                 except asyncio.CancelledError:
                     print("DEBUG: ", "soundProcessWorker cancelled.")
                     break
@@ -144,11 +223,11 @@ class SoundStreamManager(object):
         try:
             while True:
                 try:
-                    item = await self.to_target_queue.get()
-                    if item == None:
+                    item = await self.get_from_queue(self.to_target_queue)
+                    if item is wurb_rec.TERMINATE:
                         print("DEBUG-3: Terminated by process.")
                         break
-                    if item == False:
+                    if item is wurb_rec.FLUSH:
                         print("DEBUG-3: Flush.")
                         pass  # TODO.
                     print("DEBUG-3: Item: ", item)
@@ -169,13 +248,21 @@ class SoundStreamManager(object):
         try:
             while True:
                 try:
-                    queue.get_nowait()
+                    item = queue.get_nowait()
+                    self.release_item(item)
                     queue.task_done()
                 except asyncio.QueueEmpty:
                     return
         except Exception as e:
             print("Exception: SoundStreamManager: remove_items_from_queue:", e)
 
+    def release_item(self, item):
+        """ Helper method. Returns shared sound blocks to their pool. """
+        try:
+            wurb_rec.release_item(item)
+        except Exception as e:
+            print("Exception: SoundStreamManager: release_item:", e)
+
 
 # === MAIN - for test ===
 async def main():
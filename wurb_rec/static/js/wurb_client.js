@@ -185,6 +185,16 @@ async function getSettings() {
   };
 };
 
+async function getDetectionAlgorithms() {
+  try {
+    let response = await fetch("/get-detection-algorithms/");
+    let data = await response.json();
+    updateDetectionAlgorithms(data);
+  } catch (err) {
+    console.log(err);
+  };
+};
+
 async function getDefaultSettings() {
   try {
     let response = await fetch("/get-settings/?default=true");
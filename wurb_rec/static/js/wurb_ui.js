@@ -240,6 +240,43 @@ function updateLatLong(latlong) {
   longitude_dd_id.value = latlong.longitude_dd
 }
 
+function updateDetectionAlgorithms(data) {
+  // Options from the registered algorithms, the selection is kept.
+  let selected_value = settings_detection_algorithm_id.value
+  let algorithm_names = data.algorithms.map(algorithm => algorithm.algorithm_name)
+  if (!algorithm_names.includes(selected_value)) {
+    let settings = (typeof last_used_settings !== "undefined") ? last_used_settings : null
+    if (settings && algorithm_names.includes(settings.detection_algorithm)) {
+      selected_value = settings.detection_algorithm
+    } else {
+      selected_value = data.selected_algorithm
+    }
+  }
+  settings_detection_algorithm_id.innerHTML = ""
+  for (let algorithm of data.algorithms) {
+    let option = document.createElement("option")
+    option.value = algorithm.algorithm_name
+    option.text = algorithm.description
+    settings_detection_algorithm_id.add(option)
+  }
+  settings_detection_algorithm_id.value = selected_value
+  updateDetectionAlgorithmWarning(data)
+}
+
+function updateDetectionAlgorithmWarning(data) {
+  // Expected CPU load for the selected algorithm and microphone.
+  let warning = ""
+  let selected_value = settings_detection_algorithm_id.value
+  for (let algorithm of data.algorithms) {
+    if ((algorithm.algorithm_name == selected_value) && algorithm.too_expensive) {
+      warning = "Expected CPU load is " + algorithm.cpu_percent +
+        " % for " + data.sampling_freq_hz / 1000 + " kHz, the limit is " +
+        data.cpu_limit_percent + " %. Sound may be lost."
+    }
+  }
+  settings_detection_algorithm_warning_id.innerHTML = warning
+}
+
 function updateSettings(settings) {
 
   last_used_settings = settings
@@ -267,6 +304,7 @@ function updateSettings(settings) {
   settings_scheduler_post_action_delay_id.value = settings.scheduler_post_action_delay
 
   modeSelectOnChange(update_detector=false)
+  getDetectionAlgorithms()
 
   // Trigging Audio feedback sliders
   feedback_volume_slider_id.oninput()
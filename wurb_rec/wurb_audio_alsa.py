@@ -10,6 +10,10 @@ import numpy
 import array
 import time
 import logging
+from collections import deque
+
+# CloudedBats.
+import wurb_rec
 
 
 class AlsaSoundCards:
@@ -78,6 +82,17 @@ class AlsaSoundCards:
                     return card_index
         return None
 
+    def get_capture_card_index_list_by_name(self, part_of_name):
+        """ Returns all found. """
+        card_index_list = []
+        for card_dict in self.card_list:
+            card_name = card_dict.get("card_name", "")
+            card_index = card_dict.get("card_index", "")
+            if card_index in self.capture_card_index_list:
+                if part_of_name in card_name:
+                    card_index_list.append(card_index)
+        return card_index_list
+
     def get_playback_card_index_by_name(self, part_of_name):
         """ Returns first found. """
         for card_dict in self.card_list:
@@ -148,12 +163,29 @@ class AlsaSoundCapture:
         """ """
         self.data_queue = data_queue
         self.direct_target = direct_target
+        self.queue_policy = None  # Overflow handling for data_queue.
+        self.executor = None  # Thread for the capture loop, default pool if None.
         self.card_index = None
         self.sampling_freq = None
         self.buffer_size = None
         # Internal.
         self.logger = logging.getLogger("CloudedBats-WURB")
         self.capture_active = False
+        self.copy_rate_counter = wurb_rec.CopyRateCounter()
+        self.bridge = None
+        self.overrun_counter = 0
+        self.thread_cpu_start_s = 0.0
+        self.thread_cpu_s = 0.0
+        self.capture_clock = None
+        self.use_htimestamp = True
+        self.gap_deque = deque()  # Entries: (ring frame position, frames).
+        self.block_gap_frames = 0
+        # Config, may be changed by capture profiles.
+        self.copy_rate_log_interval_s = 60  # Unit: sec.
+        self.max_zero_fill_s = 1.0  # Unit: sec. Longer gaps are not filled.
+        self.max_batch_latency_s = 0.0  # Unit: sec.
+        self.period_size = 4096  # Unit: frames.
+        self.channels = 1
 
     def is_capture_active(self):
         """ """
@@ -173,39 +205,192 @@ class AlsaSoundCapture:
             self.logger.debug("ERROR: CAPTURE already running: ")
             return
         #
-        await self.main_loop.run_in_executor(None, self.start_capture)
+        await self.main_loop.run_in_executor(self.executor, self.start_capture)
 
     async def stop_capture(self):
         """ """
         # Use traditional thread termination.
         self.capture_active = False
 
+    def create_bridge(self):
+        """ One event loop wakeup for all blocks ready in the capture thread. """
+        self.bridge = wurb_rec.ThreadToLoopBridge(
+            self.main_loop, max_batch_latency_s=self.max_batch_latency_s
+        )
+        if self.data_queue:
+            self.bridge.add_queue_channel(
+                "data_queue", self.data_queue, queue_policy=self.queue_policy
+            )
+        if self.direct_target:
+            self.bridge.add_target_channel("direct_target", self.direct_target)
+
+    def get_dropped_blocks(self):
+        """ Blocks dropped because the data queue was full. """
+        if self.bridge:
+            return self.bridge.dropped_counter
+        return 0
+
+    def get_thread_cpu_s(self):
+        """ CPU time used by the capture thread. """
+        return self.thread_cpu_s - self.thread_cpu_start_s
+
+    def get_gap_stats(self):
+        """ Gaps caused by overruns and clock drift. """
+        if self.capture_clock:
+            return self.capture_clock.get_gap_stats()
+        return {}
+
+    def enable_htimestamp(self, pmc_capture):
+        """ ALSA hardware timestamps, if supported by pyalsaaudio. """
+        try:
+            pmc_capture.set_tstamp_mode(alsaaudio.PCM_TSTAMP_ENABLE)
+            pmc_capture.set_tstamp_type(alsaaudio.PCM_TSTAMP_TYPE_GETTIMEOFDAY)
+            self.use_htimestamp = True
+        except Exception as e:
+            self.use_htimestamp = False
+            self.logger.debug("Capture: Hardware timestamps not used: " + str(e))
+
+    def get_capture_time(self, pmc_capture):
+        """ Time for the last read frame. Uses the ALSA hardware timestamp
+        and the number of frames left in the buffer, if available. """
+        if self.use_htimestamp:
+            try:
+                seconds, nanoseconds, available_frames = pmc_capture.htimestamp()
+                if seconds > 0:
+                    return (
+                        seconds
+                        + nanoseconds / 1000000000.0
+                        - available_frames / self.sampling_freq
+                    )
+            except Exception as e:
+                self.use_htimestamp = False
+                self.logger.debug("Capture: Hardware timestamps failed: " + str(e))
+        return time.time()
+
+    def get_bridge_stats(self):
+        """ Wakeups per second and queueing delay since last call. """
+        if self.bridge:
+            return self.bridge.get_stats()
+        return {}
+
+    def get_copied_bytes_per_s(self):
+        """ Copied bytes per second since last call. """
+        return self.copy_rate_counter.update()
+
+    def add_gap_to_ring(self, ring_buffer, buffer_pool, gap_frames):
+        """Short gaps are filled with zeros, the stream and the sound files
+        are kept sample-accurate. For longer gaps the current block is
+        completed with zeros and the rest of the gap is stored in
+        gap_before_s for the next block, the file is closed at the gap."""
+        zero_frames = gap_frames
+        if gap_frames > self.max_zero_fill_s * self.sampling_freq:
+            zero_frames = min(gap_frames, ring_buffer.get_frames_to_block_end())
+        remaining_frames = zero_frames
+        while remaining_frames > 0:
+            remaining_frames -= ring_buffer.write_zeros(remaining_frames)
+            self.deliver_blocks(ring_buffer, buffer_pool)
+        if gap_frames > zero_frames:
+            self.gap_deque.append(
+                (ring_buffer.frames_written, gap_frames - zero_frames)
+            )
+
+    def deliver_blocks(self, ring_buffer, buffer_pool):
+        """ All complete blocks in the ring are posted to the event loop. """
+        while ring_buffer.has_block():
+            # Sample index for the first frame in block, including gaps.
+            block_ring_pos = ring_buffer.frames_read
+            gap_before_frames = 0
+            while self.gap_deque and (self.gap_deque[0][0] <= block_ring_pos):
+                gap_before_frames += self.gap_deque.popleft()[1]
+            self.block_gap_frames += gap_before_frames
+            sample_index = block_ring_pos + self.block_gap_frames
+            # One copy from the ring buffer into a pooled block.
+            # The block is shared by reference by all consumers.
+            block = buffer_pool.get_block(ring_buffer.read_block())
+            self.copy_rate_counter.add(block.data.nbytes)
+
+            # Use data queue.
+            if self.data_queue:
+                device_time = self.capture_clock.get_time(sample_index)
+                # Used to detect time drift.
+                detector_time = time.time()
+                # Put together.
+                audio_block = wurb_rec.AudioBlock(
+                    block.data,
+                    block.retain(),
+                    sample_index,
+                    device_time,
+                    detector_time,
+                )
+                audio_block.gap_before_s = gap_before_frames / self.sampling_freq
+                try:
+                    self.bridge.post("data_queue", audio_block)
+                #
+                except Exception as e:
+                    block.release()
+                    # Logging error.
+                    message = "Failed to put data on queue: " + str(e)
+                    self.logger.debug(message)
+
+            # Use data buffer.
+            if self.direct_target:
+                # The target object must contain the methods is_active() and add_data().
+                # add_data() receives a shared block and must release it.
+                try:
+                    if self.direct_target.is_active():
+                        self.bridge.post("direct_target", block.retain())
+                except Exception as e:
+                    # Logging error.
+                    message = "Failed to add data to direct_target: " + str(e)
+                    self.logger.debug(message)
+
+            # Release the reference owned by the capture loop.
+            block.release()
+
     def start_capture(self):
         """ """
         self.logger.debug("CAPTURE STARTED.")
         pmc_capture = None
         self.capture_active = True
         try:
-            calculated_time_s = time.time()
-            time_increment_s = self.buffer_size / self.sampling_freq
+            period_size = self.period_size
+            self.overrun_counter = 0
+            self.thread_cpu_start_s = time.thread_time()
+            self.thread_cpu_s = self.thread_cpu_start_s
 
             pmc_capture = alsaaudio.PCM(
                 alsaaudio.PCM_CAPTURE,
                 alsaaudio.PCM_NORMAL,
                 # alsaaudio.PCM_NONBLOCK,
-                channels=1,
+                channels=self.channels,
                 rate=self.sampling_freq,
                 format=alsaaudio.PCM_FORMAT_S16_LE,
-                periodsize=4096, # self.buffer_size,
+                periodsize=period_size, # self.buffer_size,
                 device="sysdefault",
                 cardindex=self.card_index,
             )
-
-            in_buffer_int16 = numpy.array([], dtype=numpy.int16)
+            self.enable_htimestamp(pmc_capture)
+            # Sample based clock.
+            self.capture_clock = wurb_rec.CaptureClock(self.sampling_freq)
+            self.gap_deque = deque()
+            self.block_gap_frames = 0
+
+            # Preallocated, blocks are delivered without reallocation.
+            ring_buffer = wurb_rec.AudioRingBuffer(
+                self.buffer_size, period_size, channels=self.channels
+            )
+            buffer_pool = wurb_rec.AudioBufferPool(
+                self.buffer_size, channels=self.channels
+            )
+            self.create_bridge()
+            self.copy_rate_counter.clear()
+            copy_rate_log_time_s = time.time() + self.copy_rate_log_interval_s
             while self.capture_active:
                 # Read from capture device.
                 length, data = pmc_capture.read()
                 if length < 0:
+                    self.overrun_counter += 1
+                    self.capture_clock.add_overrun()
                     self.logger.debug("SOUND CAPTURE OVERRUN: " + str(length))
                 elif len(data) > 0:
                     # Convert from string-byte array to int16 array.
@@ -214,62 +399,56 @@ class AlsaSoundCapture:
                     # Temporary solution for stereo sound cards that can't 
                     # run in mono mode (or maybe related to a bug in alsaaudio).
                     # Extract one channel if the data array is doubled in size.
-                    if (length * 2) == in_data_int16.size:
-                        in_data_int16 = in_data_int16[1::2].copy()
-
-                    # Concatenate
-                    in_buffer_int16 = numpy.concatenate((in_buffer_int16, in_data_int16))
-
-                    while len(in_buffer_int16) >= self.buffer_size:
-                        # Copy "buffer_size" part and save remaining part.
-                        data_int16 = in_buffer_int16[0:self.buffer_size]
-                        in_buffer_int16 = in_buffer_int16[self.buffer_size:]
-
-                        # Use data queue.
-                        if self.data_queue:
-                            # Time rounded to half sec.
-                            calculated_time_s += time_increment_s
-                            device_time = int((calculated_time_s) * 2) / 2
-                            # Used to detect time drift.
-                            detector_time = time.time()
-                            # Copy data.
-                            data_int16_copy = data_int16.copy()
-                            # Put together.
-                            data_dict = {
-                                "status": "data",
-                                "adc_time": device_time,
-                                "detector_time": detector_time,
-                                "data": data_int16_copy,
-                            }
-                            try:
-                                if not self.data_queue.full():
-                                    self.main_loop.call_soon_threadsafe(
-                                        self.data_queue.put_nowait, data_dict
-                                    )
-                            #
-                            except Exception as e:
-                                # Logging error.
-                                message = "Failed to put data on queue: " + str(e)
-                                self.logger.debug(message)
-
-                        # Use data buffer.
-                        if self.direct_target:
-                            # The target object must contain the methods is_active() and add_data().
-                            try:
-                                if self.direct_target.is_active():
-                                    data_int16_copy = data_int16.copy()
-                                    self.main_loop.call_soon_threadsafe(
-                                        self.direct_target.add_data, data_int16_copy
-                                    )
-                            except Exception as e:
-                                # Logging error.
-                                message = "Failed to add data to direct_target: " + str(e)
-                                self.logger.debug(message)
+                    if (self.channels == 1) and ((length * 2) == in_data_int16.size):
+                        in_data_int16 = in_data_int16[1::2]
+
+                    # Update clock. Frames lost after overruns are counted as gaps.
+                    number_of_frames = in_data_int16.size // self.channels
+                    gap_frames = self.capture_clock.update(
+                        number_of_frames, self.get_capture_time(pmc_capture)
+                    )
+                    if gap_frames > 0:
+                        self.add_gap_to_ring(ring_buffer, buffer_pool, gap_frames)
+                        message = "Capture: Gap after overrun. Lost: " + str(
+                            round(gap_frames / self.sampling_freq, 3)
+                        ) + " s."
+                        self.logger.info(message)
+
+                    # Copy into the ring buffer. Multi-channel data is
+                    # stored interleaved, channels are views into blocks.
+                    ring_buffer.write(in_data_int16)
+                    self.copy_rate_counter.add(in_data_int16.nbytes)
+                    self.deliver_blocks(ring_buffer, buffer_pool)
+
+                    # Wake up the event loop if the batch latency is reached.
+                    self.bridge.poll()
+                    self.thread_cpu_s = time.thread_time()
+
+                    # Log copy rate, used to check memory bandwidth usage.
+                    if time.time() > copy_rate_log_time_s:
+                        copy_rate_log_time_s = time.time() + self.copy_rate_log_interval_s
+                        message = "Capture: Copied bytes/s: " + str(
+                            int(self.get_copied_bytes_per_s())
+                        )
+                        self.logger.debug(message)
+                        bridge_stats = self.get_bridge_stats()
+                        message = "Capture: Wakeups/s: " + str(
+                            round(bridge_stats.get("wakeups_per_s", 0.0), 1)
+                        )
+                        message += " Mean delay ms: " + str(
+                            round(bridge_stats.get("mean_delay_s", 0.0) * 1000, 1)
+                        )
+                        message += " Max delay ms: " + str(
+                            round(bridge_stats.get("max_delay_s", 0.0) * 1000, 1)
+                        )
+                        self.logger.debug(message)
         #
         except Exception as e:
             self.logger.debug("EXCEPTION CAPTURE: " + str(e))
         finally:
             self.capture_active = False
+            if self.bridge:
+                self.bridge.flush()
             if pmc_capture:
                 pmc_capture.close()
             self.logger.debug("CAPTURE ENDED.")
@@ -323,7 +502,7 @@ class AlsaSoundPlayback:
 
     async def playback_executor(self):
         """ Use executor for IO-blocking function. """
-        await self.main_loop.run_in_executor(None, self.alsa_playback)
+        await self.main_loop.run_in_executor(self.executor, self.alsa_playback)
 
     async def stop_playback(self):
         """ """
@@ -346,9 +525,10 @@ class AlsaSoundPlayback:
                 self.data_queue.task_done()
             while True:
                 try:
-                    data_dict = await self.data_queue.get()
-                    if "data" in data_dict:
-                        self.add_data(data_dict["data"])
+                    item = await self.data_queue.get()
+                    if isinstance(item, wurb_rec.AudioBlock):
+                        self.add_data(item.data)
+                        item.release()
                 except asyncio.CancelledError:
                     break
                 except Exception as e:
@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import enum
+
+
+class BlockFlags(enum.IntFlag):
+    """ Flags for sound blocks in the pipeline. """
+
+    DATA = 1
+    NEW_FILE = 2  # First block in a sound file.
+    CLOSE_FILE = 4  # Last block in a sound file.
+    CLOSE_BEFORE = 8  # The last block in the earlier file was dropped.
+
+
+class AudioBlock:
+    """One sound block on its way through the pipeline, from capture
+    to detection and file writing. Created once by the capture object
+    and passed on by reference, only flags and peak values are changed
+    on the way. The sound data is a view into the shared block, if used.
+    The shared block reference is owned by the audio block and returned
+    to the pool by release().
+    """
+
+    __slots__ = (
+        "flags",
+        "sample_index",
+        "adc_time",
+        "detector_time",
+        "data",
+        "shared_block",
+        "gap_before_s",
+        "max_peak_freq_hz",
+        "max_peak_dbfs",
+    )
+
+    def __init__(
+        self,
+        data,
+        shared_block=None,
+        sample_index=0,
+        adc_time=0.0,
+        detector_time=0.0,
+        flags=BlockFlags.DATA,
+    ):
+        """ """
+        self.flags = flags
+        self.sample_index = sample_index
+        self.adc_time = adc_time
+        self.detector_time = detector_time
+        self.data = data
+        self.shared_block = shared_block
+        self.gap_before_s = 0.0  # Dropped time before this block.
+        self.max_peak_freq_hz = None
+        self.max_peak_dbfs = None
+
+    def copy(self):
+        """ Shallow copy. The shared block is not retained. """
+        audio_block = AudioBlock(
+            self.data,
+            self.shared_block,
+            self.sample_index,
+            self.adc_time,
+            self.detector_time,
+            self.flags,
+        )
+        audio_block.gap_before_s = self.gap_before_s
+        audio_block.max_peak_freq_hz = self.max_peak_freq_hz
+        audio_block.max_peak_dbfs = self.max_peak_dbfs
+        return audio_block
+
+    def get_duration_s(self, sampling_freq_hz):
+        """ """
+        if (self.data is None) or (not sampling_freq_hz):
+            return 0.0
+        return len(self.data) / sampling_freq_hz
+
+    def get_end_time(self, sampling_freq_hz):
+        """ Time at the ADC for the end of the block. """
+        return self.adc_time + self.get_duration_s(sampling_freq_hz)
+
+    def release(self):
+        """ Returns the shared block to its pool, if used. """
+        shared_block = self.shared_block
+        if shared_block is not None:
+            self.shared_block = None
+            shared_block.release()
+
+
+class StreamSentinel:
+    """Control items in the pipeline queues. Only the two instances
+    below are used and compared by identity."""
+
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        """ """
+        self.name = name
+
+    def __repr__(self):
+        """ """
+        return "<" + self.name + ">"
+
+
+TERMINATE = StreamSentinel("terminate")
+FLUSH = StreamSentinel("flush")
+
+
+def release_item(item):
+    """ Returns the shared block in a queue item to its pool. """
+    if isinstance(item, AudioBlock):
+        item.release()
+
+
+# === MAIN - for test ===
+if __name__ == "__main__":
+    """ Allocations per block from capture to target, compared with the
+    dicts used earlier. """
+    import time
+    import tracemalloc
+    import numpy
+
+    data = numpy.zeros(10, dtype=numpy.int16)
+    number_of_blocks = 10000
+
+    def dict_pipeline(index):
+        item = {
+            "status": "data",
+            "sample_index": index,
+            "adc_time": time.time(),
+            "detector_time": time.time(),
+            "data": data,
+            "block": None,
+        }
+        # Copied by the process worker.
+        new_item = {}
+        new_item["status"] = "data-Counter-" + str(index % 10)
+        new_item["sample_index"] = item.get("sample_index", 0)
+        new_item["adc_time"] = item["adc_time"]
+        new_item["data"] = item["data"]
+        new_item["block"] = item.get("block", None)
+        if index % 10 == 0:
+            new_item["status"] = "new_file"
+            new_item["max_peak_freq_hz"] = 40000.0
+            new_item["max_peak_dbfs"] = -30.0
+        # Both are counted, the first one is only freed when processed.
+        return item, new_item
+
+    def block_pipeline(index):
+        item = AudioBlock(data, None, index, time.time(), time.time())
+        if index % 10 == 0:
+            item.flags |= BlockFlags.NEW_FILE
+            item.max_peak_freq_hz = 40000.0
+            item.max_peak_dbfs = -30.0
+        return item
+
+    for name, function in [("dict", dict_pipeline), ("AudioBlock", block_pipeline)]:
+        tracemalloc.start()
+        start_time_s = time.perf_counter()
+        items = [function(index) for index in range(number_of_blocks)]
+        elapsed_us = (time.perf_counter() - start_time_s) / number_of_blocks * 1e6
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        stats = snapshot.statistics("filename")
+        allocated_bytes = sum(stat.size for stat in stats)
+        allocated_counter = sum(stat.count for stat in stats)
+        print(
+            name,
+            " Bytes per block: ",
+            round(allocated_bytes / number_of_blocks),
+            " Allocations per block: ",
+            round(allocated_counter / number_of_blocks, 1),
+            " Time per block, us: ",
+            round(elapsed_us, 2),
+        )
+        del items
@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import time
+import threading
+import numpy
+
+
+class AudioRingBuffer:
+    """Preallocated ring buffer for int16 sound data.
+    Data is written period by period, as delivered by the sound card,
+    and read as blocks of fixed size. No memory is allocated after init.
+    The capacity is a multiple of the block size, therefore blocks never
+    wrap around the end and can be delivered as views into the ring.
+    Multi-channel data is written interleaved, as delivered by ALSA, and
+    stored as frames. Sizes are counted in frames.
+    """
+
+    def __init__(self, block_size, period_size, channels=1):
+        """ """
+        self.block_size = int(block_size)
+        self.period_size = int(period_size)
+        self.channels = int(channels)
+        # Room for one incomplete block plus one period, rounded up to blocks.
+        no_of_blocks = -(-(self.block_size + self.period_size) // self.block_size)
+        self.capacity = max(2, no_of_blocks) * self.block_size
+        self.ring = numpy.zeros((self.capacity, self.channels), dtype=numpy.int16)
+        self.clear()
+
+    def clear(self):
+        """ """
+        self.write_pos = 0
+        self.read_pos = 0
+        self.available = 0
+        # Counters.
+        self.frames_written = 0
+        self.frames_read = 0
+        self.bytes_copied = 0
+        self.overflow_frames = 0
+        self.zero_frames = 0
+
+    def write(self, data_int16):
+        """Copy data into the ring. If there is no room left the
+        oldest frames are overwritten and counted as overflow."""
+        # Interleaved to frames, a view without copy.
+        data_int16 = data_int16.reshape(-1, self.channels)
+        length = len(data_int16)
+        if length == 0:
+            return
+        if length > self.capacity:
+            # Only the last part will fit.
+            self.overflow_frames += length - self.capacity
+            data_int16 = data_int16[-self.capacity :]
+            length = self.capacity
+        # Copy, in two parts if the end of the ring is passed.
+        first_part = min(length, self.capacity - self.write_pos)
+        self.ring[self.write_pos : self.write_pos + first_part] = data_int16[
+            :first_part
+        ]
+        if first_part < length:
+            self.ring[: length - first_part] = data_int16[first_part:]
+        self.write_pos = (self.write_pos + length) % self.capacity
+        self.frames_written += length
+        self.bytes_copied += length * self.channels * self.ring.itemsize
+        # Drop oldest blocks if overwritten.
+        self.available += length
+        while self.available > self.capacity:
+            self.read_pos = (self.read_pos + self.block_size) % self.capacity
+            self.available -= self.block_size
+            self.frames_read += self.block_size
+            self.overflow_frames += self.block_size
+
+    def write_zeros(self, number_of_frames):
+        """Zeros for lost frames. Not more than there is room for, unread
+        frames are never overwritten. Returns number of frames written."""
+        length = max(0, min(number_of_frames, self.capacity - self.available))
+        first_part = min(length, self.capacity - self.write_pos)
+        self.ring[self.write_pos : self.write_pos + first_part] = 0
+        if first_part < length:
+            self.ring[: length - first_part] = 0
+        self.write_pos = (self.write_pos + length) % self.capacity
+        self.frames_written += length
+        self.available += length
+        self.zero_frames += length
+        return length
+
+    def get_frames_to_block_end(self):
+        """ Frames needed to complete the current block. """
+        return (self.block_size - self.available % self.block_size) % self.block_size
+
+    def has_block(self):
+        """ """
+        return self.available >= self.block_size
+
+    def read_block(self):
+        """Returns the next block as a view into the ring, or None.
+        The view is only valid until the next call to write().
+        Shape is (frames,) for mono and (frames, channels) otherwise."""
+        if self.available < self.block_size:
+            return None
+        block = self.ring[self.read_pos : self.read_pos + self.block_size]
+        if self.channels == 1:
+            block = block[:, 0]
+        self.read_pos = (self.read_pos + self.block_size) % self.capacity
+        self.available -= self.block_size
+        self.frames_read += self.block_size
+        return block
+
+
+class AudioBufferPool:
+    """Pool of reusable int16 buffers, all of the same size.
+    Used to share captured blocks between consumers without copying.
+    Buffers are returned to the pool when the last consumer releases
+    the block. Blocks that are never released are garbage collected
+    as usual and the pool will allocate new buffers when needed.
+    """
+
+    def __init__(self, buffer_size, max_free_buffers=32, channels=1):
+        """ """
+        self.buffer_size = int(buffer_size)
+        self.channels = int(channels)
+        self.max_free_buffers = max_free_buffers
+        self.free_buffers = []
+        self.lock = threading.Lock()
+        # Counters.
+        self.allocated_counter = 0
+        self.reused_counter = 0
+
+    def get_block(self, data_int16):
+        """Copy data into a pooled buffer and return it as a shared
+        block, with one reference owned by the caller."""
+        buffer = None
+        with self.lock:
+            if self.free_buffers:
+                buffer = self.free_buffers.pop()
+                self.reused_counter += 1
+        if buffer is None:
+            if self.channels == 1:
+                shape = self.buffer_size
+            else:
+                shape = (self.buffer_size, self.channels)
+            buffer = numpy.empty(shape, dtype=numpy.int16)
+            self.allocated_counter += 1
+        buffer[:] = data_int16
+        return SharedAudioBlock(self, buffer)
+
+    def put_back(self, buffer):
+        """ """
+        with self.lock:
+            if len(self.free_buffers) < self.max_free_buffers:
+                self.free_buffers.append(buffer)
+
+
+class SharedAudioBlock:
+    """Read-only sound block shared by reference between consumers.
+    Call retain() before handing it over to another consumer. Each
+    consumer must call release() when done with the data.
+    """
+
+    def __init__(self, pool, buffer):
+        """ """
+        self.pool = pool
+        self.buffer = buffer
+        self.data = buffer.view()
+        self.data.flags.writeable = False
+        self.reference_counter = 1
+
+    def get_channels(self):
+        """ """
+        if self.data.ndim == 1:
+            return 1
+        return self.data.shape[1]
+
+    def get_channel_data(self, channel):
+        """Data for one channel as a view, no copy."""
+        return get_channel_data(self.data, channel)
+
+    def retain(self):
+        """ """
+        with self.pool.lock:
+            self.reference_counter += 1
+        return self
+
+    def release(self):
+        """ """
+        with self.pool.lock:
+            self.reference_counter -= 1
+            is_last = self.reference_counter == 0
+        if is_last:
+            self.data = None
+            self.pool.put_back(self.buffer)
+            self.buffer = None
+
+
+def get_channel_data(data_int16, channel):
+    """Data for one channel as a view, no copy. Mono data is
+    one-dimensional, multi-channel data is stored as (frames, channels)."""
+    if data_int16.ndim == 1:
+        return data_int16
+    return data_int16[:, channel]
+
+
+class CopyRateCounter:
+    """Used to calculate copied bytes per second in the capture loops."""
+
+    def __init__(self):
+        """ """
+        self.clear()
+
+    def clear(self):
+        """ """
+        self.bytes_copied = 0
+        self.last_bytes_copied = 0
+        self.last_time_s = time.time()
+        self.bytes_per_s = 0.0
+
+    def add(self, number_of_bytes):
+        """ """
+        self.bytes_copied += number_of_bytes
+
+    def update(self):
+        """Returns copied bytes per second since last call."""
+        now_s = time.time()
+        elapsed_s = now_s - self.last_time_s
+        if elapsed_s > 0.0:
+            self.bytes_per_s = (self.bytes_copied - self.last_bytes_copied) / elapsed_s
+            self.last_bytes_copied = self.bytes_copied
+            self.last_time_s = now_s
+        return self.bytes_per_s
+
+
+# === MAIN - for test ===
+if __name__ == "__main__":
+    """ """
+    block_size = 192000
+    period_size = 4096
+    ring_buffer = AudioRingBuffer(block_size, period_size)
+    sent = numpy.arange(block_size * 10, dtype=numpy.int64).astype(numpy.int16)
+    received = []
+    for index in range(0, len(sent), period_size):
+        ring_buffer.write(sent[index : index + period_size])
+        while ring_buffer.has_block():
+            received.append(ring_buffer.read_block().copy())
+    received = numpy.concatenate(received)
+    print("Capacity: ", ring_buffer.capacity, "  Blocks: ", len(received) // block_size)
+    print("Equal: ", numpy.array_equal(sent[: len(received)], received))
+    print("Bytes copied: ", ring_buffer.bytes_copied)
+    print("Overflow frames: ", ring_buffer.overflow_frames)
+    # Lost frames filled with zeros, in parts when larger than the room.
+    ring_buffer = AudioRingBuffer(block_size, period_size)
+    ring_buffer.write(sent[:period_size])
+    zero_blocks = 0
+    remaining = block_size * 3
+    while remaining > 0:
+        remaining -= ring_buffer.write_zeros(remaining)
+        while ring_buffer.has_block():
+            block = ring_buffer.read_block()
+            zero_blocks += 1
+    print("Zero frames: ", ring_buffer.zero_frames, "  Blocks: ", zero_blocks,
+          "  Overflow frames: ", ring_buffer.overflow_frames)
+    # Pool.
+    pool = AudioBufferPool(block_size)
+    for index in range(10):
+        block = pool.get_block(received[:block_size])
+        block.retain()  # Two consumers.
+        block.release()
+        block.release()
+    print("Pool allocated: ", pool.allocated_counter, "  Reused: ", pool.reused_counter)
+    # Four channels, interleaved.
+    ring_buffer = AudioRingBuffer(block_size, period_size, channels=4)
+    interleaved = numpy.repeat(sent[: block_size * 2], 4)
+    interleaved[1::4] = -interleaved[1::4]
+    for index in range(0, len(interleaved), period_size * 4):
+        ring_buffer.write(interleaved[index : index + period_size * 4])
+    block = ring_buffer.read_block()
+    print("Shape: ", block.shape, "  Channel 1 ok: ",
+          numpy.array_equal(get_channel_data(block, 1), -sent[:block_size]))
@@ -9,6 +9,7 @@ import time
 import numpy
 import array
 import logging
+from collections import deque
 
 # CloudedBats.
 import wurb_rec
@@ -17,20 +18,40 @@ import wurb_rec
 class PetterssonM500():
     """ """
 
+    DEVICE_NAME = "Pettersson M500 (500kHz)"
+
     def __init__(self, data_queue=None, direct_target=None):
         """ """
         self.data_queue = data_queue
         self.direct_target = direct_target
+        self.queue_policy = None  # Overflow handling for data_queue.
+        self.executor = None  # Thread for the capture loop, default pool if None.
         self.card_index = None
         self.buffer_size = None
         # M500.
-        self.device_name = "Pettersson M500 (500kHz)"
+        self.device_name = self.DEVICE_NAME
         self.sampling_freq_hz = 500000
         self.pettersson_m500 = wurb_rec.PetterssonM500BatMic()
 
         # Internal.
         self.logger = logging.getLogger("CloudedBats-WURB")
         self.capture_active = False
+        self.bridge = None
+        self.overrun_counter = 0
+        self.thread_cpu_start_s = 0.0
+        self.thread_cpu_s = 0.0
+        self.capture_clock = None
+        self.ring_buffer = None
+        self.odd_byte = None
+        self.stream_byte_position = 0
+        self.stream_reader = None
+        self.gap_deque = deque()  # Entries: (ring frame position, frames).
+        self.block_gap_frames = 0
+        # Config, may be changed by capture profiles.
+        self.max_batch_latency_s = 0.0  # Unit: sec.
+        self.max_zero_fill_s = 1.0  # Unit: sec. Longer gaps are not filled.
+        self.usb_transfer_size = 0x20000  # Unit: bytes. Must be 2^n.
+        self.usb_stream_buffers = 0  # Reader thread used if > 0.
 
     def is_m500_available(self):
         """ """
@@ -62,21 +83,181 @@ class PetterssonM500():
             self.logger.debug("ERROR: CAPTURE already running: ")
             return
         #
-        await self.main_loop.run_in_executor(None, self.start_capture)
+        await self.main_loop.run_in_executor(self.executor, self.start_capture)
 
     async def stop_capture(self):
         """ """
         # Use traditional thread termination.
         self.capture_active = False
+        if self.stream_reader:
+            self.stream_reader.active = False
         self.pettersson_m500.stop_stream()
         self.pettersson_m500.reset()
 
+    def create_bridge(self):
+        """ One event loop wakeup for all blocks ready in the capture thread. """
+        self.bridge = wurb_rec.ThreadToLoopBridge(
+            self.main_loop, max_batch_latency_s=self.max_batch_latency_s
+        )
+        if self.data_queue:
+            self.bridge.add_queue_channel(
+                "data_queue", self.data_queue, queue_policy=self.queue_policy
+            )
+        if self.direct_target:
+            self.bridge.add_target_channel("direct_target", self.direct_target)
+
+    def get_dropped_blocks(self):
+        """ Blocks dropped because the data queue was full. """
+        if self.bridge:
+            return self.bridge.dropped_counter
+        return 0
+
+    def get_thread_cpu_s(self):
+        """ CPU time used by the capture thread. """
+        return self.thread_cpu_s - self.thread_cpu_start_s
+
+    def get_gap_stats(self):
+        """ Gaps and clock drift. """
+        if self.capture_clock:
+            return self.capture_clock.get_gap_stats()
+        return {}
+
+    def get_bridge_stats(self):
+        """ Wakeups per second and queueing delay since last call. """
+        if self.bridge:
+            return self.bridge.get_stats()
+        return {}
+
+    def get_usb_stream_stats(self):
+        """ Transfer counters, only when the reader thread is used. """
+        if self.stream_reader:
+            return self.stream_reader.get_counters()
+        return {}
+
+    def read_transfer(self, transfer_buffer):
+        """ Returns (buffer, number of bytes, lost bytes before the transfer, 
+            time when completed). The buffer is only used for direct reads. 
+        """
+        if self.stream_reader:
+            return self.stream_reader.get_transfer()
+        number_of_bytes = self.pettersson_m500.read_stream_into(transfer_buffer)
+        return (transfer_buffer, number_of_bytes, 0, time.time())
+
+    def add_lost_bytes(self, lost_bytes):
+        """ Returns number of lost frames, partly lost frames included. """
+        first_lost_frame = self.stream_byte_position // 2
+        self.stream_byte_position += lost_bytes
+        self.odd_byte = None
+        return (self.stream_byte_position + 1) // 2 - first_lost_frame
+
+    def add_transfer_to_ring(self, ring_buffer, transfer_buffer, number_of_bytes):
+        """ Writes an int16 view of the transfer buffer to the ring.
+            An odd byte at the end is kept until the next transfer.
+            Returns number of frames written.
+        """
+        number_of_frames = 0
+        offset = 0
+        if (self.stream_byte_position % 2) and (number_of_bytes > 0):
+            if self.odd_byte is not None:
+                pair = numpy.array(
+                    [self.odd_byte, transfer_buffer[0]], dtype=numpy.uint8
+                )
+                ring_buffer.write(pair.view(numpy.int16))
+                number_of_frames += 1
+            # Otherwise the first byte belongs to a lost frame.
+            self.odd_byte = None
+            offset = 1
+        even_frames = (number_of_bytes - offset) // 2
+        if even_frames > 0:
+            # A view, no copy.
+            data_int16 = numpy.frombuffer(
+                transfer_buffer, dtype=numpy.int16, count=even_frames, offset=offset
+            )
+            ring_buffer.write(data_int16)
+            number_of_frames += even_frames
+        if (number_of_bytes - offset) % 2:
+            self.odd_byte = transfer_buffer[number_of_bytes - 1]
+        self.stream_byte_position += number_of_bytes
+        return number_of_frames
+
+    def add_gap_to_ring(self, ring_buffer, buffer_pool, gap_frames):
+        """Lost transfers are filled with zeros, the stream and the sound
+        files are kept sample-accurate. For longer gaps the current block
+        is completed with zeros and the rest of the gap is stored in
+        gap_before_s for the next block."""
+        zero_frames = gap_frames
+        if gap_frames > self.max_zero_fill_s * self.sampling_freq_hz:
+            zero_frames = min(gap_frames, ring_buffer.get_frames_to_block_end())
+        remaining_frames = zero_frames
+        while remaining_frames > 0:
+            remaining_frames -= ring_buffer.write_zeros(remaining_frames)
+            self.deliver_blocks(ring_buffer, buffer_pool)
+        if gap_frames > zero_frames:
+            self.gap_deque.append(
+                (ring_buffer.frames_written, gap_frames - zero_frames)
+            )
+
+    def deliver_blocks(self, ring_buffer, buffer_pool):
+        """ All complete blocks in the ring are posted to the event loop. """
+        while ring_buffer.has_block():
+            # Sample index for the first frame in block, including gaps.
+            block_ring_pos = ring_buffer.frames_read
+            gap_before_frames = 0
+            while self.gap_deque and (self.gap_deque[0][0] <= block_ring_pos):
+                gap_before_frames += self.gap_deque.popleft()[1]
+            self.block_gap_frames += gap_before_frames
+            sample_index = block_ring_pos + self.block_gap_frames
+            # A view into the ring, no copy.
+            data_int16 = ring_buffer.read_block()
+
+            # One copy into a pooled block, shared by all consumers.
+            block = buffer_pool.get_block(data_int16)
+
+            # Use data queue.
+            if self.data_queue:
+                buffer_adc_time = self.capture_clock.get_time(sample_index)
+                detector_time = time.time()
+                # Put together.
+                audio_block = wurb_rec.AudioBlock(
+                    block.data,
+                    block.retain(),
+                    sample_index,
+                    buffer_adc_time,
+                    detector_time,
+                )
+                audio_block.gap_before_s = gap_before_frames / self.sampling_freq_hz
+                # Add to queue in main event loop.
+                try:
+                    self.bridge.post("data_queue", audio_block)
+                except Exception as e:
+                    block.release()
+                    # Logging error.
+                    message = "Failed to put buffer on queue (M500): " + str(e)
+                    self.logger.debug(message)
+                    pass
+
+            # Use data buffer.
+            if self.direct_target:
+                # The target object must contain the methods is_active() and add_data().
+                # add_data() receives a shared block and must release it.
+                try:
+                    if self.direct_target.is_active():
+                        self.bridge.post("direct_target", block.retain())
+                except Exception as e:
+                    # Logging error.
+                    message = "Failed to add data to direct_target: " + str(e)
+                    self.logger.debug(message)
+
+            # Release the reference owned by the capture loop.
+            block.release()
+
     def start_capture(self):
         """ For the Pettersson M500 microphone. """
         self.active = True
         #
         try:
-            self.stream_time_s = time.time()
+            # Sample based clock, corrected by the system clock.
+            self.capture_clock = wurb_rec.CaptureClock(self.sampling_freq_hz)
             self.pettersson_m500.start_stream()
             self.pettersson_m500.led_on()
         except Exception as e:
@@ -86,68 +267,59 @@ class PetterssonM500():
             return
         # Main loop.
         try:
-            # buffer_size = int(self.sampling_freq_hz / 2)
-            buffer_size = int(self.sampling_freq_hz)  # Size gives 0.5 sec. buffers.
-            data_array = array.array("B")
-            data = self.pettersson_m500.read_stream()
-            data_array += data
-            while self.active and (len(data) > 0):
-                # Push 0.5 sec each time. M500 can't deliver that size directly.
-                if len(data_array) >= buffer_size:
-                    # Add time and check for time drift.
-                    self.stream_time_s += 0.5  # One buffer is 0.5 sec.
-                    # Push time and data buffer.
-                    data_buffer = data_array[0:buffer_size]
-                    data_int16 = numpy.fromstring(
-                        data_buffer.tobytes(), dtype=numpy.int16
-                    )  # To ndarray.
-
-                    # Use data queue.
-                    if self.data_queue:
-                        # Round to half seconds.
-                        buffer_adc_time = int((self.stream_time_s) * 2) / 2
-                        detector_time = time.time()
-                        # Copy data.
-                        data_int16_copy = data_int16.copy()
-                        # Put together.
-                        send_dict = {
-                            "status": "data",
-                            "adc_time": buffer_adc_time,
-                            "detector_time": detector_time,
-                            "data": data_int16_copy,
-                        }
-                        # Add to queue in main event loop.
-                        try:
-                            if not self.data_queue.full():
-                                self.main_loop.call_soon_threadsafe(
-                                    self.data_queue.put_nowait, send_dict
-                                )
-                        except Exception as e:
-                            # Logging error.
-                            message = "Failed to put buffer on queue (M500): " + str(e)
-                            self.logger.debug(message)
-                            pass
-
-                    # Use data buffer.
-                    if self.direct_target:
-                        # The target object must contain the methods is_active() and add_data().
-                        try:
-                            if self.direct_target.is_active():
-                                data_int16_copy = data_int16.copy()
-                                self.main_loop.call_soon_threadsafe(
-                                    self.direct_target.add_data, data_int16_copy
-                                )
-                        except Exception as e:
-                            # Logging error.
-                            message = "Failed to add data to direct_target: " + str(e)
-                            self.logger.debug(message)
-
-                    # print("DEBUG M500 buffer: ", data_int16, "    Len: ", len(data_int16))
-                    # Save remaining part.
-                    data_array = data_array[buffer_size:]
+            buffer_pool = wurb_rec.AudioBufferPool(self.buffer_size)
+            # Preallocated, USB transfers are read directly into it.
+            direct_buffer = array.array("B", bytes(self.usb_transfer_size))
+            # Blocks are assembled in a ring, one copy from the transfer buffer.
+            ring_buffer = wurb_rec.AudioRingBuffer(
+                self.buffer_size, self.usb_transfer_size // 2 + 1
+            )
+            self.ring_buffer = ring_buffer
+            self.odd_byte = None
+            self.stream_byte_position = 0
+            self.gap_deque = deque()
+            self.block_gap_frames = 0
+            self.create_bridge()
+            self.thread_cpu_start_s = time.thread_time()
+            self.thread_cpu_s = self.thread_cpu_start_s
+            self.capture_clock.start()
+            # Optional reader thread, keeps transfers going while Python is busy.
+            self.stream_reader = None
+            if self.usb_stream_buffers > 0:
+                self.stream_reader = wurb_rec.PetterssonM500StreamReader(
+                    self.pettersson_m500,
+                    transfer_size=self.usb_transfer_size,
+                    number_of_buffers=self.usb_stream_buffers,
+                )
+                self.stream_reader.start()
+            transfer = self.read_transfer(direct_buffer)
+            transfer_buffer, number_of_bytes, lost_bytes, transfer_time_s = transfer
+            while self.active and (number_of_bytes > 0):
+                if lost_bytes > 0:
+                    # Exact size of the gap is known for lost transfers.
+                    gap_frames = self.add_lost_bytes(lost_bytes)
+                    self.capture_clock.add_gap(gap_frames)
+                    self.add_gap_to_ring(ring_buffer, buffer_pool, gap_frames)
+                    self.overrun_counter += 1
+                    message = "Capture: Lost USB transfers (M500). Lost: " + str(
+                        round(gap_frames / self.sampling_freq_hz, 3)
+                    ) + " s."
+                    self.logger.info(message)
+                number_of_frames = self.add_transfer_to_ring(
+                    ring_buffer, transfer_buffer, number_of_bytes
+                )
+                if self.stream_reader:
+                    self.stream_reader.put_back(transfer_buffer)
+                self.capture_clock.update(number_of_frames, transfer_time_s)
+                # Push one block each time. M500 can't deliver that size directly.
+                self.deliver_blocks(ring_buffer, buffer_pool)
+
+                # Wake up the event loop if the batch latency is reached.
+                self.bridge.poll()
+                self.thread_cpu_s = time.thread_time()
                 # Add next buffer from M500.
-                data = self.pettersson_m500.read_stream()
-                data_array += data
+                transfer = self.read_transfer(direct_buffer)
+                transfer_buffer, number_of_bytes, lost_bytes, transfer_time_s = transfer
 
         except asyncio.CancelledError:
             pass
@@ -155,3 +327,154 @@ class PetterssonM500():
             # Logging error.
             message = "Recorder: sound_source_worker (M500): " + str(e)
             self.logger.debug(message)
+        finally:
+            if self.stream_reader:
+                self.stream_reader.stop()
+            if self.bridge:
+                self.bridge.flush()
+
+
+# === MAIN - for test ===
+class FakeM500BatMic:
+    """Simulated M500 USB endpoint, delivers an int16 ramp. Every tenth
+    transfer is short, with an odd length, as may happen on the bus.
+    If bytes_per_s is given, data is produced at that rate into a device
+    FIFO and bytes are lost in the device when the FIFO is full. Losses are
+    counted in overrun_counter of overrun_target, if given."""
+
+    def __init__(
+        self, total_bytes, bytes_per_s=None, fifo_size=0x40000, overrun_target=None
+    ):
+        """ """
+        self.overrun_target = overrun_target
+        self.pattern = numpy.arange(0x10000, dtype=numpy.uint16).tobytes()
+        self.total_bytes = total_bytes
+        self.bytes_per_s = bytes_per_s
+        self.fifo_size = fifo_size
+        self.position = 0
+        self.transfer_counter = 0
+        self.device_lost_bytes = 0
+        self.start_time_s = time.perf_counter()
+
+    def start_stream(self):
+        self.start_time_s = time.perf_counter()
+
+    def stop_stream(self):
+        pass
+
+    def led_on(self):
+        pass
+
+    def reset(self):
+        pass
+
+    def read_stream_into(self, buffer):
+        """ """
+        self.transfer_counter += 1
+        if self.bytes_per_s:
+            elapsed_s = time.perf_counter() - self.start_time_s
+            in_fifo = int(elapsed_s * self.bytes_per_s) - self.position
+            if in_fifo > self.fifo_size:
+                if self.overrun_target:
+                    self.overrun_target.overrun_counter += 1
+                self.device_lost_bytes += in_fifo - self.fifo_size
+                self.position += in_fifo - self.fifo_size
+        length = min(len(buffer), self.total_bytes - self.position)
+        if (self.transfer_counter % 10) == 0:
+            length = min(length, 1001)
+        if length <= 0:
+            return 0
+        if self.bytes_per_s:
+            ready_time_s = self.start_time_s + (self.position + length) / self.bytes_per_s
+            time.sleep(max(0.0, ready_time_s - time.perf_counter()))
+        target = memoryview(buffer)
+        done = 0
+        while done < length:
+            start = (self.position + done) % len(self.pattern)
+            part = min(length - done, len(self.pattern) - start)
+            target[done : done + part] = self.pattern[start : start + part]
+            done += part
+        self.position += length
+        return length
+
+
+class StallingM500(PetterssonM500):
+    """Simulates Python stalls in the capture thread, 0.4 s for every
+    twentieth transfer."""
+
+    def add_transfer_to_ring(self, ring_buffer, transfer_buffer, number_of_bytes):
+        """ """
+        self.stall_counter = getattr(self, "stall_counter", 0) + 1
+        if (self.stall_counter % 20) == 0:
+            time.sleep(0.4)
+        return super().add_transfer_to_ring(ring_buffer, transfer_buffer, number_of_bytes)
+
+
+async def run_test(capture_class, total_bytes, bytes_per_s=None, stream_buffers=0):
+    """ """
+    sampling_freq_hz = 500000
+    block_size = sampling_freq_hz // 2
+    data_queue = asyncio.Queue(maxsize=1000)
+    capture = capture_class(data_queue=data_queue)
+    capture.pettersson_m500 = FakeM500BatMic(total_bytes, bytes_per_s=bytes_per_s)
+    capture.usb_stream_buffers = stream_buffers
+    await capture.initiate_capture(None, sampling_freq_hz, block_size)
+    start_time_s = time.perf_counter()
+    await capture.start_capture_in_executor()
+    elapsed_s = time.perf_counter() - start_time_s
+    await asyncio.sleep(0.1)
+    # Check that the ramp is continuous. Lost frames are zeros.
+    number_of_blocks = 0
+    is_continuous = True
+    next_sample_index = 0
+    while not data_queue.empty():
+        item = data_queue.get_nowait()
+        expected = numpy.arange(
+            item.sample_index, item.sample_index + block_size, dtype=numpy.int64
+        ) % 0x10000
+        data_uint16 = item.data.view(numpy.uint16)
+        if not numpy.all((data_uint16 == expected) | (data_uint16 == 0)):
+            is_continuous = False
+        if item.sample_index != next_sample_index:
+            is_continuous = False
+        next_sample_index = item.sample_index + block_size
+        item.release()
+        number_of_blocks += 1
+    print("Blocks: ", number_of_blocks, "  Continuous: ", is_continuous)
+    captured_bytes = number_of_blocks * block_size * 2
+    print("Throughput MB/s: ", round(captured_bytes / elapsed_s / 1000000, 1))
+    print("Capture thread CPU s: ", round(capture.get_thread_cpu_s(), 3))
+    print(
+        "Ring bytes copied per captured byte: ",
+        round(capture.ring_buffer.bytes_copied / max(1, captured_bytes), 3),
+    )
+    print("Lost in device FIFO, bytes: ", capture.pettersson_m500.device_lost_bytes)
+    print("Gaps: ", capture.get_gap_stats())
+    print("USB stream: ", capture.get_usb_stream_stats())
+    # Bytes lost in the device FIFO are not reported, as for the real M500.
+    if capture.pettersson_m500.device_lost_bytes == 0:
+        assert is_continuous
+        gap_frames = capture.get_gap_stats().get("gap_frames", 0)
+        assert capture.ring_buffer.zero_frames == gap_frames
+
+
+async def main():
+    """ """
+    print("\n=== Throughput, direct reads.")
+    await run_test(PetterssonM500, total_bytes=1000000 * 60)
+    print("\n=== Throughput at 20 MB/s, reader thread.")
+    await run_test(
+        PetterssonM500, 1000000 * 60, bytes_per_s=20000000, stream_buffers=8
+    )
+    # Fixed rate as for the real M500, with stalls in the capture thread.
+    print("\n=== Stalls at 1 MB/s, direct reads.")
+    await run_test(StallingM500, 1000000 * 8, bytes_per_s=1000000)
+    print("\n=== Stalls at 1 MB/s, reader thread.")
+    await run_test(StallingM500, 1000000 * 8, bytes_per_s=1000000, stream_buffers=8)
+    print("\n=== Stalls at 1 MB/s, reader thread, too few buffers.")
+    await run_test(StallingM500, 1000000 * 8, bytes_per_s=1000000, stream_buffers=2)
+
+
+if __name__ == "__main__":
+    """ """
+    asyncio.run(main(), debug=False)
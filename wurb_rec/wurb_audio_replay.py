@@ -0,0 +1,290 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import asyncio
+import time
+import wave
+import pathlib
+import numpy
+import logging
+
+# CloudedBats.
+import wurb_rec
+
+
+class WavFileReplay:
+    """Sound source that replays one WAV file, or all WAV files in a
+    directory, instead of a microphone. Blocks are delivered in the same
+    way as for AlsaSoundCapture, the files are handled as one continuous
+    stream. The last incomplete block is not delivered.
+    Modes: "real-time" for the same pace as a microphone, or
+    "as-fast-as-possible" to measure the throughput of the pipeline. In
+    the latter mode the replay waits when the data queue is half full,
+    instead of dropping blocks.
+    """
+
+    DEVICE_NAME = "File replay"
+
+    def __init__(self, data_queue=None, direct_target=None, replay_path=""):
+        """ """
+        self.data_queue = data_queue
+        self.direct_target = direct_target
+        self.queue_policy = None  # Overflow handling for data_queue.
+        self.executor = None  # Thread for the replay loop, default pool if None.
+        self.replay_path = replay_path
+        self.card_index = None
+        self.sampling_freq = None
+        self.buffer_size = None
+        # Internal.
+        self.logger = logging.getLogger("CloudedBats-WURB")
+        self.device_name = self.DEVICE_NAME
+        self.capture_active = False
+        self.bridge = None
+        self.overrun_counter = 0
+        self.thread_cpu_start_s = 0.0
+        self.thread_cpu_s = 0.0
+        self.capture_clock = None
+        self.replayed_frames = 0
+        self.replayed_files = 0
+        self.skipped_files = 0
+        # Config, may be changed by capture profiles.
+        self.max_batch_latency_s = 0.0  # Unit: sec.
+        self.period_size = 4096  # Unit: frames. Frames read each time.
+        self.channels = 1
+        self.replay_mode = "real-time"  # Or "as-fast-as-possible".
+
+    def get_device_name(self):
+        """ """
+        return self.device_name
+
+    def get_file_list(self):
+        """ One file, or all WAV files in the directory sorted by name. """
+        path = pathlib.Path(self.replay_path)
+        if path.is_dir():
+            file_list = [
+                file_path
+                for file_path in path.rglob("*")
+                if file_path.suffix.lower() == ".wav"
+            ]
+            return sorted(file_list)
+        if path.is_file():
+            return [path]
+        return []
+
+    def get_wave_file_info(self):
+        """ Returns (sampling_freq_hz, channels) from the first file. """
+        for file_path in self.get_file_list():
+            try:
+                with wave.open(str(file_path), "rb") as wave_file:
+                    return wave_file.getframerate(), wave_file.getnchannels()
+            except Exception as e:
+                self.logger.debug("Replay: Failed to open: " + str(e))
+        return 0, 1
+
+    def is_capture_active(self):
+        """ """
+        return self.capture_active
+
+    async def initiate_capture(self, card_index, sampling_freq, buffer_size):
+        """ """
+        self.main_loop = asyncio.get_running_loop()
+        self.card_index = card_index
+        self.sampling_freq = sampling_freq
+        self.buffer_size = buffer_size
+
+    async def start_capture_in_executor(self):
+        """ Use executor for IO-blocking function. """
+        if self.is_capture_active():
+            self.logger.debug("ERROR: REPLAY already running: ")
+            return
+        #
+        await self.main_loop.run_in_executor(self.executor, self.start_capture)
+
+    async def stop_capture(self):
+        """ """
+        self.capture_active = False
+
+    def create_bridge(self):
+        """ One event loop wakeup for all blocks ready in the replay thread. """
+        self.bridge = wurb_rec.ThreadToLoopBridge(
+            self.main_loop, max_batch_latency_s=self.max_batch_latency_s
+        )
+        if self.data_queue:
+            self.bridge.add_queue_channel(
+                "data_queue", self.data_queue, queue_policy=self.queue_policy
+            )
+        if self.direct_target:
+            self.bridge.add_target_channel("direct_target", self.direct_target)
+
+    def get_dropped_blocks(self):
+        """ Blocks dropped because the data queue was full. """
+        if self.bridge:
+            return self.bridge.dropped_counter
+        return 0
+
+    def get_thread_cpu_s(self):
+        """ CPU time used by the replay thread. """
+        return self.thread_cpu_s - self.thread_cpu_start_s
+
+    def get_gap_stats(self):
+        """ No gaps for replayed files. """
+        return {}
+
+    def get_replayed_s(self):
+        """ Audio seconds delivered. """
+        if not self.sampling_freq:
+            return 0.0
+        return self.replayed_frames / self.sampling_freq
+
+    def wait_for_queue(self):
+        """ Used in as-fast-as-possible mode, keeps the data queue from
+        being filled up. Called from the replay thread. """
+        if (not self.data_queue) or (self.data_queue.maxsize <= 0):
+            return
+        while self.capture_active and (
+            self.data_queue.qsize() >= (self.data_queue.maxsize // 2)
+        ):
+            self.bridge.flush()
+            time.sleep(0.005)
+
+    def read_periods(self):
+        """ Generator, yields int16 data from the files, period by period.
+        Subclasses may override this to replay other sources. """
+        for file_path in self.get_file_list():
+            if not self.capture_active:
+                break
+            with wave.open(str(file_path), "rb") as wave_file:
+                if (
+                    (wave_file.getframerate() != self.sampling_freq)
+                    or (wave_file.getnchannels() != self.channels)
+                    or (wave_file.getsampwidth() != 2)
+                ):
+                    self.skipped_files += 1
+                    message = "Replay: Skipped, other format: " + str(file_path.name)
+                    self.logger.info(message)
+                    continue
+                self.replayed_files += 1
+                while self.capture_active:
+                    data = wave_file.readframes(self.period_size)
+                    if len(data) == 0:
+                        break
+                    # A view, no copy.
+                    yield numpy.frombuffer(data, dtype=numpy.int16)
+
+    def start_capture(self):
+        """ """
+        self.logger.debug("REPLAY STARTED.")
+        self.capture_active = True
+        try:
+            self.overrun_counter = 0
+            self.replayed_frames = 0
+            self.replayed_files = 0
+            self.skipped_files = 0
+            self.thread_cpu_start_s = time.thread_time()
+            self.thread_cpu_s = self.thread_cpu_start_s
+            self.capture_clock = wurb_rec.CaptureClock(self.sampling_freq)
+            ring_buffer = wurb_rec.AudioRingBuffer(
+                self.buffer_size, self.period_size, channels=self.channels
+            )
+            buffer_pool = wurb_rec.AudioBufferPool(
+                self.buffer_size, channels=self.channels
+            )
+            self.create_bridge()
+            real_time = self.replay_mode != "as-fast-as-possible"
+            start_time_s = time.time()
+            for data_int16 in self.read_periods():
+                # Copied once into the ring buffer.
+                ring_buffer.write(data_int16)
+
+                while ring_buffer.has_block():
+                    sample_index = ring_buffer.frames_read
+                    if real_time:
+                        # Same pace as a microphone.
+                        block_end_s = (
+                            start_time_s
+                            + (sample_index + self.buffer_size) / self.sampling_freq
+                        )
+                        time.sleep(max(0.0, block_end_s - time.time()))
+                    else:
+                        self.wait_for_queue()
+                    block = buffer_pool.get_block(ring_buffer.read_block())
+                    self.replayed_frames += self.buffer_size
+
+                    # Use data queue.
+                    if self.data_queue:
+                        audio_block = wurb_rec.AudioBlock(
+                            block.data,
+                            block.retain(),
+                            sample_index,
+                            self.capture_clock.get_time(sample_index),
+                            time.time(),
+                        )
+                        try:
+                            self.bridge.post("data_queue", audio_block)
+                        except Exception as e:
+                            block.release()
+                            # Logging error.
+                            message = "Failed to put data on queue: " + str(e)
+                            self.logger.debug(message)
+
+                    # Use data buffer. Only in real time.
+                    if self.direct_target and real_time:
+                        try:
+                            if self.direct_target.is_active():
+                                self.bridge.post("direct_target", block.retain())
+                        except Exception as e:
+                            # Logging error.
+                            message = "Failed to add data to direct_target: " + str(e)
+                            self.logger.debug(message)
+
+                    # Release the reference owned by the replay loop.
+                    block.release()
+
+                self.bridge.poll()
+                self.thread_cpu_s = time.thread_time()
+        #
+        except Exception as e:
+            self.logger.debug("EXCEPTION REPLAY: " + str(e))
+        finally:
+            self.capture_active = False
+            self.thread_cpu_s = time.thread_time()
+            if self.bridge:
+                self.bridge.flush()
+            self.logger.debug("REPLAY ENDED.")
+
+
+# === MAIN - for test ===
+async def main(replay_path):
+    """ Replays as fast as possible, without processing. """
+    data_queue = asyncio.Queue(maxsize=100)
+    replay = WavFileReplay(data_queue=data_queue, replay_path=replay_path)
+    replay.replay_mode = "as-fast-as-possible"
+    sampling_freq_hz, channels = replay.get_wave_file_info()
+    replay.channels = channels
+    await replay.initiate_capture(None, sampling_freq_hz, sampling_freq_hz // 2)
+
+    async def consumer():
+        while True:
+            item = await data_queue.get()
+            item.release()
+
+    consumer_task = asyncio.create_task(consumer())
+    cpu_start_s = time.process_time()
+    await replay.start_capture_in_executor()
+    await asyncio.sleep(0.1)
+    consumer_task.cancel()
+    cpu_s = time.process_time() - cpu_start_s
+    print("Files: ", replay.replayed_files, "  Skipped: ", replay.skipped_files)
+    print("Audio s: ", round(replay.get_replayed_s(), 1), "  CPU s: ", round(cpu_s, 3))
+    if cpu_s > 0.0:
+        print("Audio s per CPU s: ", round(replay.get_replayed_s() / cpu_s, 1))
+
+
+if __name__ == "__main__":
+    """ """
+    import sys
+
+    asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else "."), debug=False)
@@ -0,0 +1,422 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import asyncio
+import time
+import numpy
+import scipy.signal
+
+# CloudedBats.
+import wurb_rec
+
+
+class SyntheticScenes:
+    """Named scenes for the synthetic sound source. Each scene contains
+    background noise and a list of sound sources. Sources are active in
+    trains, train_s long, with pause_s between. Within a train, sounds
+    are repeated with interval_s, with a random jitter. Levels are peak
+    levels for sounds and RMS levels for noise."""
+
+    def __init__(self):
+        """ """
+        self.default_scene_name = "mixed"
+        pipistrelle = {
+            "type": "fm",
+            "start_hz": 75000,
+            "end_hz": 45000,
+            "duration_s": 0.005,
+            "interval_s": 0.08,
+            "train_s": 3.0,
+            "pause_s": 7.0,
+            "dbfs": -25.0,
+        }
+        myotis = {
+            "type": "fm",
+            "start_hz": 90000,
+            "end_hz": 30000,
+            "duration_s": 0.003,
+            "interval_s": 0.07,
+            "train_s": 2.0,
+            "pause_s": 11.0,
+            "dbfs": -35.0,
+        }
+        horseshoe = {
+            "type": "cf-fm",
+            "cf_hz": 83000,
+            "end_hz": 68000,
+            "duration_s": 0.04,
+            "fm_duration_s": 0.003,
+            "interval_s": 0.1,
+            "train_s": 2.0,
+            "pause_s": 13.0,
+            "dbfs": -30.0,
+        }
+        clicks = {
+            "type": "click",
+            "duration_s": 0.0002,
+            "interval_s": 0.7,
+            "train_s": 60.0,
+            "pause_s": 0.0,
+            "dbfs": -30.0,
+        }
+        katydid = {
+            "type": "insect",
+            "centre_hz": 35000,
+            "bandwidth_hz": 10000,
+            "duration_s": 0.02,
+            "interval_s": 0.03,
+            "train_s": 1.0,
+            "pause_s": 4.0,
+            "dbfs": -40.0,
+        }
+        self.scenes = {
+            "mixed": {
+                "noise_colour": "pink",
+                "noise_dbfs": -60.0,
+                "sources": [pipistrelle, myotis, horseshoe, clicks, katydid],
+            },
+            "fm": {
+                "noise_colour": "pink",
+                "noise_dbfs": -60.0,
+                "sources": [pipistrelle, myotis],
+            },
+            "cf-fm": {
+                "noise_colour": "pink",
+                "noise_dbfs": -60.0,
+                "sources": [horseshoe],
+            },
+            "insects": {
+                "noise_colour": "pink",
+                "noise_dbfs": -55.0,
+                "sources": [clicks, katydid],
+            },
+            "noise": {
+                "noise_colour": "brown",
+                "noise_dbfs": -50.0,
+                "sources": [],
+            },
+        }
+
+    def get_scene_names(self):
+        """ """
+        return list(self.scenes.keys())
+
+    def get_scene(self, scene_name):
+        """Returns a copy of the scene. Unknown names gives the default."""
+        if scene_name not in self.scenes:
+            scene_name = self.default_scene_name
+        scene = self.scenes[scene_name].copy()
+        scene["sources"] = [source.copy() for source in scene["sources"]]
+        scene["name"] = scene_name
+        return scene
+
+
+class BatCallGenerator:
+    """Generates synthetic ultrasound scenes, block by block.
+    The result only depends on the scene, the sampling frequency and
+    the seed, not on the block sizes used. Sounds above 0.45 times the
+    sampling frequency are not generated. All generated sounds are
+    stored in event_list, to be used as ground truth.
+    """
+
+    def __init__(self, sampling_freq_hz, seed=0, scene=None):
+        """ """
+        self.sampling_freq_hz = float(sampling_freq_hz)
+        self.seed = seed
+        self.scene = scene or SyntheticScenes().get_scene("mixed")
+        # One random sequence for each source, independent of block sizes.
+        self.noise_random = numpy.random.default_rng([seed, 1])
+        self.random_list = []
+        self.frame_index = 0
+        self.event_list = []
+        self.pending_sounds = []  # List of (start frame, float signal).
+        self.next_frame_list = []
+        self.train_end_frame_list = []
+        for index, source in enumerate(self.scene["sources"]):
+            self.random_list.append(numpy.random.default_rng([seed, 10 + index]))
+            # Sources start at random times, within the first pause.
+            start_frame = self.to_frames(
+                self.random_list[index].uniform(0.0, source["pause_s"])
+            )
+            self.next_frame_list.append(start_frame)
+            self.train_end_frame_list.append(
+                start_frame + self.to_frames(source["train_s"])
+            )
+        self.init_noise()
+
+    def to_frames(self, time_s):
+        """ """
+        return int(round(time_s * self.sampling_freq_hz))
+
+    def init_noise(self):
+        """Coloured noise is white noise through a filter with state."""
+        colour = self.scene.get("noise_colour", "white")
+        if colour == "pink":
+            # Paul Kellet's approximation, -3 dB/octave.
+            self.noise_b = [0.049922035, -0.095993537, 0.050612699, -0.004408786]
+            self.noise_a = [1.0, -2.494956002, 2.017265875, -0.522189400]
+        elif colour == "brown":
+            # Leaky integrator, -6 dB/octave.
+            self.noise_b = [1.0]
+            self.noise_a = [1.0, -0.995]
+        else:
+            self.noise_b = [1.0]
+            self.noise_a = [1.0]
+        self.noise_zi = numpy.zeros(max(len(self.noise_a), len(self.noise_b)) - 1)
+        # Gain for the requested RMS level, from a separate seeded sequence.
+        calibration_random = numpy.random.default_rng([self.seed, 2])
+        calibration = scipy.signal.lfilter(
+            self.noise_b,
+            self.noise_a,
+            calibration_random.standard_normal(int(self.sampling_freq_hz)),
+        )
+        calibration_rms = numpy.sqrt(numpy.mean(calibration[1000:] ** 2))
+        noise_rms = 10 ** (self.scene.get("noise_dbfs", -60.0) / 20) * 32767
+        self.noise_gain = noise_rms / calibration_rms if calibration_rms > 0 else 0.0
+
+    def create_tonal(self, freq_hz_array, dbfs):
+        """Signal from instantaneous frequency, with a Hann envelope."""
+        phase = 2 * numpy.pi * numpy.cumsum(freq_hz_array) / self.sampling_freq_hz
+        envelope = numpy.hanning(len(freq_hz_array))
+        return 10 ** (dbfs / 20) * 32767 * envelope * numpy.sin(phase)
+
+    def create_sound(self, source, random):
+        """Returns (float signal, peak frequency), signal is None if the
+        sound can't be represented at this sampling frequency."""
+        length = max(2, self.to_frames(source["duration_s"]))
+        max_freq_hz = 0.45 * self.sampling_freq_hz
+        sound_type = source["type"]
+        if sound_type == "fm":
+            # Exponential sweep, as for most FM bats.
+            if max(source["start_hz"], source["end_hz"]) > max_freq_hz:
+                return None, None
+            ratio = source["end_hz"] / source["start_hz"]
+            freq_hz_array = source["start_hz"] * ratio ** numpy.linspace(0, 1, length)
+            signal = self.create_tonal(freq_hz_array, source["dbfs"])
+            return signal, source["end_hz"]
+        if sound_type == "cf-fm":
+            if source["cf_hz"] > max_freq_hz:
+                return None, None
+            fm_length = self.to_frames(source["fm_duration_s"])
+            cf_length = max(1, length - fm_length)
+            freq_hz_array = numpy.concatenate(
+                [
+                    numpy.full(cf_length, float(source["cf_hz"])),
+                    numpy.linspace(source["cf_hz"], source["end_hz"], fm_length),
+                ]
+            )
+            signal = self.create_tonal(freq_hz_array, source["dbfs"])
+            return signal, source["cf_hz"]
+        if sound_type == "click":
+            # Broadband, white noise with fast exponential decay.
+            decay = numpy.exp(-numpy.arange(length) / (length / 5.0))
+            noise = random.uniform(-1.0, 1.0, length)
+            return 10 ** (source["dbfs"] / 20) * 32767 * decay * noise, None
+        if sound_type == "insect":
+            # Band limited noise, low pass filtered noise moved to the centre.
+            if source["centre_hz"] + source["bandwidth_hz"] / 2 > max_freq_hz:
+                return None, None
+            smooth_length = max(
+                1, int(self.sampling_freq_hz / source["bandwidth_hz"])
+            )
+            noise = numpy.convolve(
+                random.standard_normal(length + smooth_length),
+                numpy.ones(smooth_length) / numpy.sqrt(smooth_length),
+                mode="valid",
+            )[:length]
+            carrier = numpy.cos(
+                2 * numpy.pi * source["centre_hz"] * numpy.arange(length)
+                / self.sampling_freq_hz
+            )
+            envelope = numpy.hanning(length)
+            signal = noise * carrier * envelope
+            peak = numpy.max(numpy.abs(signal))
+            if peak > 0.0:
+                signal = signal / peak
+            return 10 ** (source["dbfs"] / 20) * 32767 * signal, source["centre_hz"]
+        return None, None
+
+    def schedule_sounds(self, end_frame):
+        """Creates all sounds starting before end_frame."""
+        for index, source in enumerate(self.scene["sources"]):
+            while self.next_frame_list[index] < end_frame:
+                start_frame = self.next_frame_list[index]
+                random = self.random_list[index]
+                signal, peak_freq_hz = self.create_sound(source, random)
+                if signal is not None:
+                    self.pending_sounds.append((start_frame, signal))
+                    self.event_list.append(
+                        {
+                            "frame_index": start_frame,
+                            "time_s": start_frame / self.sampling_freq_hz,
+                            "type": source["type"],
+                            "peak_freq_hz": peak_freq_hz,
+                            "dbfs": source["dbfs"],
+                        }
+                    )
+                # Next sound, 10% jitter of the interval.
+                jitter = random.uniform(-0.1, 0.1) * source["interval_s"]
+                next_frame = start_frame + self.to_frames(
+                    source["interval_s"] + jitter
+                )
+                if next_frame >= self.train_end_frame_list[index]:
+                    next_frame = self.train_end_frame_list[index] + self.to_frames(
+                        source["pause_s"]
+                    )
+                    self.train_end_frame_list[index] = next_frame + self.to_frames(
+                        source["train_s"]
+                    )
+                self.next_frame_list[index] = max(next_frame, start_frame + 1)
+
+    def generate(self, number_of_frames):
+        """Returns the next frames as int16."""
+        start_frame = self.frame_index
+        end_frame = start_frame + number_of_frames
+        # Background noise.
+        white = self.noise_random.standard_normal(number_of_frames)
+        block, self.noise_zi = scipy.signal.lfilter(
+            self.noise_b, self.noise_a, white, zi=self.noise_zi
+        )
+        block *= self.noise_gain
+        # Sounds, may continue into the next block.
+        self.schedule_sounds(end_frame)
+        remaining_sounds = []
+        for sound_start_frame, signal in self.pending_sounds:
+            first = max(start_frame, sound_start_frame)
+            last = min(end_frame, sound_start_frame + len(signal))
+            if last > first:
+                block[first - start_frame : last - start_frame] += signal[
+                    first - sound_start_frame : last - sound_start_frame
+                ]
+            if sound_start_frame + len(signal) > end_frame:
+                remaining_sounds.append((sound_start_frame, signal))
+        self.pending_sounds = remaining_sounds
+        self.frame_index = end_frame
+        return numpy.clip(numpy.round(block), -32768, 32767).astype(numpy.int16)
+
+
+class SyntheticSoundSource(wurb_rec.WavFileReplay):
+    """Sound source for synthetic scenes. Plugs into the recorder in the
+    same way as file replay, in real time or as fast as possible.
+    A duration of zero means that the source runs until stopped."""
+
+    DEVICE_NAME = "Synthetic scene"
+
+    def __init__(
+        self, data_queue=None, direct_target=None, scene_name="mixed", seed=0
+    ):
+        """ """
+        super().__init__(data_queue=data_queue, direct_target=direct_target)
+        self.device_name = self.DEVICE_NAME
+        self.scene_name = scene_name
+        self.seed = seed
+        self.duration_s = 0.0
+        self.generator = None
+
+    def get_event_list(self):
+        """Generated sounds, ground truth for benchmarks."""
+        if self.generator:
+            return self.generator.event_list
+        return []
+
+    def read_periods(self):
+        """ Generator, yields synthetic int16 data period by period. """
+        scene = SyntheticScenes().get_scene(self.scene_name)
+        self.generator = BatCallGenerator(
+            self.sampling_freq, seed=self.seed, scene=scene
+        )
+        max_frames = int(self.duration_s * self.sampling_freq)
+        while self.capture_active:
+            number_of_frames = self.period_size
+            if max_frames > 0:
+                number_of_frames = min(
+                    number_of_frames, max_frames - self.generator.frame_index
+                )
+                if number_of_frames <= 0:
+                    break
+            yield self.generator.generate(number_of_frames)
+
+
+# === MAIN - for test ===
+class TestSettings:
+    """ Settings used by SoundDetectionSimple in this test. """
+
+    def get_setting(self, key):
+        return {
+            "detection_limit_khz": 15.0,
+            "detection_sensitivity_dbfs": -50.0,
+            "rec_mode": "mode-auto",
+        }.get(key)
+
+
+class TestManager:
+    """ Minimal manager and recorder for SoundDetectionSimple. """
+
+    def __init__(self, sampling_freq_hz):
+        self.wurb_settings = TestSettings()
+        self.wurb_logging = None
+        self.manual_trigger_activated = False
+        self.wurb_recorder = self
+        self.sampling_freq_hz = sampling_freq_hz
+
+
+async def main():
+    """ """
+    sampling_freq_hz = 384000
+    block_size = sampling_freq_hz // 2
+    # Same seed, other block sizes, same result.
+    scene = SyntheticScenes().get_scene("mixed")
+    generator_1 = BatCallGenerator(sampling_freq_hz, seed=1, scene=scene)
+    generator_2 = BatCallGenerator(sampling_freq_hz, seed=1, scene=scene)
+    data_1 = numpy.concatenate([generator_1.generate(4096) for _ in range(100)])
+    data_2 = numpy.concatenate([generator_2.generate(1000) for _ in range(410)])
+    print("Deterministic: ", numpy.array_equal(data_1, data_2[: len(data_1)]))
+    # Detection rate and CPU for SoundDetectionSimple.
+    data_queue = asyncio.Queue(maxsize=100)
+    source = SyntheticSoundSource(data_queue=data_queue, scene_name="mixed", seed=1)
+    source.replay_mode = "as-fast-as-possible"
+    source.duration_s = 60.0
+    await source.initiate_capture(None, sampling_freq_hz, block_size)
+    test_manager = TestManager(sampling_freq_hz)
+    detector = wurb_rec.SoundDetection(test_manager).get_detection()
+    detected_blocks = []
+    detection_cpu_s = [0.0]
+
+    async def consumer():
+        while True:
+            item = await data_queue.get()
+            start_cpu_s = time.thread_time()
+            detected, _freq, _dbfs = detector.check_for_sound(
+                (item.adc_time, item.data)
+            )
+            detection_cpu_s[0] += time.thread_time() - start_cpu_s
+            if detected:
+                detected_blocks.append(item.sample_index // block_size)
+            item.release()
+
+    consumer_task = asyncio.create_task(consumer())
+    await source.start_capture_in_executor()
+    while not data_queue.empty():
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.1)
+    consumer_task.cancel()
+    # Blocks with bat calls.
+    bat_blocks = set()
+    for event in source.get_event_list():
+        if event["type"] in ["fm", "cf-fm"]:
+            bat_blocks.add(event["frame_index"] // block_size)
+    detected = set(detected_blocks)
+    print("Events: ", len(source.get_event_list()))
+    print("Blocks with bat calls: ", len(bat_blocks), "  Detected: ", len(detected))
+    print("Bat blocks detected: ", len(bat_blocks & detected))
+    print("Detected without bat calls: ", len(detected - bat_blocks))
+    audio_s = source.get_replayed_s()
+    print("Detection audio s per CPU s: ", round(audio_s / detection_cpu_s[0], 1))
+
+
+if __name__ == "__main__":
+    """ """
+    asyncio.run(main(), debug=False)
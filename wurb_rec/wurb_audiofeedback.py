@@ -31,6 +31,8 @@ class WurbPitchShifting(object):
         self.audio_task = None
         # self.audio_callback_active = False
         self.alsa_playback = None
+        # Feedback jobs are run in order by one thread.
+        self.dsp_executor = wurb_manager.executors.get_executor("feedback-dsp")
         #
         self.logger = logging.getLogger("CloudedBats-WURB")
         self.clear()
@@ -164,6 +166,9 @@ class WurbPitchShifting(object):
             card_index = cards.get_playback_card_index_by_name(part_of_name)
             if card_index != None:
                 self.alsa_playback = wurb_rec.AlsaSoundPlayback()
+                self.alsa_playback.executor = self.wurb_manager.executors.get_executor(
+                    "playback"
+                )
                 buffer_size = 1000
                 await self.alsa_playback.start_playback(
                     card_index=card_index,
@@ -179,10 +184,35 @@ class WurbPitchShifting(object):
             await self.alsa_playback.stop_playback()
             self.alsa_playback = None
 
-    def add_data(self, buffer_int16):
-        """ """
+    def add_data(self, block):
+        """ Called from the capture loop with a shared block. """
+        if self.is_active():
+            self.asyncio_loop.run_in_executor(self.dsp_executor, self.add_block, block)
+        else:
+            block.release()
+
+    def add_data_list(self, blocks):
+        """ Called from the capture loop. One executor job for all blocks. """
         if self.is_active():
-            self.asyncio_loop.run_in_executor(None, self.add_buffer, buffer_int16)
+            self.asyncio_loop.run_in_executor(
+                self.dsp_executor, self.add_block_list, blocks
+            )
+        else:
+            for block in blocks:
+                block.release()
+
+    def add_block_list(self, blocks):
+        """ """
+        for block in blocks:
+            self.add_block(block)
+
+    def add_block(self, block):
+        """ The shared block must be released when the data is used. """
+        try:
+            # Only the first channel is used for multi-channel microphones.
+            self.add_buffer(block.get_channel_data(0))
+        finally:
+            block.release()
 
     def add_buffer(self, buffer_int16):
         """ """
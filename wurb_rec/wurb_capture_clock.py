@@ -0,0 +1,175 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import time
+from collections import deque
+
+
+class CaptureClock:
+    """Capture clock based on sample counts.
+    The time for a frame is calculated from the number of frames since
+    start. Observed times, from ALSA hardware timestamps or the system
+    clock, are used to correct the offset continuously with a smoothed
+    estimator. The drift is the slope of a linear regression of observed
+    time against sample time, over a sliding window. Lost frames after
+    overruns are counted as gaps, calculated from the observed time for
+    the next delivered frames.
+    """
+
+    def __init__(self, sampling_freq_hz):
+        """ """
+        self.sampling_freq_hz = float(sampling_freq_hz)
+        # Config.
+        self.offset_smoothing = 0.01  # Part of the error used for each update.
+        self.drift_window_s = 300.0  # Unit: sec. Observations used for drift.
+        self.drift_point_interval_s = 1.0  # Unit: sec.
+        self.min_drift_span_s = 10.0  # Unit: sec. Before drift is estimated.
+        self.max_step_s = 1.0  # Larger errors are handled as clock steps.
+        self.min_gap_s = 0.002  # Smaller differences are jitter, not gaps.
+        self.start()
+
+    def start(self, start_time_s=None):
+        """ """
+        if start_time_s is None:
+            start_time_s = time.time()
+        self.start_time_s = start_time_s
+        self.frame_counter = 0
+        self.offset_s = 0.0
+        self.drift = 0.0  # Unit: sec/sec.
+        self.drift_points = deque()  # Entries: (sample time, observed - sample time).
+        self.next_drift_point_s = 0.0
+        self.overrun_pending = False
+        self.gap_list = []
+        self.gap_frames_total = 0
+        self.step_counter = 0
+
+    def get_time(self, frame_index):
+        """Time for the frame, in seconds since epoch."""
+        elapsed_s = frame_index / self.sampling_freq_hz
+        return self.start_time_s + self.offset_s + elapsed_s * (1.0 + self.drift)
+
+    def add_overrun(self):
+        """Called when the device reports an overrun. The size of the gap
+        is calculated when the next frames are delivered."""
+        self.overrun_pending = True
+
+    def add_gap(self, number_of_frames):
+        """Called when the number of lost frames is known exactly, for
+        example lost USB transfers. Inserted before the next frames."""
+        if number_of_frames <= 0:
+            return
+        self.gap_list.append(
+            {
+                "frame_index": self.frame_counter,
+                "frames": number_of_frames,
+                "time_s": self.get_time(self.frame_counter),
+            }
+        )
+        self.gap_frames_total += number_of_frames
+        self.frame_counter += number_of_frames
+
+    def update(self, number_of_frames, observed_time_s):
+        """Called for each read. The observed time is the time for the
+        last frame in the read. Returns the number of gap frames inserted
+        before the new frames, zero if no gap."""
+        gap_frames = 0
+        expected_time_s = self.get_time(self.frame_counter + number_of_frames)
+        error_s = observed_time_s - expected_time_s
+        if self.overrun_pending:
+            self.overrun_pending = False
+            if error_s > self.min_gap_s:
+                gap_frames = int(round(error_s * self.sampling_freq_hz))
+                self.gap_list.append(
+                    {
+                        "frame_index": self.frame_counter,
+                        "frames": gap_frames,
+                        "time_s": self.get_time(self.frame_counter),
+                    }
+                )
+                self.gap_frames_total += gap_frames
+                self.frame_counter += gap_frames
+                error_s = observed_time_s - self.get_time(
+                    self.frame_counter + number_of_frames
+                )
+        self.frame_counter += number_of_frames
+        # Large errors, for example when the system time is set from GPS.
+        if abs(error_s) > self.max_step_s:
+            self.offset_s += error_s
+            self.step_counter += 1
+            self.drift_points.clear()
+            return gap_frames
+        # Smoothed correction of offset.
+        self.offset_s += self.offset_smoothing * error_s
+        elapsed_s = self.frame_counter / self.sampling_freq_hz
+        if elapsed_s >= self.next_drift_point_s:
+            self.next_drift_point_s = elapsed_s + self.drift_point_interval_s
+            self.add_drift_point(elapsed_s, observed_time_s)
+        return gap_frames
+
+    def add_drift_point(self, elapsed_s, observed_time_s):
+        """The drift is estimated from the observations in the window. The
+        offset is adjusted, the time for the current frame is unchanged."""
+        self.drift_points.append((elapsed_s, observed_time_s - self.start_time_s))
+        while elapsed_s - self.drift_points[0][0] > self.drift_window_s:
+            self.drift_points.popleft()
+        if elapsed_s - self.drift_points[0][0] < self.min_drift_span_s:
+            return
+        # Least squares slope, centered to keep the precision.
+        number_of_points = len(self.drift_points)
+        mean_x = sum(x for x, _ in self.drift_points) / number_of_points
+        mean_y = sum(y for _, y in self.drift_points) / number_of_points
+        sum_xy = 0.0
+        sum_xx = 0.0
+        for x, y in self.drift_points:
+            sum_xy += (x - mean_x) * (y - mean_y)
+            sum_xx += (x - mean_x) ** 2
+        drift = sum_xy / sum_xx - 1.0
+        self.offset_s -= elapsed_s * (drift - self.drift)
+        self.drift = drift
+
+    def get_gap_stats(self):
+        """ """
+        return {
+            "gaps": len(self.gap_list),
+            "gap_frames": self.gap_frames_total,
+            "gap_s": round(self.gap_frames_total / self.sampling_freq_hz, 3),
+            "drift_ppm": round(self.drift * 1000000, 1),
+            "clock_steps": self.step_counter,
+        }
+
+
+# === MAIN - for test ===
+if __name__ == "__main__":
+    """ """
+    # Simulated device running 50 ppm fast, with one lost period, and
+    # up to 1 ms jitter in the observed time.
+    import random
+
+    random.seed(1)
+    sampling_freq_hz = 384000
+    period_size = 4096
+    clock = CaptureClock(sampling_freq_hz)
+    clock.start(start_time_s=1000.0)
+    real_rate = sampling_freq_hz * (1 + 50e-6)
+    device_frames = 0
+    for index in range(20000):
+        device_frames += period_size
+        if index == 10000:
+            # Overrun, one period lost.
+            device_frames += period_size
+            clock.add_overrun()
+        observed_time_s = 1000.0 + device_frames / real_rate
+        clock.update(period_size, observed_time_s + random.uniform(0.0, 0.001))
+    print("Gap stats: ", clock.get_gap_stats())
+    error_ms = (clock.get_time(device_frames) - observed_time_s) * 1000
+    print("Time error ms: ", round(error_ms, 3))
+    simulated_drift_ppm = (sampling_freq_hz / real_rate - 1.0) * 1000000
+    drift_ppm = clock.get_gap_stats()["drift_ppm"]
+    print("Simulated drift ppm: ", round(simulated_drift_ppm, 1))
+    assert abs(drift_ppm - simulated_drift_ppm) < 3.0
+    # Within the jitter.
+    gap_frames = clock.get_gap_stats()["gap_frames"]
+    assert abs(gap_frames - period_size) < 0.001 * sampling_freq_hz
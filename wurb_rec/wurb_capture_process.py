@@ -0,0 +1,531 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import asyncio
+import logging
+import importlib
+import multiprocessing
+import multiprocessing.shared_memory
+import numpy
+
+# CloudedBats.
+import wurb_rec
+
+
+class SharedMemoryBlockRing:
+    """Ring of sound blocks in shared memory, one writer and one reader.
+    The writer never waits. Each block is written to the next slot and
+    then the write counter in the header is increased. The reader keeps
+    its own read counter. If the reader is more than the number of slots
+    behind, the oldest blocks are lost and counted by the reader.
+    Header, int64: write counter and capture counters.
+    Header, float64: capture stats.
+    Per slot: sample index (int64), ADC time, detector time and gap before
+    the block (float64).
+    """
+
+    # Index in the int64 header.
+    WRITE_COUNTER = 0
+    OVERRUNS = 1
+    DROPPED_BLOCKS = 2
+    GAPS = 3
+    GAP_FRAMES = 4
+    CLOCK_STEPS = 5
+    # Index in the float64 header.
+    THREAD_CPU_S = 0
+    DRIFT_PPM = 1
+
+    def __init__(self, block_size, channels=1, number_of_slots=16, name=None):
+        """Creates the shared memory if name is None, otherwise attaches."""
+        self.block_size = int(block_size)
+        self.channels = int(channels)
+        self.number_of_slots = int(number_of_slots)
+        header_bytes = 8 * 8 + 8 * 8
+        meta_bytes = self.number_of_slots * 8 * 4
+        data_bytes = self.number_of_slots * self.block_size * self.channels * 2
+        if name is None:
+            self.shared_memory = multiprocessing.shared_memory.SharedMemory(
+                create=True, size=header_bytes + meta_bytes + data_bytes
+            )
+            self.is_owner = True
+        else:
+            self.shared_memory = multiprocessing.shared_memory.SharedMemory(name=name)
+            self.is_owner = False
+        buffer = self.shared_memory.buf
+        offset = 0
+        self.header_int = numpy.ndarray((8,), numpy.int64, buffer, offset)
+        offset += 8 * 8
+        self.header_float = numpy.ndarray((8,), numpy.float64, buffer, offset)
+        offset += 8 * 8
+        slots = self.number_of_slots
+        self.sample_index_array = numpy.ndarray((slots,), numpy.int64, buffer, offset)
+        offset += slots * 8
+        self.adc_time_array = numpy.ndarray((slots,), numpy.float64, buffer, offset)
+        offset += slots * 8
+        self.detector_time_array = numpy.ndarray(
+            (slots,), numpy.float64, buffer, offset
+        )
+        offset += slots * 8
+        self.gap_before_s_array = numpy.ndarray(
+            (slots,), numpy.float64, buffer, offset
+        )
+        offset += slots * 8
+        self.data_array = numpy.ndarray(
+            (slots, self.block_size, self.channels), numpy.int16, buffer, offset
+        )
+        if self.is_owner:
+            self.header_int[:] = 0
+            self.header_float[:] = 0.0
+        # Reader side.
+        self.read_counter = 0
+        self.lost_blocks = 0
+
+    def get_name(self):
+        """ """
+        return self.shared_memory.name
+
+    def write_block(
+        self, data_int16, sample_index, adc_time, detector_time, gap_before_s=0.0
+    ):
+        """Writer side. Returns the new write counter."""
+        write_counter = int(self.header_int[self.WRITE_COUNTER])
+        slot = write_counter % self.number_of_slots
+        self.data_array[slot] = data_int16.reshape(self.block_size, self.channels)
+        self.sample_index_array[slot] = sample_index
+        self.adc_time_array[slot] = adc_time
+        self.detector_time_array[slot] = detector_time
+        self.gap_before_s_array[slot] = gap_before_s
+        # Published last. The reader only reads blocks it is notified about.
+        self.header_int[self.WRITE_COUNTER] = write_counter + 1
+        return write_counter + 1
+
+    def read_blocks(self, available_counter):
+        """Reader side. Yields (data view, sample index, ADC time, detector
+        time, gap before) for blocks up to available_counter. The view is
+        only valid until the next block is yielded."""
+        if available_counter - self.read_counter >= self.number_of_slots:
+            # Overwritten before they were read. One slot of margin, the
+            # slot for the next block may be written at the same time.
+            first_counter = available_counter - self.number_of_slots + 1
+            self.lost_blocks += first_counter - self.read_counter
+            self.read_counter = first_counter
+        while self.read_counter < available_counter:
+            slot = self.read_counter % self.number_of_slots
+            data = self.data_array[slot]
+            if self.channels == 1:
+                data = data[:, 0]
+            yield (
+                data,
+                int(self.sample_index_array[slot]),
+                float(self.adc_time_array[slot]),
+                float(self.detector_time_array[slot]),
+                float(self.gap_before_s_array[slot]),
+            )
+            self.read_counter += 1
+
+    def is_overwritten(self, counter):
+        """Reader side. True if the block was overwritten while read. The
+        slot is written before the write counter is increased, the block
+        may be partly overwritten when the counter is number_of_slots
+        ahead."""
+        write_counter = int(self.header_int[self.WRITE_COUNTER])
+        return (write_counter - counter) >= self.number_of_slots
+
+    def close(self):
+        """ """
+        self.header_int = None
+        self.header_float = None
+        self.sample_index_array = None
+        self.adc_time_array = None
+        self.detector_time_array = None
+        self.gap_before_s_array = None
+        self.data_array = None
+        self.shared_memory.close()
+        if self.is_owner:
+            self.shared_memory.unlink()
+
+
+def create_capture(config, data_queue):
+    """Default capture factory, used in the capture process."""
+    if config["device_type"] == "m500":
+        return wurb_rec.PetterssonM500(data_queue=data_queue)
+    capture = wurb_rec.AlsaSoundCapture(data_queue=data_queue)
+    capture.channels = config["channels"]
+    return capture
+
+
+async def capture_process_main_async(config, shared_memory_name, notify_conn, stop_event):
+    """Runs in the capture process. Blocks from the capture object are
+    written to the shared memory ring and the main process is notified."""
+    ring = SharedMemoryBlockRing(
+        config["buffer_size"],
+        channels=config["channels"],
+        number_of_slots=config["number_of_slots"],
+        name=shared_memory_name,
+    )
+    data_queue = asyncio.Queue(maxsize=config["number_of_slots"])
+    module_name, function_name = config["capture_factory"].split(":")
+    capture_factory = getattr(importlib.import_module(module_name), function_name)
+    capture = capture_factory(config, data_queue)
+    for key, value in config["capture_attributes"].items():
+        if hasattr(capture, key):
+            setattr(capture, key, value)
+    await capture.initiate_capture(
+        card_index=config["card_index"],
+        sampling_freq=config["sampling_freq"],
+        buffer_size=config["buffer_size"],
+    )
+    capture_task = asyncio.create_task(capture.start_capture_in_executor())
+    try:
+        while not stop_event.is_set():
+            if capture_task.done() and data_queue.empty():
+                break
+            try:
+                item = await asyncio.wait_for(data_queue.get(), timeout=0.5)
+            except asyncio.TimeoutError:
+                continue
+            try:
+                write_counter = ring.write_block(
+                    item.data,
+                    item.sample_index,
+                    item.adc_time,
+                    item.detector_time,
+                    item.gap_before_s,
+                )
+            finally:
+                item.release()
+            # Stats for the main process.
+            ring.header_int[ring.OVERRUNS] = capture.overrun_counter
+            ring.header_int[ring.DROPPED_BLOCKS] = capture.get_dropped_blocks()
+            gap_stats = capture.get_gap_stats()
+            ring.header_int[ring.GAPS] = gap_stats.get("gaps", 0)
+            ring.header_int[ring.GAP_FRAMES] = gap_stats.get("gap_frames", 0)
+            ring.header_int[ring.CLOCK_STEPS] = gap_stats.get("clock_steps", 0)
+            ring.header_float[ring.DRIFT_PPM] = gap_stats.get("drift_ppm", 0.0)
+            ring.header_float[ring.THREAD_CPU_S] = capture.get_thread_cpu_s()
+            # Notification only, the data is in shared memory.
+            notify_conn.send_bytes(write_counter.to_bytes(8, "little"))
+    finally:
+        await capture.stop_capture()
+        try:
+            await asyncio.wait_for(capture_task, timeout=5.0)
+        except Exception:
+            pass
+        ring.close()
+        notify_conn.close()
+
+
+def capture_process_main(config, shared_memory_name, notify_conn, stop_event):
+    """Entry point for the capture process."""
+    asyncio.run(
+        capture_process_main_async(config, shared_memory_name, notify_conn, stop_event)
+    )
+
+
+class ProcessSoundCapture:
+    """Runs AlsaSoundCapture or PetterssonM500 in a separate process, to
+    avoid that the capture thread has to compete for the GIL with
+    detection, web server and file writing. Blocks are transferred
+    through a ring in shared memory, the event loop only receives a short
+    notification for each block. The interface is the same as for the
+    capture objects running in threads.
+    """
+
+    def __init__(self, data_queue=None, direct_target=None, device_type="alsa"):
+        """ """
+        self.data_queue = data_queue
+        self.direct_target = direct_target
+        self.queue_policy = None  # Overflow handling for data_queue.
+        self.device_type = device_type
+        self.card_index = None
+        self.sampling_freq = None
+        self.buffer_size = None
+        # Internal.
+        self.logger = logging.getLogger("CloudedBats-WURB")
+        self.capture_active = False
+        self.ring = None
+        self.process = None
+        self.stop_event = None
+        self.notify_conn = None
+        self.process_done = None
+        self.overrun_counter = 0
+        self.dropped_counter = 0
+        self.ring_dropped_counter = 0
+        self.thread_cpu_s = 0.0
+        self.gap_stats = {}
+        # Config, may be changed by capture profiles.
+        self.max_batch_latency_s = 0.0  # Unit: sec.
+        self.period_size = 4096  # Unit: frames. ALSA.
+        self.usb_transfer_size = 0x20000  # Unit: bytes. M500.
+        self.usb_stream_buffers = 0  # M500.
+        self.channels = 1
+        self.number_of_slots = 16
+        self.capture_factory = "wurb_rec.wurb_capture_process:create_capture"
+
+    def is_capture_active(self):
+        """ """
+        return self.capture_active
+
+    async def initiate_capture(self, card_index, sampling_freq, buffer_size):
+        """ """
+        self.main_loop = asyncio.get_running_loop()
+        self.card_index = card_index
+        self.sampling_freq = sampling_freq
+        self.buffer_size = buffer_size
+
+    def get_config(self):
+        """ Everything the capture process needs, must be picklable. """
+        return {
+            "device_type": self.device_type,
+            "card_index": self.card_index,
+            "sampling_freq": self.sampling_freq,
+            "buffer_size": self.buffer_size,
+            "channels": self.channels,
+            "number_of_slots": self.number_of_slots,
+            "capture_factory": self.capture_factory,
+            "capture_attributes": {
+                "max_batch_latency_s": self.max_batch_latency_s,
+                "period_size": self.period_size,
+                "usb_transfer_size": self.usb_transfer_size,
+                "usb_stream_buffers": self.usb_stream_buffers,
+            },
+        }
+
+    async def start_capture_in_executor(self):
+        """ Starts the capture process and waits until it is finished. """
+        if self.is_capture_active():
+            self.logger.debug("ERROR: CAPTURE already running: ")
+            return
+        self.capture_active = True
+        self.overrun_counter = 0
+        self.dropped_counter = 0
+        self.ring_dropped_counter = 0
+        self.ring = SharedMemoryBlockRing(
+            self.buffer_size,
+            channels=self.channels,
+            number_of_slots=self.number_of_slots,
+        )
+        self.buffer_pool = wurb_rec.AudioBufferPool(
+            self.buffer_size, channels=self.channels
+        )
+        # Spawn, forking a process with running threads is not safe.
+        context = multiprocessing.get_context("spawn")
+        self.stop_event = context.Event()
+        receive_conn, send_conn = context.Pipe(duplex=False)
+        self.notify_conn = receive_conn
+        self.process = context.Process(
+            target=capture_process_main,
+            args=(self.get_config(), self.ring.get_name(), send_conn, self.stop_event),
+            name="wurb-capture",
+            daemon=True,
+        )
+        self.process_done = self.main_loop.create_future()
+        try:
+            self.process.start()
+            send_conn.close()
+            self.main_loop.add_reader(receive_conn.fileno(), self.on_notification)
+            await self.process_done
+        finally:
+            self.main_loop.remove_reader(receive_conn.fileno())
+            self.stop_event.set()
+            await self.main_loop.run_in_executor(None, self.process.join, 5.0)
+            if self.process.is_alive():
+                self.process.terminate()
+            receive_conn.close()
+            self.ring.close()
+            self.ring = None
+            self.capture_active = False
+
+    async def stop_capture(self):
+        """ """
+        if self.stop_event:
+            self.stop_event.set()
+
+    def on_notification(self):
+        """Called in the event loop when notifications are available."""
+        available_counter = None
+        try:
+            while self.notify_conn.poll():
+                available_counter = int.from_bytes(
+                    self.notify_conn.recv_bytes(), "little"
+                )
+        except (EOFError, OSError):
+            # The capture process is finished.
+            if not self.process_done.done():
+                self.process_done.set_result(True)
+        if available_counter is not None:
+            self.deliver_blocks(available_counter)
+
+    def deliver_blocks(self, available_counter):
+        """Copies blocks from shared memory into pooled blocks."""
+        ring = self.ring
+        self.overrun_counter = int(ring.header_int[ring.OVERRUNS])
+        self.thread_cpu_s = float(ring.header_float[ring.THREAD_CPU_S])
+        self.gap_stats = {
+            "gaps": int(ring.header_int[ring.GAPS]),
+            "gap_frames": int(ring.header_int[ring.GAP_FRAMES]),
+            "gap_s": round(int(ring.header_int[ring.GAP_FRAMES]) / self.sampling_freq, 3),
+            "drift_ppm": float(ring.header_float[ring.DRIFT_PPM]),
+            "clock_steps": int(ring.header_int[ring.CLOCK_STEPS]),
+        }
+        for (
+            data,
+            sample_index,
+            adc_time,
+            detector_time,
+            gap_before_s,
+        ) in ring.read_blocks(available_counter):
+            # One copy, from shared memory into a pooled block.
+            block = self.buffer_pool.get_block(data)
+            if ring.is_overwritten(ring.read_counter):
+                ring.lost_blocks += 1
+                block.release()
+                continue
+            if self.data_queue:
+                audio_block = wurb_rec.AudioBlock(
+                    block.data, block.retain(), sample_index, adc_time, detector_time
+                )
+                audio_block.gap_before_s = gap_before_s
+                if self.queue_policy is not None:
+                    self.queue_policy.put_nowait(audio_block)
+                elif self.data_queue.full():
+                    self.dropped_counter += 1
+                    audio_block.release()
+                else:
+                    self.data_queue.put_nowait(audio_block)
+            if self.direct_target:
+                try:
+                    if self.direct_target.is_active():
+                        self.direct_target.add_data(block.retain())
+                except Exception as e:
+                    # Logging error.
+                    message = "Failed to add data to direct_target: " + str(e)
+                    self.logger.debug(message)
+            block.release()
+        self.ring_dropped_counter = (
+            int(ring.header_int[ring.DROPPED_BLOCKS]) + ring.lost_blocks
+        )
+
+    def get_dropped_blocks(self):
+        """ Blocks dropped in both processes, including lost ring blocks. """
+        return self.dropped_counter + self.ring_dropped_counter
+
+    def get_thread_cpu_s(self):
+        """ CPU time used by the capture thread in the capture process. """
+        return self.thread_cpu_s
+
+    def get_gap_stats(self):
+        """ Gaps and clock drift, from the capture process. """
+        return self.gap_stats
+
+
+# === MAIN - for test ===
+def create_simulated_capture(config, data_queue):
+    """Simulated device with a small FIFO, overruns are counted when data
+    is not read in time. Used to compare thread and process capture."""
+    capture = wurb_rec.PetterssonM500(data_queue=data_queue)
+    capture.pettersson_m500 = wurb_rec.wurb_audio_m500.FakeM500BatMic(
+        config["total_bytes"],
+        bytes_per_s=config["sampling_freq"] * 2,
+        fifo_size=0x8000,
+        overrun_target=capture,
+    )
+    return capture
+
+
+class SimulatedProcessCapture(ProcessSoundCapture):
+    """ProcessSoundCapture with the simulated device."""
+
+    def get_config(self):
+        """ """
+        config = super().get_config()
+        config["capture_factory"] = (
+            "wurb_rec.wurb_capture_process:create_simulated_capture"
+        )
+        config["total_bytes"] = self.total_bytes
+        return config
+
+
+def busy_load(stop_list):
+    """Pure Python work, holds the GIL as detection and web server may do."""
+    while not stop_list:
+        sum(index * index for index in range(10000))
+
+
+async def run_comparison(use_process, duration_s, load_threads):
+    """ """
+    sampling_freq_hz = 500000
+    block_size = sampling_freq_hz // 2
+    data_queue = asyncio.Queue(maxsize=100)
+    config = {
+        "sampling_freq": sampling_freq_hz,
+        "total_bytes": int(duration_s * sampling_freq_hz * 2),
+    }
+    if use_process:
+        capture = SimulatedProcessCapture(data_queue=data_queue, device_type="m500")
+        capture.total_bytes = config["total_bytes"]
+    else:
+        capture = create_simulated_capture(config, data_queue)
+    capture.usb_transfer_size = 0x4000
+    await capture.initiate_capture(None, sampling_freq_hz, block_size)
+    received_blocks = [0]
+
+    async def consumer():
+        while True:
+            item = await data_queue.get()
+            item.release()
+            received_blocks[0] += 1
+
+    consumer_task = asyncio.create_task(consumer())
+    loop = asyncio.get_running_loop()
+    stop_list = []
+    load_futures = [
+        loop.run_in_executor(None, busy_load, stop_list) for _ in range(load_threads)
+    ]
+    await capture.start_capture_in_executor()
+    stop_list.append(True)
+    await asyncio.gather(*load_futures)
+    await asyncio.sleep(0.1)
+    consumer_task.cancel()
+    mode = "process" if use_process else "thread"
+    print(
+        "Mode: ", mode,
+        "  Load threads: ", load_threads,
+        "  Blocks: ", received_blocks[0],
+        "  Overruns: ", capture.overrun_counter,
+    )
+
+
+def check_ring():
+    """A reader that is behind, and a block overwritten while read."""
+    number_of_slots = 4
+    ring = SharedMemoryBlockRing(8, number_of_slots=number_of_slots)
+    for counter in range(6):
+        ring.write_block(numpy.full(8, counter, numpy.int16), counter, 0.0, 0.0)
+    received = [int(data[0]) for data, _, _, _, _ in ring.read_blocks(6)]
+    print("Ring, received: ", received, " Lost: ", ring.lost_blocks)
+    assert received == [3, 4, 5]
+    assert ring.lost_blocks == 3
+    # Published counter 8. The writer may be in the middle of block 8,
+    # in the slot used by block 4.
+    for counter in range(6, 8):
+        ring.write_block(numpy.full(8, counter, numpy.int16), counter, 0.0, 0.0)
+    assert not ring.is_overwritten(5)
+    assert ring.is_overwritten(4)
+    ring.close()
+
+
+async def main():
+    """ """
+    check_ring()
+    for load_threads in [0, 4]:
+        await run_comparison(False, 10.0, load_threads)
+        await run_comparison(True, 10.0, load_threads)
+
+
+if __name__ == "__main__":
+    """ """
+    asyncio.run(main(), debug=False)
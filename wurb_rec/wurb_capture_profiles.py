@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import time
+import psutil
+
+
+class CaptureProfiles:
+    """Named capture latency profiles.
+    Period size and block duration are used for ALSA microphones.
+    USB transfer size and block duration are used for the Pettersson M500.
+    The profile is selected by the environment variable
+    WURB_REC_CAPTURE_PROFILE, default is "balanced".
+    """
+
+    def __init__(self):
+        """ """
+        self.default_profile_name = "balanced"
+        self.profiles = {
+            "low-latency": {
+                "period_size": 1024,  # Unit: frames.
+                "block_duration_s": 0.125,
+                "usb_transfer_size": 0x8000,  # Unit: bytes. Must be 2^n.
+                "max_batch_latency_s": 0.0,
+            },
+            "balanced": {
+                "period_size": 4096,
+                "block_duration_s": 0.5,
+                "usb_transfer_size": 0x20000,
+                "max_batch_latency_s": 0.0,
+            },
+            "low-cpu": {
+                "period_size": 16384,
+                "block_duration_s": 1.0,
+                "usb_transfer_size": 0x40000,
+                "max_batch_latency_s": 0.25,
+            },
+        }
+
+    def get_profile_names(self):
+        """ """
+        return list(self.profiles.keys())
+
+    def get_profile(self, profile_name):
+        """Returns a copy of the profile. Unknown names gives the default."""
+        if profile_name not in self.profiles:
+            profile_name = self.default_profile_name
+        profile = self.profiles[profile_name].copy()
+        profile["name"] = profile_name
+        return profile
+
+
+class CaptureProfileStats:
+    """Measures CPU load for the whole process and counts overruns
+    while a capture profile is used."""
+
+    def __init__(self, profile_name=""):
+        """ """
+        self.process = psutil.Process()
+        self.start(profile_name)
+
+    def start(self, profile_name):
+        """ """
+        self.profile_name = profile_name
+        self.overrun_counter = 0
+        self.start_time_s = time.time()
+        self.start_cpu_s = self.get_cpu_time_s()
+
+    def get_cpu_time_s(self):
+        """ """
+        cpu_times = self.process.cpu_times()
+        return cpu_times.user + cpu_times.system
+
+    def add_overruns(self, number_of_overruns=1):
+        """ """
+        self.overrun_counter += number_of_overruns
+
+    def get_stats(self):
+        """ """
+        elapsed_s = time.time() - self.start_time_s
+        cpu_percent = 0.0
+        if elapsed_s > 0.0:
+            cpu_percent = (self.get_cpu_time_s() - self.start_cpu_s) / elapsed_s * 100
+        return {
+            "profile_name": self.profile_name,
+            "elapsed_s": round(elapsed_s, 1),
+            "cpu_percent": round(cpu_percent, 1),
+            "overruns": self.overrun_counter,
+        }
@@ -0,0 +1,382 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import numpy as np
+
+# CloudedBats.
+import wurb_rec
+
+
+class SoundDetectionSpectral(wurb_rec.SoundDetectionSimple):
+    """Base for detectors that use the band power for all frames. Frames
+    are continuous between blocks and hits are counted within the hit
+    window, as in the simple detection. Subclasses decide which frames
+    are hits in get_frame_hits().
+    """
+
+    def __init__(self, wurb_manager, wurb_recorder=None):
+        """ """
+        super().__init__(wurb_manager, wurb_recorder)
+        # All frames are needed, no gate. The floor is not used.
+        self.use_detection_gate = False
+        self.use_noise_floor = False
+
+    def get_frame_hits(self, band_power, first_frame):
+        """ Abstract. Returns hits, peak dBFS and peak frequency for each frame. """
+        peak_dbfs, peak_freq_hz = self.get_frame_peaks(band_power)
+        return peak_dbfs > self.threshold_dbfs, peak_dbfs, peak_freq_hz
+
+    def get_frame_peaks(self, band_power):
+        """ Peak dBFS and frequency for each frame, from the band power. """
+        number_of_frames = len(band_power)
+        if band_power.shape[1] == 0:
+            return np.full(number_of_frames, -500.0), np.zeros(number_of_frames)
+        bin_peak_indexes = band_power.argmax(axis=1)
+        peak_power = band_power[np.arange(number_of_frames), bin_peak_indexes]
+        peak_power = np.maximum(peak_power, self.filter_floor_power)
+        peak_dbfs = 10 * np.log10(peak_power) - 20 * np.log10(
+            self.window_function_dbfs_max
+        )
+        peak_freq_hz = self.freq_bins_hz[bin_peak_indexes + self.first_filter_bin]
+        return peak_dbfs, peak_freq_hz
+
+    def check_hits(self, frame_hits, first_frame):
+        """Returns the index for the frame where the detection is triggered
+        and the frame number for the first of the hits, or None."""
+        min_hits = self.sound_detected_counter_min
+        earlier_hits = len(self.last_hit_frames)
+        hit_frames = np.concatenate(
+            [
+                np.array(self.last_hit_frames, dtype=np.int64),
+                first_frame + np.flatnonzero(frame_hits),
+            ]
+        )
+        keep_hits = min_hits - 1
+        self.last_hit_frames = list(hit_frames[len(hit_frames) - keep_hits :])
+        if len(hit_frames) < min_hits:
+            return None, None
+        # Time from the first to the last hit, for each group of hits.
+        spans = hit_frames[keep_hits:] - hit_frames[: len(hit_frames) - keep_hits]
+        triggered = np.flatnonzero(spans <= self.hit_window_frames)
+        # Only triggered by hits in this block.
+        triggered = triggered[triggered + keep_hits >= earlier_hits]
+        if len(triggered) == 0:
+            return None, None
+        first_hit_index = triggered[0]
+        trigger_index = hit_frames[first_hit_index + keep_hits] - first_frame
+        return trigger_index, hit_frames[first_hit_index]
+
+    def check_for_sound(self, time_and_data):
+        """ """
+        _rec_time, block_int16 = time_and_data
+        sound_detected = False
+        peak_frequency_hz = None
+        peak_dbfs_at_max = None
+        self.trigger_sample_offset = None
+        try:
+            (
+                _data_int16,
+                frames,
+                overlap_length,
+                first_frame,
+            ) = self.get_continuous_frames(block_int16)
+            band_power = self.get_band_power(frames)
+            frame_hits, peak_dbfs, peak_freq_hz = self.get_frame_hits(
+                band_power, first_frame
+            )
+            trigger_index, first_hit_frame = self.check_hits(frame_hits, first_frame)
+            if trigger_index is not None:
+                sound_detected = True
+                self.trigger_sample_offset = (
+                    first_hit_frame - first_frame
+                ) * self.jump_size - overlap_length
+                # Loudest hit after the trigger.
+                later_hits = np.flatnonzero(frame_hits[trigger_index:])
+                later_hits += trigger_index
+                peak_index = later_hits[np.argmax(peak_dbfs[later_hits])]
+                peak_dbfs_at_max = peak_dbfs[peak_index]
+                peak_frequency_hz = peak_freq_hz[peak_index]
+        except Exception as e:
+            print("DEBUG: Exception in check_for_sound: ", e)
+
+        # Check if running in manual triggering mode.
+        sound_detected = self.manual_triggering_check(sound_detected)
+
+        return sound_detected, peak_frequency_hz, peak_dbfs_at_max
+
+
+class SoundDetectionFlatness(SoundDetectionSpectral):
+    """Frames above threshold are only used if the spectrum is tonal.
+    Spectral flatness is the geometric mean divided by the arithmetic
+    mean of the band power. It is low for bat calls and close to 0.5
+    for clicks, rain and broadband noise.
+    """
+
+    algorithm_name = "detection-flatness"
+    description = "Spectral flatness (tonal sounds, no clicks or noise)"
+    cpu_cost_per_audio_s = 0.0045
+
+    def __init__(self, wurb_manager, wurb_recorder=None):
+        """ """
+        super().__init__(wurb_manager, wurb_recorder)
+        # Config.
+        self.flatness_max = 0.2
+        # Counters.
+        self.rejected_frames = 0
+
+    def get_frame_hits(self, band_power, first_frame):
+        """ """
+        peak_dbfs, peak_freq_hz = self.get_frame_peaks(band_power)
+        frame_hits = peak_dbfs > self.threshold_dbfs
+        # Only calculated for frames above threshold.
+        hit_indexes = np.flatnonzero(frame_hits)
+        if len(hit_indexes) > 0:
+            power = band_power[hit_indexes] + np.float32(self.filter_floor_power)
+            geometric_mean = np.exp(np.mean(np.log(power), axis=1))
+            flatness = geometric_mean / np.mean(power, axis=1)
+            is_tonal = flatness <= self.flatness_max
+            frame_hits[hit_indexes] = is_tonal
+            self.rejected_frames += int(np.count_nonzero(~is_tonal))
+        return frame_hits, peak_dbfs, peak_freq_hz
+
+    def get_stats(self):
+        """ """
+        stats = super().get_stats()
+        stats["flatness_rejected_frames"] = self.rejected_frames
+        return stats
+
+
+class SoundDetectionBandRatio(SoundDetectionSpectral):
+    """Frames are hits when the band energy is above the running noise
+    floor by a margin, and the peak is above threshold. The floor is a
+    low percentile of the band energy in each block. It follows lower
+    values at once and higher values slowly, so calls do not raise it.
+    """
+
+    algorithm_name = "detection-band-ratio"
+    description = "Band energy above the running noise floor"
+    cpu_cost_per_audio_s = 0.005
+
+    def __init__(self, wurb_manager, wurb_recorder=None):
+        """ """
+        super().__init__(wurb_manager, wurb_recorder)
+        # Config.
+        self.ratio_min_db = 12.0
+        self.floor_percentile = 20
+        self.floor_rise_db_per_s = 1.0
+        # Not changed by reset(), it is the same place.
+        self.band_floor = None
+
+    def get_frame_hits(self, band_power, first_frame):
+        """ """
+        peak_dbfs, peak_freq_hz = self.get_frame_peaks(band_power)
+        number_of_frames = len(band_power)
+        if (number_of_frames == 0) or (band_power.shape[1] == 0):
+            return np.zeros(number_of_frames, dtype=bool), peak_dbfs, peak_freq_hz
+        band_energy = band_power.sum(axis=1, dtype=np.float64)
+        band_energy = np.maximum(band_energy, self.filter_floor_power)
+        block_floor = np.percentile(band_energy, self.floor_percentile)
+        if self.band_floor is None:
+            self.band_floor = block_floor
+        ratio_db = 10 * np.log10(band_energy / self.band_floor)
+        frame_hits = (ratio_db >= self.ratio_min_db) & (
+            peak_dbfs > self.threshold_dbfs
+        )
+        # Down at once, up slowly.
+        block_s = number_of_frames * self.jump_size / self.sampling_freq
+        rise_factor = 10 ** (self.floor_rise_db_per_s * block_s / 10)
+        self.band_floor = min(block_floor, self.band_floor * rise_factor)
+        return frame_hits, peak_dbfs, peak_freq_hz
+
+    def get_stats(self):
+        """ """
+        stats = super().get_stats()
+        if self.band_floor is not None:
+            band_floor_dbfs = 10 * np.log10(self.band_floor) - 20 * np.log10(
+                self.window_function_dbfs_max
+            )
+            stats["band_floor_dbfs"] = round(float(band_floor_dbfs), 1)
+        return stats
+
+
+class SoundDetectionFmSweep(SoundDetectionSpectral):
+    """Tracks the peak frequency over short frames. A sweep is a number
+    of frames in a row where the frequency falls, or stays the same, and
+    falls at least sweep_min_hz from the first to the last frame. One
+    sweep triggers the detection. Constant frequency is not a sweep, and
+    the short FM part of CF-FM calls is seldom enough, so calls from
+    horseshoe bats (Rhinolophus) are not detected. The peak is searched
+    in the spectrum divided by a running noise floor for each bin, so
+    peaks in coloured noise are not tracked. Insects and other constant
+    sounds do not sweep.
+    """
+
+    algorithm_name = "detection-fm-sweep"
+    description = "FM sweeps (falling frequency, not for CF bats)"
+    cpu_cost_per_audio_s = 0.0075
+
+    def __init__(self, wurb_manager, wurb_recorder=None):
+        """ """
+        super().__init__(wurb_manager, wurb_recorder)
+        # Config. Short frames, FM calls can be 2-3 ms.
+        self.window_size = 512
+        self.jump_size = 256
+        self.sound_detected_counter_min = 1
+        self.sweep_frames_min = 3
+        self.sweep_min_hz = 12000.0  # From start to end.
+        self.sweep_step_max_hz = 20000.0  # Between frames.
+        self.peak_to_mean_min_db = 10.0
+        # Counters.
+        self.sweep_counter = 0
+
+    def config(self):
+        """ The floor is always used, for the tracking. """
+        super().config()
+        # The median is used for the whitening, and not capped.
+        self.noise_floor = wurb_rec.NoiseFloor(
+            "on",
+            margin_db=15.0,
+            percentile=50.0,
+            frame_step=4,
+            rise_db_per_s=3.0,
+            max_above_quiet_db=None,
+        )
+        self.noise_floor.config(
+            self.freq_bins_hz[self.first_filter_bin :],
+            self.window_function_dbfs_max,
+            self.filter_floor_power,
+        )
+
+    def reset(self):
+        """ """
+        super().reset()
+        self.sweep_frames = 0
+        self.sweep_start_freq_hz = None
+        self.sweep_last_freq_hz = None
+        self.sweep_last_frame = None
+        self.sweep_counted = False
+
+    def get_tonal_peaks(self, band_power):
+        """Peak frequency and if the peak is tonal for each frame. The
+        peak must be above the noise floor by the margin."""
+        number_of_frames = len(band_power)
+        if (number_of_frames == 0) or (band_power.shape[1] == 0):
+            return np.zeros(number_of_frames, dtype=bool), np.zeros(number_of_frames)
+        block_s = number_of_frames * self.jump_size / self.sampling_freq
+        floor = self.noise_floor.update(
+            band_power[:: self.noise_floor.frame_step], block_s
+        )
+        whitened = band_power / floor
+        peak_bins = whitened.argmax(axis=1)
+        peak_ratio = whitened[np.arange(number_of_frames), peak_bins]
+        # Clicks are loud in all bins, the peak is not far above the mean.
+        is_tonal = (peak_ratio >= self.noise_floor.margin_factor) & (
+            peak_ratio >= whitened.mean(axis=1) * 10 ** (self.peak_to_mean_min_db / 10)
+        )
+        peak_freq_hz = self.freq_bins_hz[peak_bins + self.first_filter_bin]
+        return is_tonal, peak_freq_hz
+
+    def get_frame_hits(self, band_power, first_frame):
+        """ Frames above threshold are few, they are checked one by one. """
+        peak_dbfs, _peak_freq_hz = self.get_frame_peaks(band_power)
+        is_tonal, peak_freq_hz = self.get_tonal_peaks(band_power)
+        frame_hits = np.zeros(len(band_power), dtype=bool)
+        bin_hz = self.sampling_freq / self.window_size
+        above_threshold = peak_dbfs > self.threshold_dbfs
+        frame_indexes = np.flatnonzero(above_threshold & is_tonal)
+        self.noise_floor.add_suppressed(
+            int(np.count_nonzero(above_threshold)) - len(frame_indexes)
+        )
+        for frame_index in frame_indexes:
+            frame = first_frame + frame_index
+            freq_hz = peak_freq_hz[frame_index]
+            continued = False
+            if self.sweep_last_frame == frame - 1:
+                step_hz = self.sweep_last_freq_hz - freq_hz
+                continued = -bin_hz <= step_hz <= self.sweep_step_max_hz
+            if continued:
+                self.sweep_frames += 1
+            else:
+                self.sweep_frames = 1
+                self.sweep_start_freq_hz = freq_hz
+                self.sweep_counted = False
+            self.sweep_last_frame = frame
+            self.sweep_last_freq_hz = freq_hz
+            if (self.sweep_frames >= self.sweep_frames_min) and (
+                self.sweep_start_freq_hz - freq_hz >= self.sweep_min_hz
+            ):
+                frame_hits[frame_index] = True
+                if not self.sweep_counted:
+                    self.sweep_counted = True
+                    self.sweep_counter += 1
+        return frame_hits, peak_dbfs, peak_freq_hz
+
+    def get_stats(self):
+        """ """
+        stats = super().get_stats()
+        stats["sweeps"] = self.sweep_counter
+        return stats
+
+
+# Registered when the module is imported.
+wurb_rec.detection_algorithms.register(SoundDetectionFlatness)
+wurb_rec.detection_algorithms.register(SoundDetectionBandRatio)
+wurb_rec.detection_algorithms.register(SoundDetectionFmSweep)
+
+
+# === MAIN - for test ===
+if __name__ == "__main__":
+    """ All registered detectors on the synthetic scenes. Blocks with
+    detected sound and CPU time per second of audio at 384 kHz. """
+    import time
+    from wurb_rec.wurb_audio_synthetic import TestManager
+
+    class Settings:
+        def __init__(self, algorithm_name):
+            self.algorithm_name = algorithm_name
+
+        def get_setting(self, key):
+            return {
+                "detection_algorithm": self.algorithm_name,
+                "detection_limit_khz": 15.0,
+                "detection_sensitivity_dbfs": -50.0,
+                "rec_mode": "mode-auto",
+            }.get(key)
+
+    sampling_freq_hz = 384000
+    block_size = sampling_freq_hz // 2
+    number_of_blocks = 120  # 60 s.
+    scene_blocks = {}
+    for scene_name in wurb_rec.SyntheticScenes().get_scene_names():
+        scene = wurb_rec.SyntheticScenes().get_scene(scene_name)
+        generator = wurb_rec.BatCallGenerator(sampling_freq_hz, seed=1, scene=scene)
+        scene_blocks[scene_name] = [
+            generator.generate(block_size) for _ in range(number_of_blocks)
+        ]
+    for algorithm_name in wurb_rec.detection_algorithms.get_algorithm_names():
+        detected = {}
+        cpu_s = 0.0
+        for scene_name, blocks in scene_blocks.items():
+            test_manager = TestManager(sampling_freq_hz)
+            test_manager.wurb_settings = Settings(algorithm_name)
+            detector = wurb_rec.SoundDetection(test_manager).get_detection()
+            start_cpu_s = time.thread_time()
+            results = [detector.check_for_sound((0, block)) for block in blocks]
+            cpu_s += time.thread_time() - start_cpu_s
+            detected[scene_name] = sum(result[0] for result in results)
+        audio_s = len(scene_blocks) * number_of_blocks * block_size / sampling_freq_hz
+        detector_class = wurb_rec.detection_algorithms.get_detector_class(
+            algorithm_name
+        )
+        print(
+            algorithm_name.ljust(22),
+            " CPU s per audio s: ",
+            round(cpu_s / audio_s, 4),
+            " Declared: ",
+            detector_class.cpu_cost_per_audio_s,
+            " Detected blocks: ",
+            detected,
+        )
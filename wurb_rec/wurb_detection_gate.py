@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import time
+import numpy as np
+import scipy.signal
+
+try:
+    # Keeps float32, numpy.fft converts to float64.
+    import scipy.fft as fft_module
+except ImportError:
+    fft_module = np.fft
+
+
+class DetectionGate:
+    """Cheap check in front of the FFT detection. The band energy above
+    the detection limit is calculated for short frames without overlap,
+    and only detection frames close to a loud short frame are used in
+    the FFT detection. Most blocks are silent and no FFT is needed.
+    Modes: "off", "on" or "verify". In "verify" mode all frames are
+    also used in the FFT detection and frames missed by the gate are
+    counted, for example when testing with replayed files.
+    """
+
+    def __init__(self, mode="off", margin_db=6.0, gate_window_size=512):
+        """ """
+        self.mode = mode
+        self.margin_db = margin_db
+        self.gate_window_size = gate_window_size
+        self.clear()
+
+    def clear(self):
+        """ """
+        # Counters.
+        self.checked_blocks = 0
+        self.passed_blocks = 0
+        self.checked_frames = 0
+        self.passed_frames = 0
+        self.missed_frames = 0
+        self.gate_cpu_s = 0.0
+        self.fft_cpu_s = 0.0
+        self.fft_frames = 0
+
+    def is_used(self):
+        """ """
+        return self.mode in ["on", "verify"]
+
+    def config(self, sampling_freq_hz, filter_min_hz, threshold_dbfs):
+        """ Threshold for the short frames, with the same dBFS scale as
+        the detection. """
+        self.window_function = (
+            scipy.signal.windows.hann(self.gate_window_size) / 32768.0
+        ).astype(np.float32)
+        window_function_dbfs_max = np.sum(self.window_function) * 32768.0 / 2
+        freq_bins_hz = np.arange((self.gate_window_size / 2) + 1) / (
+            self.gate_window_size / sampling_freq_hz
+        )
+        self.first_filter_bin = int(np.sum(freq_bins_hz < filter_min_hz))
+        gate_dbfs = threshold_dbfs - self.margin_db
+        gate_amplitude = 10.0 ** (gate_dbfs / 20.0)
+        self.gate_amplitude = gate_amplitude * window_function_dbfs_max
+
+    def get_frame_mask(self, data_int16, number_of_frames, window_size, jump_size):
+        """ True for detection frames that should be used in the FFT
+        detection. The frames are the same as in the detection. """
+        start_cpu_s = time.thread_time()
+        frame_mask = np.zeros(number_of_frames, dtype=bool)
+        if number_of_frames > 0:
+            # Short frames, the last one is padded with zeros.
+            size = self.gate_window_size
+            number_of_gate_frames = -(-len(data_int16) // size)
+            signals = np.zeros(number_of_gate_frames * size, dtype=np.float32)
+            signals[: len(data_int16)] = data_int16
+            signals = signals.reshape(number_of_gate_frames, size)
+            signals *= self.window_function
+            spectra = fft_module.rfft(signals, axis=1)[:, self.first_filter_bin :]
+            if spectra.shape[1] > 0:
+                gate_passed = np.abs(spectra).max(axis=1) >= self.gate_amplitude
+                # Passed short frames inside each detection frame.
+                passed_sum = np.concatenate([[0], np.cumsum(gate_passed)])
+                frame_starts = np.arange(number_of_frames) * jump_size
+                first_gate_frame = frame_starts // size
+                last_gate_frame = (frame_starts + window_size - 1) // size
+                frame_mask = (
+                    passed_sum[last_gate_frame + 1] > passed_sum[first_gate_frame]
+                )
+        self.checked_blocks += 1
+        self.checked_frames += number_of_frames
+        passed_frames = int(np.count_nonzero(frame_mask))
+        self.passed_frames += passed_frames
+        if passed_frames > 0:
+            self.passed_blocks += 1
+        self.gate_cpu_s += time.thread_time() - start_cpu_s
+        return frame_mask
+
+    def add_fft_cpu(self, cpu_s, number_of_frames):
+        """ Used to calculate saved CPU time. Also called once for a test
+        transform when configured, used if all frames are skipped. """
+        self.fft_cpu_s += cpu_s
+        self.fft_frames += number_of_frames
+
+    def add_missed_frames(self, missed_frames):
+        """ Frames above threshold in the FFT detection, not passed by
+        the gate. Only checked in "verify" mode. """
+        self.missed_frames += missed_frames
+
+    def get_stats(self):
+        """ """
+        checked_blocks = max(1, self.checked_blocks)
+        checked_frames = max(1, self.checked_frames)
+        fft_cpu_per_frame_s = self.fft_cpu_s / max(1, self.fft_frames)
+        skipped_frames = self.checked_frames - self.passed_frames
+        # In "verify" mode all frames are used, the saved time is an estimate.
+        saved_cpu_s = skipped_frames * fft_cpu_per_frame_s - self.gate_cpu_s
+        return {
+            "gate_mode": self.mode,
+            "gate_checked_blocks": self.checked_blocks,
+            "gate_passed_blocks": self.passed_blocks,
+            "gate_hit_percent": round(self.passed_blocks / checked_blocks * 100, 1),
+            "gate_passed_frame_percent": round(
+                self.passed_frames / checked_frames * 100, 1
+            ),
+            "gate_missed_frames": self.missed_frames,
+            "gate_cpu_s": round(self.gate_cpu_s, 3),
+            "gate_saved_cpu_s": round(saved_cpu_s, 3),
+        }
+
+
+# === MAIN - for test ===
+if __name__ == "__main__":
+    """ Synthetic scenes, detection with and without the gate. """
+    import os
+    import wurb_rec
+    from wurb_rec.wurb_audio_synthetic import TestManager
+
+    sampling_freq_hz = 384000
+    block_size = sampling_freq_hz // 2
+    number_of_blocks = 120  # 60 s.
+    for scene_name in wurb_rec.SyntheticScenes().get_scene_names():
+        scene = wurb_rec.SyntheticScenes().get_scene(scene_name)
+        generator = wurb_rec.BatCallGenerator(sampling_freq_hz, seed=1, scene=scene)
+        blocks = [generator.generate(block_size) for _ in range(number_of_blocks)]
+        results = {}
+        for mode in ["off", "on", "verify"]:
+            os.environ["WURB_REC_DETECTION_GATE"] = mode
+            detector = wurb_rec.SoundDetection(TestManager(sampling_freq_hz))
+            detector = detector.get_detection()
+            start_cpu_s = time.thread_time()
+            results[mode] = [detector.check_for_sound((0, block)) for block in blocks]
+            cpu_s = time.thread_time() - start_cpu_s
+            stats = detector.detection_gate.get_stats()
+            print(
+                scene_name.ljust(8),
+                mode.ljust(6),
+                " Detected: ",
+                sum(result[0] for result in results[mode]),
+                " CPU per block, ms: ",
+                round(cpu_s / number_of_blocks * 1000, 2),
+                " Hit %: ",
+                stats["gate_hit_percent"] if mode != "off" else "-",
+                " Saved CPU s: ",
+                stats["gate_saved_cpu_s"] if mode != "off" else "-",
+                " Missed frames: ",
+                stats["gate_missed_frames"] if mode == "verify" else "-",
+            )
+        print(
+            scene_name.ljust(8),
+            "Identical results, on/off: ",
+            results["on"] == results["off"],
+        )
@@ -0,0 +1,274 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import os
+import asyncio
+import time
+import ctypes
+import ctypes.util
+import logging
+
+# Flags from <sys/inotify.h>.
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+
+class HotplugWatcher:
+    """Watches device nodes for hotplug events with inotify, used on Linux.
+    Both created and removed nodes are reported, and changed attributes
+    since udev sets permissions after the node is created. Paths that do
+    not exist yet are watched via the parent directory. The callback is
+    called in the event loop, once for each group of events.
+    """
+
+    def __init__(self, callback, watch_paths=None):
+        """ """
+        self.callback = callback
+        if watch_paths is None:
+            watch_paths = ["/dev/snd", "/dev/bus/usb"]
+        self.watch_paths = watch_paths
+        self.logger = logging.getLogger("CloudedBats-WURB")
+        self.libc = None
+        self.inotify_fd = None
+        self.main_loop = None
+        self.event_counter = 0
+
+    def is_active(self):
+        """ """
+        return self.inotify_fd is not None
+
+    def start(self, main_loop):
+        """ Returns False if inotify is not available. """
+        if self.is_active():
+            return True
+        try:
+            libc_name = ctypes.util.find_library("c") or "libc.so.6"
+            self.libc = ctypes.CDLL(libc_name, use_errno=True)
+            inotify_fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if inotify_fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed.")
+            self.inotify_fd = inotify_fd
+            self.add_watches()
+            self.main_loop = main_loop
+            self.main_loop.add_reader(self.inotify_fd, self.on_readable)
+            return True
+        except Exception as e:
+            self.logger.debug("Hotplug watcher not available: " + str(e))
+            self.stop()
+            return False
+
+    def stop(self):
+        """ """
+        if self.inotify_fd is not None:
+            if self.main_loop:
+                try:
+                    self.main_loop.remove_reader(self.inotify_fd)
+                except Exception:
+                    pass
+            os.close(self.inotify_fd)
+        self.inotify_fd = None
+        self.main_loop = None
+
+    def add_watches(self):
+        """ Called again for each event, new directories are then added.
+        Watches that already exists are not duplicated by inotify. """
+        mask = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ATTRIB
+        path_list = []
+        for watch_path in self.watch_paths:
+            if os.path.isdir(watch_path):
+                path_list.append(watch_path)
+                # USB device nodes are stored in one directory per bus.
+                for entry in os.scandir(watch_path):
+                    if entry.is_dir(follow_symlinks=False):
+                        path_list.append(entry.path)
+            else:
+                parent_path = os.path.dirname(watch_path)
+                if os.path.isdir(parent_path):
+                    path_list.append(parent_path)
+        for path in path_list:
+            self.libc.inotify_add_watch(self.inotify_fd, os.fsencode(path), mask)
+
+    def on_readable(self):
+        """ Called in the event loop. Events are only counted, any change
+        will invalidate the inventory. """
+        has_events = False
+        try:
+            while True:
+                if not os.read(self.inotify_fd, 4096):
+                    break
+                has_events = True
+        except BlockingIOError:
+            pass
+        except Exception as e:
+            self.logger.debug("Hotplug watcher: " + str(e))
+        if has_events:
+            self.event_counter += 1
+            try:
+                self.add_watches()
+            except Exception:
+                pass
+            self.callback()
+
+
+class DeviceInventory:
+    """Cached list of connected microphones.
+    The probe function is blocking, it may open sound cards and scan the
+    USB bus, and runs in an executor thread. The result is reused until a
+    hotplug event is reported. Without inotify a fingerprint of the device
+    nodes is compared instead, which only lists a few directories.
+    """
+
+    def __init__(self, watch_paths=None):
+        """ """
+        if watch_paths is None:
+            watch_paths = ["/dev/snd", "/dev/bus/usb"]
+        self.watch_paths = watch_paths
+        self.logger = logging.getLogger("CloudedBats-WURB")
+        self.hotplug_watcher = HotplugWatcher(self.invalidate, watch_paths)
+        self.watcher_started = False
+        self.probe_lock = None
+        self.device_list = None
+        self.fingerprint = None
+        self.generation = 0
+        self.listeners = []
+        # Counters.
+        self.probe_counter = 0
+        self.cache_hit_counter = 0
+        self.invalidation_counter = 0
+        self.last_probe_s = 0.0
+
+    def add_listener(self, callback):
+        """ The callback is called in the event loop for hotplug events. """
+        self.listeners.append(callback)
+
+    def invalidate(self):
+        """ Called for hotplug events. """
+        self.generation += 1
+        self.invalidation_counter += 1
+        self.device_list = None
+        for callback in self.listeners:
+            callback()
+
+    def shutdown(self):
+        """ """
+        self.hotplug_watcher.stop()
+        self.watcher_started = False
+        self.device_list = None
+
+    def get_fingerprint(self):
+        """ Names and modes for all device nodes. Only used without inotify. """
+        if self.hotplug_watcher.is_active():
+            return None
+        fingerprint = []
+        for watch_path in self.watch_paths:
+            for dir_path, _dir_names, file_names in os.walk(watch_path):
+                for file_name in sorted(file_names):
+                    try:
+                        stat = os.stat(os.path.join(dir_path, file_name))
+                        fingerprint.append(
+                            (dir_path, file_name, stat.st_mode, stat.st_gid)
+                        )
+                    except OSError:
+                        pass
+        return tuple(fingerprint)
+
+    def is_valid(self):
+        """ """
+        if self.device_list is None:
+            return False
+        if self.hotplug_watcher.is_active():
+            return True
+        return self.fingerprint == self.get_fingerprint()
+
+    async def get_device_list(self, probe_function):
+        """ Returns the cached list, or the result from probe_function. """
+        main_loop = asyncio.get_running_loop()
+        if not self.watcher_started:
+            self.watcher_started = True
+            if self.hotplug_watcher.start(main_loop):
+                self.logger.debug("Device inventory: Hotplug watcher started.")
+        if self.probe_lock is None:
+            self.probe_lock = asyncio.Lock()
+        async with self.probe_lock:
+            if self.is_valid():
+                self.cache_hit_counter += 1
+                return list(self.device_list)
+            generation = self.generation
+            fingerprint = self.get_fingerprint()
+            start_time_s = time.monotonic()
+            device_list = await main_loop.run_in_executor(None, probe_function)
+            self.last_probe_s = time.monotonic() - start_time_s
+            self.probe_counter += 1
+            # Not cached if changed during the probe, probed again next time.
+            if generation == self.generation:
+                self.device_list = list(device_list)
+                self.fingerprint = fingerprint
+            message = "Device inventory: Probed in " + str(round(self.last_probe_s, 3))
+            message += " s. Devices: " + str(len(device_list))
+            self.logger.debug(message)
+            return list(device_list)
+
+    def get_stats(self):
+        """ """
+        return {
+            "hotplug_watcher": self.hotplug_watcher.is_active(),
+            "hotplug_events": self.hotplug_watcher.event_counter,
+            "probes": self.probe_counter,
+            "cache_hits": self.cache_hit_counter,
+            "invalidations": self.invalidation_counter,
+            "last_probe_s": round(self.last_probe_s, 3),
+        }
+
+
+# === MAIN - for test ===
+async def main():
+    """ Uses a temporary directory as device nodes and a slow probe. """
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        bus_dir = os.path.join(temp_dir, "001")
+        os.mkdir(bus_dir)
+        probe_result = []
+
+        def slow_probe():
+            time.sleep(0.2)
+            return list(probe_result)
+
+        for use_inotify in [True, False]:
+            inventory = DeviceInventory(watch_paths=[temp_dir])
+            if not use_inotify:
+                inventory.watcher_started = True
+            probe_result.clear()
+            start_time_s = time.monotonic()
+            for _index in range(100):
+                await inventory.get_device_list(slow_probe)
+            print("Inotify: ", inventory.hotplug_watcher.is_active())
+            print("  100 checks, s: ", round(time.monotonic() - start_time_s, 3))
+            # Plug in.
+            probe_result.append({"device_name": "Test mic"})
+            with open(os.path.join(bus_dir, "002"), "w") as device_node:
+                device_node.write("")
+            await asyncio.sleep(0.05)
+            device_list = await inventory.get_device_list(slow_probe)
+            print("  After plug in: ", len(device_list))
+            # Unplug.
+            probe_result.clear()
+            os.remove(os.path.join(bus_dir, "002"))
+            await asyncio.sleep(0.05)
+            device_list = await inventory.get_device_list(slow_probe)
+            print("  After unplug: ", len(device_list))
+            print("  Stats: ", inventory.get_stats())
+            inventory.shutdown()
+
+
+if __name__ == "__main__":
+    """ """
+    asyncio.run(main(), debug=False)
@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import time
+import threading
+import concurrent.futures
+
+
+class RoleExecutor(concurrent.futures.ThreadPoolExecutor):
+    """Thread pool for one role, for example capture for one device,
+    DSP for audio feedback or disk I/O. Used as executor in
+    run_in_executor(). Jobs waiting for a thread are counted as queue
+    depth, and the time spent in jobs is counted as busy time.
+    """
+
+    def __init__(self, name, max_workers=1):
+        """ """
+        super().__init__(max_workers=max_workers, thread_name_prefix="wurb-" + name)
+        self.name = name
+        self.max_workers = max_workers
+        self.stats_lock = threading.Lock()
+        self.start_time_s = time.monotonic()
+        # Counters.
+        self.queued_jobs = 0
+        self.queued_jobs_max = 0
+        self.running_jobs = 0
+        self.finished_jobs = 0
+        self.busy_s = 0.0
+        self.wait_s = 0.0
+        self.job_start_times = {}  # Running jobs, by thread.
+
+    def submit(self, function, *args, **kwargs):
+        """ """
+        with self.stats_lock:
+            self.queued_jobs += 1
+            self.queued_jobs_max = max(self.queued_jobs_max, self.queued_jobs)
+        return super().submit(self.run_job, time.monotonic(), function, args, kwargs)
+
+    def run_job(self, submit_time_s, function, args, kwargs):
+        """ Called in the worker thread. """
+        start_time_s = time.monotonic()
+        thread_id = threading.get_ident()
+        with self.stats_lock:
+            self.queued_jobs -= 1
+            self.running_jobs += 1
+            self.wait_s += start_time_s - submit_time_s
+            self.job_start_times[thread_id] = start_time_s
+        try:
+            return function(*args, **kwargs)
+        finally:
+            with self.stats_lock:
+                self.running_jobs -= 1
+                self.finished_jobs += 1
+                self.busy_s += time.monotonic() - start_time_s
+                del self.job_start_times[thread_id]
+
+    def get_stats(self):
+        """ Busy time includes jobs still running, like capture loops. """
+        with self.stats_lock:
+            now_s = time.monotonic()
+            elapsed_s = now_s - self.start_time_s
+            busy_s = self.busy_s
+            for start_time_s in self.job_start_times.values():
+                busy_s += now_s - start_time_s
+            busy_percent = 0.0
+            if elapsed_s > 0.0:
+                capacity_s = elapsed_s * self.max_workers
+                busy_percent = busy_s / capacity_s * 100
+            finished_jobs = max(1, self.finished_jobs)
+            return {
+                "threads": self.max_workers,
+                "queue_depth": self.queued_jobs,
+                "queue_depth_max": self.queued_jobs_max,
+                "running_jobs": self.running_jobs,
+                "finished_jobs": self.finished_jobs,
+                "busy_s": round(busy_s, 3),
+                "busy_percent": round(busy_percent, 1),
+                "mean_wait_s": round(self.wait_s / finished_jobs, 4),
+            }
+
+
+class ExecutorRegistry:
+    """Named executors, created when first used and shared by name.
+    Long running loops, capture and playback, get a thread each and
+    do not occupy the default pool. Short jobs for the same role are
+    run in order by a single thread, instead of concurrently.
+    """
+
+    def __init__(self):
+        """ """
+        self.executors = {}
+
+    def get_executor(self, name, max_workers=1):
+        """ """
+        executor = self.executors.get(name, None)
+        if executor is None:
+            executor = RoleExecutor(name, max_workers)
+            self.executors[name] = executor
+        return executor
+
+    def remove_executor(self, name):
+        """ Running jobs are not waited for. """
+        executor = self.executors.pop(name, None)
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def shutdown(self):
+        """ """
+        for name in list(self.executors):
+            self.remove_executor(name)
+
+    def get_stats(self):
+        """ """
+        return {name: executor.get_stats() for name, executor in self.executors.items()}
+
+
+# === MAIN - for test ===
+if __name__ == "__main__":
+    """ Two capture loops, and short feedback jobs in one DSP thread. """
+    import asyncio
+
+    def capture_loop(stop_event):
+        while not stop_event.is_set():
+            time.sleep(0.01)
+
+    def feedback_job():
+        time.sleep(0.005)
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        registry = ExecutorRegistry()
+        stop_event = threading.Event()
+        capture_tasks = [
+            loop.run_in_executor(
+                registry.get_executor("capture-" + str(index)), capture_loop, stop_event
+            )
+            for index in range(2)
+        ]
+        dsp_executor = registry.get_executor("feedback-dsp")
+        for _index in range(20):
+            loop.run_in_executor(dsp_executor, feedback_job)
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+        stop_event.set()
+        await asyncio.gather(*capture_tasks)
+        for name, stats in registry.get_stats().items():
+            print(name, stats)
+        registry.shutdown()
+
+    asyncio.run(main())
@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import asyncio
+import threading
+import time
+
+# CloudedBats.
+import wurb_rec
+
+
+class ThreadToLoopBridge:
+    """Moves items from a capture thread to the asyncio event loop.
+    All items that are ready are delivered with a single wakeup of
+    the event loop. Items are posted to named channels and each channel
+    callback is called once per wakeup with a list of items.
+    If max_batch_latency_s is zero the loop is woken up as soon as
+    possible, otherwise items are collected until the oldest item has
+    waited that long. The capture thread should call poll() regularly,
+    and flush() when done, if a batch latency is used.
+    """
+
+    def __init__(self, main_loop, max_batch_latency_s=0.0):
+        """ """
+        self.main_loop = main_loop
+        self.max_batch_latency_s = max_batch_latency_s
+        self.channels = {}
+        self.lock = threading.Lock()
+        self.pending_items = []
+        self.first_pending_time_s = None
+        self.wakeup_scheduled = False
+        self.dropped_counter = 0
+        self.clear_stats()
+
+    def clear_stats(self):
+        """ """
+        self.wakeup_counter = 0
+        self.item_counter = 0
+        self.delay_sum_s = 0.0
+        self.delay_max_s = 0.0
+        self.stats_time_s = time.monotonic()
+
+    def add_channel(self, name, batch_callback):
+        """The callback is called in the event loop with a list of items."""
+        self.channels[name] = batch_callback
+
+    def add_queue_channel(self, name, queue, queue_policy=None):
+        """Items are put on an asyncio queue. Shared sound blocks
+        are released if the queue is full, or handled by the queue
+        policy if used."""
+
+        def put_items_on_queue(items):
+            for item in items:
+                if queue_policy is not None:
+                    queue_policy.put_nowait(item)
+                    continue
+                if queue.full():
+                    self.dropped_counter += 1
+                    wurb_rec.release_item(item)
+                    continue
+                queue.put_nowait(item)
+
+        self.add_channel(name, put_items_on_queue)
+
+    def add_target_channel(self, name, target):
+        """Items are delivered to the target by add_data_list(), if
+        available, otherwise by add_data() once per item."""
+        if hasattr(target, "add_data_list"):
+            self.add_channel(name, target.add_data_list)
+        else:
+
+            def add_items_to_target(items):
+                for item in items:
+                    target.add_data(item)
+
+            self.add_channel(name, add_items_to_target)
+
+    def post(self, name, item):
+        """Called from the capture thread."""
+        now_s = time.monotonic()
+        with self.lock:
+            self.pending_items.append((name, item, now_s))
+            if self.first_pending_time_s is None:
+                self.first_pending_time_s = now_s
+        self.poll(now_s)
+
+    def poll(self, now_s=None):
+        """Called from the capture thread. Wakes up the loop if due."""
+        if now_s is None:
+            now_s = time.monotonic()
+        with self.lock:
+            if self.wakeup_scheduled or (self.first_pending_time_s is None):
+                return
+            if (now_s - self.first_pending_time_s) < self.max_batch_latency_s:
+                return
+            self.wakeup_scheduled = True
+        self.main_loop.call_soon_threadsafe(self.deliver)
+
+    def flush(self):
+        """Called from the capture thread. Wakes up the loop if needed."""
+        with self.lock:
+            if self.wakeup_scheduled or (self.first_pending_time_s is None):
+                return
+            self.wakeup_scheduled = True
+        self.main_loop.call_soon_threadsafe(self.deliver)
+
+    def deliver(self):
+        """Called in the event loop."""
+        with self.lock:
+            items = self.pending_items
+            self.pending_items = []
+            self.first_pending_time_s = None
+            self.wakeup_scheduled = False
+        if not items:
+            return
+        # Stats.
+        now_s = time.monotonic()
+        self.wakeup_counter += 1
+        self.item_counter += len(items)
+        for _name, _item, post_time_s in items:
+            delay_s = now_s - post_time_s
+            self.delay_sum_s += delay_s
+            if delay_s > self.delay_max_s:
+                self.delay_max_s = delay_s
+        # Group by channel, order is kept within each channel.
+        batches = {}
+        for name, item, _post_time_s in items:
+            batches.setdefault(name, []).append(item)
+        for name, batch in batches.items():
+            batch_callback = self.channels.get(name, None)
+            if batch_callback is not None:
+                try:
+                    batch_callback(batch)
+                except Exception as e:
+                    print("Exception: ThreadToLoopBridge: deliver:", e)
+
+    def get_stats(self, clear=True):
+        """Returns wakeups per second and queueing delay since last call."""
+        elapsed_s = time.monotonic() - self.stats_time_s
+        stats = {
+            "wakeups_per_s": 0.0,
+            "items_per_wakeup": 0.0,
+            "mean_delay_s": 0.0,
+            "max_delay_s": self.delay_max_s,
+        }
+        if elapsed_s > 0.0:
+            stats["wakeups_per_s"] = self.wakeup_counter / elapsed_s
+        if self.wakeup_counter > 0:
+            stats["items_per_wakeup"] = self.item_counter / self.wakeup_counter
+        if self.item_counter > 0:
+            stats["mean_delay_s"] = self.delay_sum_s / self.item_counter
+        if clear:
+            self.clear_stats()
+        return stats
+
+
+# === MAIN - for test ===
+async def main():
+    """ """
+    received = []
+    bridge = ThreadToLoopBridge(
+        asyncio.get_running_loop(), max_batch_latency_s=0.05
+    )
+    bridge.add_channel("test", received.extend)
+
+    def producer():
+        for index in range(200):
+            bridge.post("test", index)
+            time.sleep(0.002)
+        bridge.flush()
+
+    await asyncio.get_running_loop().run_in_executor(None, producer)
+    await asyncio.sleep(0.1)
+    print("Received: ", len(received), "  In order: ", received == list(range(200)))
+    print("Stats: ", bridge.get_stats())
+
+
+if __name__ == "__main__":
+    """ """
+    asyncio.run(main(), debug=True)
@@ -24,8 +24,15 @@ class WurbRecManager(object):
             self.rec_status = "Not started"
             self.notification_event = None
             self.ultrasound_devices = None
-            self.wurb_recorder = None
+            self.wurb_recorder = None  # The first recorder.
+            self.wurb_recorders = []  # One for each microphone.
+            self.wave_writer_executor = None
+            # Named thread pools, one for each role.
+            self.executors = wurb_rec.ExecutorRegistry()
             self.update_status_task = None
+            self.device_watch_task = None
+            self.device_check_pending = False
+            self.device_watch_settle_s = 0.2  # Unit: sec.
 
             self.wurb_rpi = None
             self.wurb_logging = None
@@ -46,7 +53,15 @@ class WurbRecManager(object):
             self.wurb_settings = wurb_rec.WurbSettings(self)
             self.wurb_audiofeedback = wurb_rec.WurbPitchShifting(self)
             self.ultrasound_devices = wurb_rec.UltrasoundDevices(self)
+            self.ultrasound_devices.device_inventory.add_listener(
+                self.request_device_check
+            )
             self.wurb_recorder = wurb_rec.WurbRecorder(self)
+            self.wurb_recorders = [self.wurb_recorder]
+            # File writing, shared by all recorders.
+            self.wave_writer_executor = self.executors.get_executor(
+                "disk-io", max_workers=int(os.getenv("WURB_REC_DISK_IO_THREADS", "2"))
+            )
             self.wurb_gps = wurb_rec.WurbGps(self)
             self.wurb_scheduler = wurb_rec.WurbScheduler(self)
             self.update_status_task = asyncio.create_task(self.update_status())
@@ -66,7 +81,10 @@ class WurbRecManager(object):
     async def shutdown(self):
         """ """
         try:
-            await self.wurb_recorder.stop_streaming(stop_immediate=True)
+            for wurb_recorder in self.wurb_recorders:
+                await wurb_recorder.stop_streaming(stop_immediate=True)
+            if self.ultrasound_devices:
+                await self.ultrasound_devices.shutdown()
 
             if self.wurb_audiofeedback:
                 await self.wurb_audiofeedback.shutdown()
@@ -83,6 +101,11 @@ class WurbRecManager(object):
             if self.update_status_task:
                 self.update_status_task.cancel()
                 self.update_status_task = None
+            if self.device_watch_task:
+                self.device_watch_task.cancel()
+                self.device_watch_task = None
+            self.wave_writer_executor = None
+            self.executors.shutdown()
             if self.wurb_logging:
                 await self.wurb_logging.shutdown()
                 self.wurb_logging = None
@@ -92,34 +115,107 @@ class WurbRecManager(object):
             self.wurb_logging.error(message, short_message=message)
 
     async def start_rec(self):
-        """ """
+        """ All recorders are checked. Recorders for microphones that are
+        gone are stopped and removed before new recorders are created. """
         try:
-            rec_status = await self.wurb_recorder.get_rec_status()
-            if rec_status == "Microphone is on.":
-                return  # Already running.
+            # Running recorders, and recorders waiting for a lost microphone.
+            active_recorders = []
+            restart_needed = False
+            for wurb_recorder in self.wurb_recorders:
+                rec_status = await wurb_recorder.get_rec_status()
+                if rec_status == "Microphone is on.":
+                    active_recorders.append(wurb_recorder)
+                elif rec_status == "Microphone lost.":
+                    # Handled by the device watch. Full restart if not back in time.
+                    lost_s = wurb_recorder.get_device_lost_s()
+                    if lost_s < wurb_recorder.rec_timeout_before_restart_s:
+                        active_recorders.append(wurb_recorder)
+                    else:
+                        restart_needed = True
+            if restart_needed:
+                await self.stop_rec()
+                active_recorders = []
 
             # await self.ultrasound_devices.stop_checking_devices()
             await self.ultrasound_devices.check_devices()
 
-            device_name = self.ultrasound_devices.device_name
-            card_index = self.ultrasound_devices.card_index
-            sampling_freq_hz = self.ultrasound_devices.sampling_freq_hz
-            if (len(device_name) > 1) and sampling_freq_hz > 0:
-                # Audio feedback.
-                await self.wurb_audiofeedback.set_sampling_freq(
-                    sampling_freq=sampling_freq_hz
-                )
-                await self.wurb_audiofeedback.startup()
-                # Rec.
+            device_list = []
+            for device_dict in self.ultrasound_devices.device_list:
+                device_name = device_dict["device_name"]
+                sampling_freq_hz = device_dict["sampling_freq_hz"]
+                if (len(device_name) > 1) and sampling_freq_hz > 0:
+                    device_list.append(device_dict)
+            # Microphones already used. Running recorders for microphones
+            # that are gone are stopped.
+            drain_timeout_s = float(os.getenv("WURB_REC_DRAIN_TIMEOUT_S", "5.0"))
+            free_devices = list(device_list)
+            for wurb_recorder in list(active_recorders):
+                same_card = not wurb_recorder.is_device_lost()
+                device_dict = wurb_recorder.find_device(free_devices, same_card)
+                if device_dict:
+                    free_devices.remove(device_dict)
+                elif not wurb_recorder.is_device_lost():
+                    await wurb_recorder.set_rec_status("")
+                    await wurb_recorder.drain_streaming(drain_timeout_s)
+                    active_recorders.remove(wurb_recorder)
+            # Unused recorders, the first recorder is always kept.
+            idle_recorders = [
+                wurb_recorder
+                for wurb_recorder in self.wurb_recorders
+                if wurb_recorder not in active_recorders
+            ]
+            for wurb_recorder in idle_recorders[len(free_devices) :]:
+                if wurb_recorder is self.wurb_recorder:
+                    continue
+                wurb_recorder.clear_device_lost()
+                await wurb_recorder.set_rec_status("")
+                await wurb_recorder.drain_streaming(drain_timeout_s)
+                self.wurb_recorders.remove(wurb_recorder)
+            idle_recorders = idle_recorders[: len(free_devices)]
+            if active_recorders and (not free_devices):
+                return  # Already running.
+            if free_devices:
+                # Rec. One recorder for each microphone.
                 self.manual_trigger_activated = False
-                await self.wurb_recorder.set_device(
-                    device_name, card_index, sampling_freq_hz
-                )
-                await self.wurb_recorder.start_streaming()
+                while len(idle_recorders) < len(free_devices):
+                    used_numbers = [
+                        wurb_recorder.device_number
+                        for wurb_recorder in self.wurb_recorders
+                    ]
+                    device_number = 1
+                    while device_number in used_numbers:
+                        device_number += 1
+                    wurb_recorder = wurb_rec.WurbRecorder(
+                        self, device_number=device_number
+                    )
+                    self.wurb_recorders.append(wurb_recorder)
+                    idle_recorders.append(wurb_recorder)
+                if self.wurb_recorder in idle_recorders:
+                    # Audio feedback, connected to the first microphone.
+                    await self.wurb_audiofeedback.set_sampling_freq(
+                        sampling_freq=free_devices[0]["sampling_freq_hz"]
+                    )
+                    await self.wurb_audiofeedback.startup()
+                no_of_recorders = len(active_recorders) + len(free_devices)
+                for wurb_recorder, device_dict in zip(idle_recorders, free_devices):
+                    # Different filename prefixes if more than one microphone.
+                    wurb_recorder.filename_prefix_suffix = ""
+                    if no_of_recorders > 1:
+                        wurb_recorder.filename_prefix_suffix = "-Mic" + str(
+                            wurb_recorder.device_number
+                        )
+                    await wurb_recorder.set_device(
+                        device_dict["device_name"],
+                        device_dict["card_index"],
+                        device_dict["sampling_freq_hz"],
+                    )
+                    await wurb_recorder.start_streaming()
                 # Logging.
                 message = "Rec. started."
+                if no_of_recorders > 1:
+                    message = "Rec. started. Microphones: " + str(no_of_recorders)
                 self.wurb_logging.info(message, short_message=message)
-            else:
+            elif not active_recorders:
                 await self.wurb_recorder.set_rec_status("Failed: No valid microphone.")
                 # Logging.
                 message = "Failed: No valid microphone."
@@ -138,11 +234,24 @@ class WurbRecManager(object):
                 message = "Rec. stopped."
                 self.wurb_logging.info(message, short_message=message)
 
+            # Device watch.
+            if self.device_watch_task:
+                self.device_watch_task.cancel()
+                self.device_watch_task = None
             # Audio feedback.
             await self.wurb_audiofeedback.shutdown()
-            # Rec.
-            await self.wurb_recorder.set_rec_status("")
-            await self.wurb_recorder.stop_streaming(stop_immediate=True)
+            # Rec. Blocks in flight are written and files closed, within
+            # the drain timeout.
+            drain_timeout_s = float(os.getenv("WURB_REC_DRAIN_TIMEOUT_S", "5.0"))
+            for wurb_recorder in self.wurb_recorders:
+                wurb_recorder.clear_device_lost()
+                await wurb_recorder.set_rec_status("")
+            await asyncio.gather(
+                *[
+                    wurb_recorder.drain_streaming(drain_timeout_s)
+                    for wurb_recorder in self.wurb_recorders
+                ]
+            )
             await self.ultrasound_devices.reset_devices()
         except Exception as e:
             # Logging error.
@@ -157,6 +266,8 @@ class WurbRecManager(object):
                 # Logging.
                 # message = "Rec. restart initiated."
                 # self.wurb_logging.info(message, short_message=message)
+                for wurb_recorder in self.wurb_recorders:
+                    wurb_recorder.pipeline_stats.restart_counter += 1
                 await self.stop_rec()
                 await asyncio.sleep(1.0)
                 await self.start_rec()
@@ -165,6 +276,55 @@ class WurbRecManager(object):
             message = "Manager: restart_rec: " + str(e)
             self.wurb_logging.error(message, short_message=message)
 
+    def request_device_check(self):
+        """ Called for hotplug events and when a capture ends by itself.
+        Events during a running check will cause a new check. """
+        self.device_check_pending = True
+        if (self.device_watch_task is None) or self.device_watch_task.done():
+            self.device_watch_task = asyncio.create_task(self.device_watch_worker())
+
+    async def device_watch_worker(self):
+        """ Stops recorders where the microphone is lost and resumes them
+        when it is back. Other recorders are not affected. """
+        try:
+            while self.device_check_pending:
+                self.device_check_pending = False
+                # Permissions are set by udev shortly after the node is created.
+                await asyncio.sleep(self.device_watch_settle_s)
+                watched_recorders = [
+                    wurb_recorder
+                    for wurb_recorder in self.wurb_recorders
+                    if wurb_recorder.is_hardware_device()
+                    and (wurb_recorder.is_streaming() or wurb_recorder.is_device_lost())
+                ]
+                if not watched_recorders:
+                    continue
+                await self.ultrasound_devices.check_devices()
+                device_list = list(self.ultrasound_devices.device_list)
+                # Running recorders.
+                for wurb_recorder in watched_recorders:
+                    if wurb_recorder.is_device_lost():
+                        continue
+                    device_dict = wurb_recorder.find_device(device_list, same_card=True)
+                    if device_dict and wurb_recorder.is_capture_running():
+                        device_list.remove(device_dict)
+                    else:
+                        await wurb_recorder.stop_lost_device()
+                # Lost recorders, resumed if the same kind of microphone is found.
+                for wurb_recorder in watched_recorders:
+                    if not wurb_recorder.is_device_lost():
+                        continue
+                    device_dict = wurb_recorder.find_device(device_list)
+                    if device_dict:
+                        device_list.remove(device_dict)
+                        await wurb_recorder.resume_lost_device(device_dict)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            # Logging error.
+            message = "Manager: device_watch_worker: " + str(e)
+            self.wurb_logging.error(message, short_message=message)
+
     async def get_notification_event(self):
         """ """
         try:
@@ -184,11 +344,15 @@ class WurbRecManager(object):
             device_name = device_name.replace("USB Ultrasound Microphone", "")
             if len(device_name) > 25:
                 device_name = device_name[:24] + "..."
+            no_of_devices = len(self.ultrasound_devices.device_list)
+            if no_of_devices > 1:
+                device_name += " (+" + str(no_of_devices - 1) + ")"
             status_dict = {
                 "rec_status": self.wurb_recorder.rec_status,
                 "device_name": device_name,
                 "sample_rate": str(self.ultrasound_devices.sampling_freq_hz),
             }
+            status_dict.update(self.wurb_recorder.get_noise_floor_status())
             return status_dict
         except Exception as e:
             # Logging error.
@@ -203,7 +367,6 @@ class WurbRecManager(object):
                     device_notification = (
                         await self.ultrasound_devices.get_notification_event()
                     )
-                    rec_notification = await self.wurb_recorder.get_notification_event()
                     # events = [
                     #     device_notification.wait(),
                     #     rec_notification.wait(),
@@ -213,13 +376,17 @@ class WurbRecManager(object):
                     task_1 = asyncio.create_task(
                         device_notification.wait(), name="rec-settings-event"
                     )
-                    task_2 = asyncio.create_task(
-                        rec_notification.wait(), name="rec-location-event"
-                    )
                     events = [
                         task_1,
-                        task_2,
                     ]
+                    # One event for each recorder.
+                    for wurb_recorder in self.wurb_recorders:
+                        rec_notification = await wurb_recorder.get_notification_event()
+                        events.append(
+                            asyncio.create_task(
+                                rec_notification.wait(), name="rec-location-event"
+                            )
+                        )
                     done, pending = await asyncio.wait(
                         events, return_when=asyncio.FIRST_COMPLETED
                     )
@@ -245,6 +412,76 @@ class WurbRecManager(object):
             message = "Manager update_status terminated."
             self.wurb_logging.debug(message=message)
 
+    async def get_device_stats(self):
+        """ CPU load and dropped blocks for each microphone. """
+        try:
+            device_stats = []
+            for wurb_recorder in self.wurb_recorders:
+                if wurb_recorder.device_name:
+                    device_stats.append(wurb_recorder.get_device_stats())
+            return device_stats
+        except Exception as e:
+            # Logging error.
+            message = "Manager: get_device_stats: " + str(e)
+            self.wurb_logging.error(message, short_message=message)
+
+    async def get_pipeline_stats(self):
+        """ Snapshot of latencies, queue depths and counters for each
+        recorder. Nothing is calculated in the pipelines for this. """
+        try:
+            pipeline_stats = []
+            for wurb_recorder in self.wurb_recorders:
+                if wurb_recorder.device_name:
+                    pipeline_stats.append(wurb_recorder.get_pipeline_stats())
+            return pipeline_stats
+        except Exception as e:
+            # Logging error.
+            message = "Manager: get_pipeline_stats: " + str(e)
+            self.wurb_logging.error(message, short_message=message)
+
+    async def get_detection_algorithms(self):
+        """Detection algorithms and the expected CPU load for the connected
+        microphone. The declared cost is adjusted by the measured cost when
+        the detection has been running for a while."""
+        try:
+            sampling_freq_hz = 0
+            channels = 1
+            cpu_factor = float(os.getenv("WURB_REC_DETECTION_CPU_FACTOR", "1.0"))
+            for wurb_recorder in self.wurb_recorders:
+                if wurb_recorder.device_name:
+                    sampling_freq_hz = wurb_recorder.sampling_freq_hz
+                    channels = wurb_recorder.channels
+                    cpu_factor = wurb_recorder.get_detection_cpu_factor(cpu_factor)
+                    break
+            cpu_limit_percent = float(
+                os.getenv("WURB_REC_DETECTION_CPU_LIMIT_PERCENT", "50.0")
+            )
+            algorithm_list = wurb_rec.detection_algorithms.get_algorithm_list(
+                sampling_freq_hz, channels, cpu_factor, cpu_limit_percent
+            )
+            return {
+                "sampling_freq_hz": sampling_freq_hz,
+                "cpu_factor": round(cpu_factor, 2),
+                "cpu_limit_percent": cpu_limit_percent,
+                "selected_algorithm": self.wurb_settings.get_setting(
+                    "detection_algorithm"
+                ),
+                "algorithms": algorithm_list,
+            }
+        except Exception as e:
+            # Logging error.
+            message = "Manager: get_detection_algorithms: " + str(e)
+            self.wurb_logging.error(message, short_message=message)
+
+    async def get_executor_stats(self):
+        """ Queue depth and busy time for each named thread pool. """
+        try:
+            return self.executors.get_stats()
+        except Exception as e:
+            # Logging error.
+            message = "Manager: get_executor_stats: " + str(e)
+            self.wurb_logging.error(message, short_message=message)
+
     async def manual_trigger(self):
         """ """
         # Will be checked and resetted in wurb_sound_detection.py
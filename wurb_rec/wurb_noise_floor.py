@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import numpy as np
+
+
+class NoiseFloor:
+    """Running noise floor for each frequency bin, used together with the
+    fixed threshold in the detection. The floor is a low percentile of
+    the band power in every few frames of each block. It follows lower
+    values at once and higher values slowly. Bat calls have gaps between
+    them and do not raise it, also CF calls with a high duty cycle, but
+    constant noise from insects or pingers from other detectors does, in
+    a few seconds. The floor is not raised more than max_above_quiet_db
+    above the quiet bins in the block, so sounds far above the noise, 45
+    dB with the default values, are always used.
+    Frames must be above the floor by a margin in some bin.
+    Modes: "off" or "on".
+    """
+
+    def __init__(
+        self,
+        mode="off",
+        margin_db=25.0,
+        percentile=10.0,
+        frame_step=4,
+        rise_db_per_s=6.0,
+        max_above_quiet_db=30.0,
+    ):
+        """ Not capped if max_above_quiet_db is None. """
+        self.mode = mode
+        # The 10th percentile of noise is 10 dB below the mean, the limit
+        # is 15 dB above the mean. Seldom reached by noise in any bin.
+        self.margin_db = margin_db
+        self.percentile = percentile
+        self.frame_step = frame_step  # Every n:th frame is used.
+        self.rise_db_per_s = rise_db_per_s
+        self.max_above_quiet_db = max_above_quiet_db
+        self.margin_factor = np.float32(10 ** (margin_db / 10))
+        self.max_above_quiet_factor = None
+        if max_above_quiet_db is not None:
+            self.max_above_quiet_factor = np.float32(10 ** (max_above_quiet_db / 10))
+        self.band_freqs_hz = np.zeros(0)
+        self.window_function_dbfs_max = 1.0
+        self.min_power = 0.0
+        self.clear()
+
+    def clear(self):
+        """ """
+        self.floor = None
+        # Counters.
+        self.updated_blocks = 0
+        self.suppressed_frames = 0
+        self.suppressed_triggers = 0
+
+    def is_used(self):
+        """ """
+        return self.mode == "on"
+
+    def config(self, band_freqs_hz, window_function_dbfs_max, min_power):
+        """ Frequencies for the bins in the band power, and the scale
+        used for dBFS in the detection. """
+        self.band_freqs_hz = band_freqs_hz
+        self.window_function_dbfs_max = window_function_dbfs_max
+        self.min_power = min_power
+        self.floor = None
+
+    def update(self, band_power, block_s):
+        """Band power for the used frames, every frame_step frame in the
+        block. Returns the floor for this block, the lower of the earlier
+        floor and the updated floor. Sound in this block, for example a
+        bat with long CF calls, does not raise it. Blocks can be skipped,
+        the floor is only raised by the time for the updated blocks."""
+        if (len(band_power) == 0) or (band_power.shape[1] == 0):
+            return self.floor
+        # Partition is faster than np.percentile, no interpolation needed.
+        kth = int(round(self.percentile / 100 * (len(band_power) - 1)))
+        block_floor = np.partition(band_power, kth, axis=0)[kth]
+        block_floor = np.maximum(block_floor, self.min_power).astype(np.float32)
+        if self.max_above_quiet_factor is not None:
+            # Not more than max_above_quiet_db above the median of the bins.
+            middle = len(block_floor) // 2
+            quiet_power = np.partition(block_floor, middle)[middle]
+            block_floor = np.minimum(
+                block_floor, quiet_power * self.max_above_quiet_factor
+            )
+        if (self.floor is None) or (len(self.floor) != len(block_floor)):
+            self.floor = block_floor
+        earlier_floor = self.floor
+        # Down at once, up slowly.
+        rise_factor = np.float32(10 ** (self.rise_db_per_s * block_s / 10))
+        self.floor = np.minimum(block_floor, earlier_floor * rise_factor)
+        self.updated_blocks += 1
+        return np.minimum(earlier_floor, self.floor)
+
+    def get_limit(self, floor, min_power):
+        """ Power for each bin, floor and margin, not below min_power. """
+        return np.maximum(floor * self.margin_factor, np.float32(min_power))
+
+    def add_suppressed(self, frames, triggers=0):
+        """ Frames above threshold, but not above the floor. Triggers
+        that would have been made without the floor. """
+        self.suppressed_frames += frames
+        self.suppressed_triggers += triggers
+
+    def get_floor_dbfs(self):
+        """ dBFS for each bin, same scale as the detection threshold. """
+        if self.floor is None:
+            return None
+        floor_power = np.maximum(self.floor, 1e-30)
+        return 10 * np.log10(floor_power) - 20 * np.log10(
+            self.window_function_dbfs_max
+        )
+
+    def get_stats(self):
+        """ The floor as max and median dBFS, and max dBFS for each 10 kHz
+        band. """
+        stats = {
+            "noise_floor_mode": self.mode,
+            "noise_floor_margin_db": self.margin_db,
+            "noise_floor_max_above_quiet_db": self.max_above_quiet_db,
+            "noise_floor_blocks": self.updated_blocks,
+            "suppressed_frames": self.suppressed_frames,
+            "suppressed_triggers": self.suppressed_triggers,
+        }
+        floor_dbfs = self.get_floor_dbfs()
+        if (floor_dbfs is None) or (len(floor_dbfs) != len(self.band_freqs_hz)):
+            return stats
+        if len(floor_dbfs) == 0:
+            return stats
+        peak_index = int(floor_dbfs.argmax())
+        stats["noise_floor_max_dbfs"] = round(float(floor_dbfs[peak_index]), 1)
+        stats["noise_floor_max_khz"] = round(
+            float(self.band_freqs_hz[peak_index]) / 1000, 1
+        )
+        stats["noise_floor_median_dbfs"] = round(float(np.median(floor_dbfs)), 1)
+        band_khz = (self.band_freqs_hz // 10000).astype(int) * 10
+        stats["noise_floor_bands_dbfs"] = [
+            [int(khz), round(float(floor_dbfs[band_khz == khz].max()), 1)]
+            for khz in np.unique(band_khz)
+        ]
+        return stats
+
+
+# === MAIN - for test ===
+if __name__ == "__main__":
+    """Floor for white noise, and after a constant tone is started. A CF
+    bat with 83% duty cycle, and a loud constant tone, are not suppressed."""
+    rng = np.random.default_rng(1)
+    number_of_bins = 100
+    noise_floor = NoiseFloor("on")
+    noise_floor.config(np.arange(number_of_bins) * 1000.0 + 15000.0, 1.0, 1e-18)
+    # Calls in 10 of 12 frames, 50 ms calls and 10 ms gaps.
+    cf_frames = (np.arange(48) % 12) < 10
+    for block_index in range(20):
+        band_power = rng.exponential(1.0, (48, number_of_bins)).astype(np.float32)
+        if block_index >= 10:
+            band_power[:, 50] += 1000.0  # Constant tone at 65 kHz.
+            band_power[cf_frames, 68] += 1000.0  # CF bat at 83 kHz.
+            band_power[:, 90] += 100000.0  # Loud constant tone at 105 kHz.
+        floor = noise_floor.update(band_power, 0.5)
+        limit = noise_floor.get_limit(floor, 0.0)
+        passed = band_power >= limit
+        print(
+            "Block: ",
+            block_index,
+            " Floor at 65 kHz, dB: ",
+            round(float(10 * np.log10(floor[50])), 1),
+            " Frames above floor at 65, 83, 105 kHz: ",
+            np.count_nonzero(passed[:, 50]),
+            np.count_nonzero(passed[:, 68]),
+            np.count_nonzero(passed[:, 90]),
+        )
+    cf_passed = np.count_nonzero(passed[cf_frames, 68])
+    print("CF bat, last block, frames above floor: ", cf_passed, "of 40")
+    print(noise_floor.get_stats())
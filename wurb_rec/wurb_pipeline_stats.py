@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import time
+import math
+
+
+class LatencyHistogram:
+    """Histogram with logarithmic buckets, used for latency percentiles.
+    Memory and time per value are constant, it can be used all night.
+    Percentiles are returned as the upper limit of the bucket, with
+    a resolution of about 25 percent.
+    """
+
+    def __init__(self, min_value_s=0.0001, max_value_s=1000.0, buckets_per_decade=10):
+        """ """
+        self.min_value_s = min_value_s
+        self.buckets_per_decade = buckets_per_decade
+        decades = math.log10(max_value_s / min_value_s)
+        self.number_of_buckets = int(math.ceil(decades * buckets_per_decade)) + 1
+        self.clear()
+
+    def clear(self):
+        """ """
+        self.bucket_counts = [0] * self.number_of_buckets
+        self.counter = 0
+        self.sum_s = 0.0
+        self.max_s = 0.0
+
+    def add(self, value_s):
+        """ """
+        if value_s <= self.min_value_s:
+            index = 0
+        else:
+            index = int(
+                math.ceil(math.log10(value_s / self.min_value_s) * self.buckets_per_decade)
+            )
+            index = min(index, self.number_of_buckets - 1)
+        self.bucket_counts[index] += 1
+        self.counter += 1
+        self.sum_s += value_s
+        if value_s > self.max_s:
+            self.max_s = value_s
+
+    def get_percentile(self, percent):
+        """ """
+        if self.counter == 0:
+            return 0.0
+        limit = self.counter * percent / 100.0
+        accumulated = 0
+        for index, count in enumerate(self.bucket_counts):
+            accumulated += count
+            if accumulated >= limit:
+                upper_s = self.min_value_s * 10.0 ** (index / self.buckets_per_decade)
+                return min(upper_s, self.max_s)
+        return self.max_s
+
+    def get_stats(self):
+        """ Unit: sec. """
+        mean_s = self.sum_s / self.counter if self.counter else 0.0
+        return {
+            "count": self.counter,
+            "mean_s": round(mean_s, 4),
+            "p50_s": round(self.get_percentile(50), 4),
+            "p90_s": round(self.get_percentile(90), 4),
+            "p99_s": round(self.get_percentile(99), 4),
+            "max_s": round(self.max_s, 4),
+        }
+
+
+class PipelineStats:
+    """Counters and latencies for one sound stream pipeline:
+    Source ---> Queue ---> Process ---> Queue ---> Target
+    Updated by the workers, one call per block. The snapshot is taken
+    when requested, without any work in the pipeline.
+    """
+
+    def __init__(self):
+        """ """
+        self.clear()
+
+    def clear(self):
+        """ """
+        self.start_time_s = time.time()
+        # Counters.
+        self.processed_blocks = 0
+        self.written_blocks = 0
+        self.flush_counter = 0
+        self.restart_counter = 0
+        # Sample index in the stream for the first frame that triggered.
+        self.trigger_counter = 0
+        self.last_trigger_sample_index = None
+        # Drain when stopped.
+        self.drain_counter = 0
+        self.last_drain_s = 0.0
+        self.drain_discarded_s = 0.0
+        # Queue depth, last and max, for each queue.
+        self.queue_depth = {}
+        self.queue_depth_max = {}
+        # Time per block.
+        self.detection_time = LatencyHistogram()
+        self.write_time = LatencyHistogram()
+        # From end of the block at the ADC.
+        self.detection_latency = LatencyHistogram()
+        self.disk_latency = LatencyHistogram()
+
+    def add_queue_depth(self, queue_name, depth):
+        """ """
+        self.queue_depth[queue_name] = depth
+        self.queue_depth_max[queue_name] = max(
+            depth, self.queue_depth_max.get(queue_name, 0)
+        )
+
+    def add_detection(self, detection_s, block_end_time):
+        """ Called in the process worker for each block. """
+        self.processed_blocks += 1
+        self.detection_time.add(detection_s)
+        # Small negative values are possible after clock corrections.
+        self.detection_latency.add(max(0.0, time.time() - block_end_time))
+
+    def add_trigger(self, trigger_sample_index):
+        """ Called when a detection starts. """
+        self.trigger_counter += 1
+        self.last_trigger_sample_index = trigger_sample_index
+
+    def add_write(self, write_s, block_end_time):
+        """ Called in the target worker for each block written to disk. """
+        self.written_blocks += 1
+        self.write_time.add(write_s)
+        self.disk_latency.add(max(0.0, time.time() - block_end_time))
+
+    def get_snapshot(self):
+        """ """
+        return {
+            "elapsed_s": round(time.time() - self.start_time_s, 1),
+            "processed_blocks": self.processed_blocks,
+            "written_blocks": self.written_blocks,
+            "flushes": self.flush_counter,
+            "restarts": self.restart_counter,
+            "triggers": self.trigger_counter,
+            "last_trigger_sample_index": self.last_trigger_sample_index,
+            "drains": self.drain_counter,
+            "last_drain_s": round(self.last_drain_s, 3),
+            "drain_discarded_s": round(self.drain_discarded_s, 3),
+            "queue_depth": dict(self.queue_depth),
+            "queue_depth_max": dict(self.queue_depth_max),
+            "detection_time": self.detection_time.get_stats(),
+            "write_time": self.write_time.get_stats(),
+            "capture_to_detection_latency": self.detection_latency.get_stats(),
+            "capture_to_disk_latency": self.disk_latency.get_stats(),
+        }
+
+
+# === MAIN - for test ===
+if __name__ == "__main__":
+    """ """
+    import random
+
+    histogram = LatencyHistogram()
+    values = [random.lognormvariate(math.log(0.02), 0.5) for _ in range(100000)]
+    start_time_s = time.perf_counter()
+    for value in values:
+        histogram.add(value)
+    add_us = (time.perf_counter() - start_time_s) / len(values) * 1000000
+    values.sort()
+    print("Histogram: ", histogram.get_stats())
+    print(
+        "Exact: p50 ",
+        round(values[50000], 4),
+        " p90 ",
+        round(values[90000], 4),
+        " p99 ",
+        round(values[99000], 4),
+    )
+    print("Time per value, us: ", round(add_us, 2))
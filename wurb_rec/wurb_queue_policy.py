@@ -0,0 +1,425 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import os
+import asyncio
+import time
+import tempfile
+import pathlib
+import itertools
+import numpy
+import logging
+from collections import deque
+
+# CloudedBats.
+import wurb_rec
+
+
+class QueuePolicy:
+    """Overflow handling for an asyncio queue with sound blocks.
+    Policies used when the queue is full:
+    - "block": put() waits until there is room. Items from put_nowait(),
+      called by capture threads that can not wait, are kept in memory
+      meanwhile, up to the size of the queue. When that overflow also is
+      full they are dropped, counted as "overflow_full_items".
+    - "drop-newest": The new item is dropped.
+    - "drop-oldest": The oldest item in the queue is dropped.
+    - "spill-to-disk": Items are written to files and put back on the
+      queue, in order, when there is room.
+    Dropped items are counted, both as items and as audio seconds. The
+    dropped time is added as "gap_before_s" to the block after the gap,
+    also the new file and close file flags in the dropped blocks. For
+    items dropped at the head of the queue this is done in get(), used
+    by the consumer.
+    The terminate and flush sentinels are put with put_sentinel(), after
+    the items in overflow. Flush discards the items in overflow. They are
+    never dropped or moved.
+    """
+
+    policy_names = ["block", "drop-newest", "drop-oldest", "spill-to-disk"]
+    spill_file_counter = itertools.count()
+
+    def __init__(
+        self, queue, policy_name="drop-newest", sampling_freq_hz=0, executor=None
+    ):
+        """ Spill files are written and read in executor, default pool
+        if None. """
+        self.queue = queue
+        if policy_name not in self.policy_names:
+            policy_name = "drop-newest"
+        self.policy_name = policy_name
+        self.sampling_freq_hz = sampling_freq_hz
+        self.logger = logging.getLogger("CloudedBats-WURB")
+        self.overflow = deque()  # Entries: [item, spill file path or None].
+        self.overflow_task = None
+        self.overflow_empty_event = asyncio.Event()
+        self.overflow_empty_event.set()
+        self.executor = executor
+        # Gap for the next accepted item, and for the next item in get().
+        self.pending_gap_s = 0.0
+        self.pending_flags = wurb_rec.BlockFlags(0)
+        self.pending_peak = (None, None)
+        self.head_gap_s = 0.0
+        self.head_flags = wurb_rec.BlockFlags(0)
+        self.head_peak = (None, None)
+        # Counters.
+        self.dropped_items = 0
+        self.dropped_s = 0.0
+        self.blocked_s = 0.0
+        self.overflow_full_items = 0
+        self.spilled_items = 0
+        self.spill_bytes = 0
+        # Config.
+        self.max_overflow_items = max(1, queue.maxsize)  # For "block".
+        self.max_spill_bytes = 512 * 1024 * 1024
+        self.spill_dir_path = pathlib.Path(tempfile.gettempdir(), "wurb_spill")
+        self.spill_poll_s = 0.05  # Unit: sec.
+
+    def drop(self, item, at_head=False):
+        """ The gap is added to the next accepted item, or to the next item
+        in get() if dropped at the head of the queue. """
+        self.dropped_items += 1
+        item_s = item.get_duration_s(self.sampling_freq_hz)
+        self.dropped_s += item_s
+        # Gaps before the dropped item are moved to the next item.
+        gap_s = item_s + item.gap_before_s
+        item.gap_before_s = 0.0
+        if at_head:
+            self.head_gap_s += gap_s
+            self.head_flags, self.head_peak = self.carry_flags(
+                item, self.head_flags, self.head_peak
+            )
+        else:
+            self.pending_gap_s += gap_s
+            self.pending_flags, self.pending_peak = self.carry_flags(
+                item, self.pending_flags, self.pending_peak
+            )
+        item.release()
+
+    def carry_flags(self, item, flags, peak):
+        """A dropped new file is started at the next item. For a dropped
+        close file, the file is closed before the next item, and a new
+        file in the same gap is not needed. Returns (flags, peak)."""
+        if item.flags & wurb_rec.BlockFlags.CLOSE_BEFORE:
+            flags |= wurb_rec.BlockFlags.CLOSE_BEFORE
+        if item.flags & wurb_rec.BlockFlags.NEW_FILE:
+            flags |= wurb_rec.BlockFlags.NEW_FILE
+            peak = (item.max_peak_freq_hz, item.max_peak_dbfs)
+        if item.flags & wurb_rec.BlockFlags.CLOSE_FILE:
+            flags &= ~wurb_rec.BlockFlags.NEW_FILE
+            flags |= wurb_rec.BlockFlags.CLOSE_BEFORE
+        return flags, peak
+
+    def apply_gap(self, item, gap_s, flags, peak):
+        """ """
+        item.gap_before_s += gap_s
+        if (flags & wurb_rec.BlockFlags.NEW_FILE) and not (
+            item.flags & wurb_rec.BlockFlags.NEW_FILE
+        ):
+            item.flags |= wurb_rec.BlockFlags.NEW_FILE
+            item.max_peak_freq_hz, item.max_peak_dbfs = peak
+        if flags & wurb_rec.BlockFlags.CLOSE_BEFORE:
+            item.flags |= wurb_rec.BlockFlags.CLOSE_BEFORE
+
+    def add_gap(self, item):
+        """ The dropped time and flags are stored in the next accepted item. """
+        if (self.pending_gap_s > 0.0) or self.pending_flags:
+            self.apply_gap(
+                item, self.pending_gap_s, self.pending_flags, self.pending_peak
+            )
+            self.pending_gap_s = 0.0
+            self.pending_flags = wurb_rec.BlockFlags(0)
+        return item
+
+    async def get(self):
+        """Used by the consumer. Items dropped at the head of the queue
+        are added as a gap to the next item. A gap before terminate or
+        flush is not used, the items after them are not continued."""
+        item = await self.queue.get()
+        if (self.head_gap_s > 0.0) or self.head_flags:
+            if isinstance(item, wurb_rec.AudioBlock):
+                self.apply_gap(item, self.head_gap_s, self.head_flags, self.head_peak)
+            self.head_gap_s = 0.0
+            self.head_flags = wurb_rec.BlockFlags(0)
+        return item
+
+    def put_nowait(self, item):
+        """ Called in the event loop, never waits. Returns False if dropped. """
+        if self.overflow:
+            # Items waiting in overflow must be delivered first.
+            return self.add_to_overflow(item)
+        if not self.queue.full():
+            self.queue.put_nowait(self.add_gap(item))
+            return True
+        if self.policy_name == "drop-oldest":
+            return self.replace_oldest(item)
+        if self.policy_name in ["block", "spill-to-disk"]:
+            return self.add_to_overflow(item)
+        self.drop(item)
+        return False
+
+    async def put(self, item):
+        """ Waits for room if the policy is "block". Returns False if dropped. """
+        if self.policy_name == "block":
+            if self.queue.full() or self.overflow:
+                start_time_s = time.monotonic()
+                # Items waiting in overflow must be delivered first.
+                while self.overflow:
+                    await self.overflow_empty_event.wait()
+                await self.queue.put(self.add_gap(item))
+                self.blocked_s += time.monotonic() - start_time_s
+            else:
+                self.queue.put_nowait(self.add_gap(item))
+            return True
+        return self.put_nowait(item)
+
+    async def put_sentinel(self, sentinel):
+        """Terminate or flush. Delivered after the items in overflow, they
+        are never dropped. Flush discards the items in overflow first."""
+        if sentinel is wurb_rec.FLUSH:
+            self.release_overflow(count_as_dropped=False)
+        if self.overflow:
+            self.append_to_overflow([sentinel, None])
+        else:
+            await self.queue.put(sentinel)
+
+    def replace_oldest(self, item):
+        """ """
+        oldest = self.queue.get_nowait()
+        self.queue.task_done()
+        if isinstance(oldest, wurb_rec.AudioBlock):
+            # The gap is before the item that now is first in the queue.
+            self.drop(oldest, at_head=True)
+            self.queue.put_nowait(self.add_gap(item))
+            return True
+        # Terminate or flush first, they must be kept in front. Seldom,
+        # all items are taken out and put back in the same order, without
+        # the oldest block. A gap before terminate or flush is not used.
+        self.head_gap_s = 0.0
+        self.head_flags = wurb_rec.BlockFlags(0)
+        items = [oldest]
+        while not self.queue.empty():
+            items.append(self.queue.get_nowait())
+            self.queue.task_done()
+        is_dropped = False
+        for index, queued_item in enumerate(items):
+            if is_dropped:
+                self.queue.put_nowait(queued_item)
+            elif isinstance(queued_item, wurb_rec.AudioBlock):
+                self.drop(queued_item, at_head=True)
+                is_dropped = True
+                # The gap is before the next block.
+                for next_item in items[index + 1 :]:
+                    if isinstance(next_item, wurb_rec.AudioBlock):
+                        self.apply_gap(
+                            next_item, self.head_gap_s, self.head_flags, self.head_peak
+                        )
+                        self.head_gap_s = 0.0
+                        self.head_flags = wurb_rec.BlockFlags(0)
+                        break
+            else:
+                self.queue.put_nowait(queued_item)
+        if not is_dropped:
+            # Only terminate or flush in the queue.
+            self.drop(item)
+            return False
+        if (self.head_gap_s > 0.0) or self.head_flags:
+            # No block after the dropped one, the gap is before the new item.
+            self.apply_gap(item, self.head_gap_s, self.head_flags, self.head_peak)
+            self.head_gap_s = 0.0
+            self.head_flags = wurb_rec.BlockFlags(0)
+        self.queue.put_nowait(self.add_gap(item))
+        return True
+
+    def add_to_overflow(self, item):
+        """ """
+        if self.policy_name == "spill-to-disk":
+            is_full = self.spill_bytes >= self.max_spill_bytes
+        else:
+            is_full = len(self.overflow) >= self.max_overflow_items
+        if is_full:
+            if self.policy_name == "block":
+                self.overflow_full_items += 1
+            self.drop(item)
+            return False
+        self.append_to_overflow([self.add_gap(item), None])
+        return True
+
+    def append_to_overflow(self, entry):
+        """ """
+        self.overflow.append(entry)
+        self.overflow_empty_event.clear()
+        if (self.overflow_task is None) or self.overflow_task.done():
+            self.overflow_task = asyncio.create_task(self.overflow_worker())
+
+    async def overflow_worker(self):
+        """ Moves items from overflow to the queue, in order. """
+        main_loop = asyncio.get_running_loop()
+        try:
+            while self.overflow:
+                entry = self.overflow[0]
+                if self.queue.full() and (self.policy_name == "spill-to-disk"):
+                    # Items still in memory are written to disk, oldest first.
+                    for entry in self.overflow:
+                        is_block = isinstance(entry[0], wurb_rec.AudioBlock)
+                        if is_block and (entry[1] is None):
+                            await main_loop.run_in_executor(
+                                self.executor, self.write_spill_file, entry
+                            )
+                            break
+                    else:
+                        await asyncio.sleep(self.spill_poll_s)
+                    continue
+                item = entry[0]
+                if entry[1] is not None:
+                    item = await main_loop.run_in_executor(
+                        self.executor, self.read_spill_file, entry
+                    )
+                start_time_s = time.monotonic()
+                await self.queue.put(item)
+                self.blocked_s += time.monotonic() - start_time_s
+                self.overflow.popleft()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.logger.debug("Queue policy, overflow: " + str(e))
+        finally:
+            if not self.overflow:
+                self.overflow_empty_event.set()
+
+    def write_spill_file(self, entry):
+        """ Called in an executor thread. The shared block is released. """
+        item = entry[0]
+        if not self.spill_dir_path.exists():
+            self.spill_dir_path.mkdir(parents=True)
+        file_name = (
+            "spill_" + str(os.getpid()) + "_" + str(next(self.spill_file_counter))
+        )
+        spill_path = pathlib.Path(self.spill_dir_path, file_name + ".npy")
+        numpy.save(str(spill_path), item.data)
+        self.spill_bytes += item.data.nbytes
+        self.spilled_items += 1
+        spilled_item = item.copy()
+        spilled_item.data = None
+        spilled_item.shared_block = None
+        item.release()
+        entry[0] = spilled_item
+        entry[1] = spill_path
+
+    def read_spill_file(self, entry):
+        """ Called in an executor thread. """
+        item, spill_path = entry
+        item.data = numpy.load(str(spill_path))
+        self.spill_bytes -= item.data.nbytes
+        spill_path.unlink()
+        entry[0] = item
+        entry[1] = None
+        return item
+
+    def release_overflow(self, count_as_dropped=True):
+        """ Items in overflow are released and spill files removed. """
+        if self.overflow_task:
+            self.overflow_task.cancel()
+            self.overflow_task = None
+        for item, spill_path in self.overflow:
+            if not isinstance(item, wurb_rec.AudioBlock):
+                continue
+            try:
+                if spill_path is not None:
+                    item.data = numpy.load(str(spill_path), mmap_mode="r")
+                if count_as_dropped:
+                    self.drop(item)
+                else:
+                    item.release()
+                if spill_path is not None:
+                    item.data = None
+                    spill_path.unlink()
+            except Exception as e:
+                self.logger.debug("Queue policy, release: " + str(e))
+        if not count_as_dropped:
+            self.pending_gap_s = 0.0
+            self.pending_flags = wurb_rec.BlockFlags(0)
+        self.overflow = deque()
+        self.overflow_empty_event.set()
+        self.spill_bytes = 0
+
+    async def close(self):
+        """ Items left in overflow are counted as dropped. """
+        self.release_overflow(count_as_dropped=True)
+
+    def get_stats(self):
+        """ """
+        return {
+            "policy": self.policy_name,
+            "queue_size": self.queue.qsize(),
+            "overflow_items": len(self.overflow),
+            "dropped_items": self.dropped_items,
+            "dropped_s": round(self.dropped_s, 3),
+            "blocked_s": round(self.blocked_s, 3),
+            "overflow_full_items": self.overflow_full_items,
+            "spilled_items": self.spilled_items,
+        }
+
+
+# === MAIN - for test ===
+async def main():
+    """A fast producer and a consumer that stalls for a while. Terminate
+    is delivered after the items in overflow."""
+    sampling_freq_hz = 384000
+    block_size = sampling_freq_hz // 2
+    for policy_name in QueuePolicy.policy_names:
+        queue = asyncio.Queue(maxsize=10)
+        policy = QueuePolicy(queue, policy_name, sampling_freq_hz)
+        received = []
+        gap_s = 0.0
+
+        async def consumer():
+            nonlocal gap_s
+            await asyncio.sleep(0.2)  # Stalled.
+            while True:
+                item = await policy.get()
+                if item is wurb_rec.TERMINATE:
+                    break
+                received.append(int(item.data[0]))
+                gap_s += item.gap_before_s
+                queue.task_done()
+
+        consumer_task = asyncio.create_task(consumer())
+        for index in range(40):
+            data = numpy.full(block_size, index, dtype=numpy.int16)
+            policy.put_nowait(wurb_rec.AudioBlock(data))
+            await asyncio.sleep(0.001)
+        overflow_items = len(policy.overflow)
+        await policy.put_sentinel(wurb_rec.TERMINATE)
+        await asyncio.wait_for(consumer_task, timeout=5.0)
+        await policy.close()
+        in_order = received == sorted(received)
+        print(policy_name, policy.get_stats())
+        print("  Received: ", len(received), " In order: ", in_order,
+              " Gap s: ", round(gap_s, 3), " Overflow at terminate: ",
+              overflow_items)
+    # Drop oldest with flush first in the queue, the flush is kept first.
+    queue = asyncio.Queue(maxsize=3)
+    policy = QueuePolicy(queue, "drop-oldest", sampling_freq_hz)
+    await policy.put_sentinel(wurb_rec.FLUSH)
+    for index in range(3):
+        data = numpy.full(block_size, index, dtype=numpy.int16)
+        policy.put_nowait(wurb_rec.AudioBlock(data))
+    received = []
+    while not queue.empty():
+        item = await policy.get()
+        if isinstance(item, wurb_rec.AudioBlock):
+            received.append((int(item.data[0]), item.gap_before_s))
+        else:
+            received.append((item, 0.0))
+        queue.task_done()
+    print("Drop oldest after flush: ", received)
+    assert received == [(wurb_rec.FLUSH, 0.0), (1, 0.5), (2, 0.0)]
+
+
+if __name__ == "__main__":
+    """ """
+    asyncio.run(main(), debug=False)
@@ -7,9 +7,11 @@
 import os
 import asyncio
 import time
+import threading
 import wave
 import pathlib
 import psutil
+import numpy
 from collections import deque
 
 # CloudedBats.
@@ -29,83 +31,158 @@ class UltrasoundDevices(object):
         self.device_name = ""
         self.card_index = None
         self.sampling_freq_hz = 0
+        self.device_list = []
         self.check_interval_s = 5.0
         self.notification_event = None
         self.pettersson_m500 = wurb_rec.PetterssonM500()
         self.alsa_cards = wurb_rec.AlsaSoundCards()
         self.alsa_capture = None
+        self.device_inventory = wurb_rec.DeviceInventory()
+        self.known_sampling_freqs = {}
 
     async def check_devices(self):
-        """ For asyncio events. """
+        """ For asyncio events. All connected microphones are listed in
+        device_list, the first one is also used as the main device. """
         try:
-            # Check ALSA connected microphones.
-            self.alsa_cards.update_card_lists()
-            #
-            await self.set_connected_device("", None, 0)
-            device_name = ""
-            card_index = None
-            sampling_freq_hz = 0
-            for device_name_part in self.default_name_part_list:
+            # Replay of WAV files instead of microphones, if specified.
+            replay_path = os.getenv("WURB_REC_REPLAY_PATH", "")
+            if replay_path:
+                replay = wurb_rec.WavFileReplay(replay_path=replay_path)
+                sampling_freq_hz, _channels = replay.get_wave_file_info()
+                await self.set_replay_device(
+                    wurb_rec.WavFileReplay.DEVICE_NAME, sampling_freq_hz
+                )
+                return
+            # Synthetic scenes instead of microphones, if specified.
+            if os.getenv("WURB_REC_SYNTHETIC_SCENE", ""):
+                sampling_freq_hz = int(
+                    os.getenv("WURB_REC_SYNTHETIC_FREQ_HZ", "384000")
+                )
+                await self.set_replay_device(
+                    wurb_rec.SyntheticSoundSource.DEVICE_NAME, sampling_freq_hz
+                )
+                return
+            # Microphones, from the inventory if nothing is changed.
+            device_list = await self.device_inventory.get_device_list(
+                self.probe_devices
+            )
+            self.device_list = device_list
+            if device_list:
+                first_device = device_list[0]
+                device = (
+                    first_device["device_name"],
+                    first_device["card_index"],
+                    first_device["sampling_freq_hz"],
+                )
+            else:
+                device = ("", None, 0)
+            # Only notify if changed.
+            if device != (self.device_name, self.card_index, self.sampling_freq_hz):
+                await self.set_connected_device(*device)
+
+        except Exception as e:
+            # Logging error.
+            message = "Rec. check_devices: " + str(e)
+            self.wurb_manager.wurb_logging.error(message, short_message=message)
+
+    def probe_devices(self):
+        """ Blocking, opens sound cards and scans the USB bus. Called in an
+        executor thread by the device inventory. """
+        # Check ALSA connected microphones.
+        self.alsa_cards.update_card_lists()
+        device_list = []
+        used_card_index_list = []
+        for device_name_part in self.default_name_part_list:
+            try:
+                card_index_list = self.alsa_cards.get_capture_card_index_list_by_name(
+                    device_name_part
+                )
+                for card_index in card_index_list:
+                    if card_index in used_card_index_list:
+                        continue
+                    used_card_index_list.append(card_index)
+                    card_dict = self.alsa_cards.get_card_dict_by_index(card_index)
+                    device_name = card_dict.get("card_name", "")
+                    sampling_freq_hz = self.alsa_cards.get_max_sampling_freq(card_index)
+                    # Cards in use can not be opened, the last known rate is used.
+                    card_key = (device_name, card_index)
+                    if sampling_freq_hz > 0:
+                        self.known_sampling_freqs[card_key] = sampling_freq_hz
+                    else:
+                        sampling_freq_hz = self.known_sampling_freqs.get(card_key, 0)
+                    if device_name and (sampling_freq_hz > 0):
+                        device_list.append(
+                            {
+                                "device_name": device_name,
+                                "card_index": card_index,
+                                "sampling_freq_hz": sampling_freq_hz,
+                            }
+                        )
+            except:
+                pass
+        # Check if Pettersson M500.
+        if self.pettersson_m500.is_m500_available():
+            device_list.append(
+                {
+                    "device_name": wurb_rec.PetterssonM500.DEVICE_NAME,
+                    "card_index": None,
+                    "sampling_freq_hz": self.pettersson_m500.get_sampling_freq_hz(),
+                }
+            )
+        # Check if another ALSA mic. is specified in advanced settings.
+        if not device_list:
+            settings_device_name_part = os.getenv("WURB_REC_INPUT_DEVICE", "")
+            settings_sampling_freq_hz = int(
+                os.getenv("WURB_REC_INPUT_DEVICE_FREQ_HZ", "0")
+            )
+            if settings_device_name_part:
+                device_name = ""
+                card_index = None
+                sampling_freq_hz = 0
                 try:
                     card_index = self.alsa_cards.get_capture_card_index_by_name(
-                        device_name_part
+                        settings_device_name_part
                     )
                     if card_index != None:
                         card_dict = self.alsa_cards.get_card_dict_by_index(card_index)
                         device_name = card_dict.get("card_name", "")
-                        sampling_freq_hz = self.alsa_cards.get_max_sampling_freq(
-                            card_index
-                        )
-                        break
-                except:
-                    pass
-            # Check if Pettersson M500.
-            if not device_name:
-                if self.pettersson_m500.is_m500_available():
-                    device_name = self.pettersson_m500.get_device_name()
-                    sampling_freq_hz = self.pettersson_m500.get_sampling_freq_hz()
-            # Check if another ALSA mic. is specified in advanced settings.
-            if not device_name:
-                settings_device_name_part = os.getenv("WURB_REC_INPUT_DEVICE", "")
-                settings_sampling_freq_hz = int(
-                    os.getenv("WURB_REC_INPUT_DEVICE_FREQ_HZ", "0")
-                )
-                if settings_device_name_part:
-                    device_name = ""
-                    card_index = None
-                    sampling_freq_hz = 0
-                    try:
-                        card_index = self.alsa_cards.get_capture_card_index_by_name(
-                            settings_device_name_part
-                        )
-                        if card_index != None:
-                            card_dict = self.alsa_cards.get_card_dict_by_index(
+                        if settings_sampling_freq_hz > 0:
+                            sampling_freq_hz = settings_sampling_freq_hz
+                        else:
+                            sampling_freq_hz = self.alsa_cards.get_max_sampling_freq(
                                 card_index
                             )
-                            device_name = card_dict.get("card_name", "")
-                            if settings_sampling_freq_hz > 0:
-                                sampling_freq_hz = settings_sampling_freq_hz
-                            else:
-                                sampling_freq_hz = (
-                                    self.alsa_cards.get_max_sampling_freq(card_index)
-                                )
-                    except Exception as e:
-                        # Logging error.
-                        message = "Recorder: check_devices: " + str(e)
-                        self.wurb_manager.wurb_logging.error(
-                            message, short_message=message
+                        device_list.append(
+                            {
+                                "device_name": device_name,
+                                "card_index": card_index,
+                                "sampling_freq_hz": sampling_freq_hz,
+                            }
                         )
-            # Done.
-            await self.set_connected_device(device_name, card_index, sampling_freq_hz)
+                except Exception as e:
+                    # Logging error.
+                    message = "Recorder: check_devices: " + str(e)
+                    self.wurb_manager.wurb_logging.error(message, short_message=message)
+        # Done.
+        return device_list
 
-        except Exception as e:
-            # Logging error.
-            message = "Rec. check_devices: " + str(e)
-            self.wurb_manager.wurb_logging.error(message, short_message=message)
+    async def set_replay_device(self, device_name, sampling_freq_hz):
+        """ Replayed files or synthetic scenes, used as microphone. """
+        self.device_list = []
+        if sampling_freq_hz > 0:
+            self.device_list.append(
+                {
+                    "device_name": device_name,
+                    "card_index": None,
+                    "sampling_freq_hz": sampling_freq_hz,
+                }
+            )
+        await self.set_connected_device(device_name, None, sampling_freq_hz)
 
     async def reset_devices(self):
         """ For asyncio events. """
         try:
+            self.device_list = []
             await self.set_connected_device("", None, 0)
 
         except Exception as e:
@@ -113,6 +190,10 @@ class UltrasoundDevices(object):
             message = "Recorder: reset_devices: " + str(e)
             self.wurb_manager.wurb_logging.error(message, short_message=message)
 
+    async def shutdown(self):
+        """ Stops the hotplug watcher. """
+        self.device_inventory.shutdown()
+
     async def get_notification_event(self):
         """ """
         try:
@@ -153,13 +234,24 @@ class UltrasoundDevices(object):
 class WurbRecorder(wurb_rec.SoundStreamManager):
     """ """
 
-    def __init__(self, wurb_manager, queue_max_size=1200):
-        """ """
+    def __init__(self, wurb_manager, queue_max_size=1200, device_number=1):
+        """ One recorder for each microphone. Audio feedback is only
+        connected to the first one. """
         super().__init__(queue_max_size)
         self.wurb_manager = wurb_manager
         self.wurb_settings = wurb_manager.wurb_settings
         self.wurb_logging = wurb_manager.wurb_logging
-        self.wurb_audiofeedback = wurb_manager.wurb_audiofeedback
+        self.wurb_audiofeedback = None
+        if device_number == 1:
+            self.wurb_audiofeedback = wurb_manager.wurb_audiofeedback
+            self.stream_fan_out.add_consumer(
+                "audio_feedback", handler=self.audio_feedback_handler
+            )
+        self.device_number = device_number
+        self.filename_prefix_suffix = ""
+        self.sound_capture = None
+        self.detection_cpu_s = 0.0
+        self.detection_audio_s = 0.0
         self.rec_status = ""
         self.device_name = ""
         self.card_index = ""
@@ -167,10 +259,77 @@ class WurbRecorder(wurb_rec.SoundStreamManager):
         self.notification_event = None
         self.rec_start_time = None
         self.restart_activated = False
+        self.device_lost_time = None
+        self.last_block_end_time = None
+        self.lost_block_end_time = None
+        self.next_sample_index = None  # Continuous stream for detection.
+        self.sound_detectors = []
+        self.trigger_sample_index = None
+        self.last_resume_time = 0.0
+        self.device_gap_counter = 0
+        self.device_gap_s = 0.0
+        self.file_gap_counter = 0
+        self.file_gap_s = 0.0
+        self.capture_profile = None
+        self.capture_profile_stats = None
+        self.block_duration_s = 0.5  # Unit: sec. From capture profile.
+        self.channels = 1
+        self.multichannel_file_mode = "multichannel-wav"
         # Config.
-        self.max_adc_time_diff_s = 10  # Unit: sec.
         self.rec_length_s = 6  # Unit: sec.
         self.rec_timeout_before_restart_s = 30  # Unit: sec.
+        self.min_resume_interval_s = 5.0  # Unit: sec.
+
+    def clear(self):
+        """ New queues, each with a policy for overflow handling. """
+        super().clear()
+        sampling_freq_hz = getattr(self, "sampling_freq_hz", 0)
+        # Spill files compete with file writing in the disk I/O pool. Not
+        # available when called from __init__, clear() is also called when
+        # streaming is started.
+        disk_io_executor = None
+        if getattr(self, "wurb_manager", None) is not None:
+            disk_io_executor = self.wurb_manager.wave_writer_executor
+        # Alternatives: "block", "drop-newest", "drop-oldest" or "spill-to-disk".
+        self.from_source_policy = wurb_rec.QueuePolicy(
+            self.from_source_queue,
+            os.getenv("WURB_REC_SOURCE_QUEUE_POLICY", "drop-newest"),
+            sampling_freq_hz,
+            executor=disk_io_executor,
+        )
+        self.to_target_policy = wurb_rec.QueuePolicy(
+            self.to_target_queue,
+            os.getenv("WURB_REC_TARGET_QUEUE_POLICY", "block"),
+            sampling_freq_hz,
+            executor=disk_io_executor,
+        )
+        for queue_policy in [self.from_source_policy, self.to_target_policy]:
+            spill_dir = os.getenv("WURB_REC_SPILL_DIR", "")
+            if spill_dir:
+                queue_policy.spill_dir_path = pathlib.Path(spill_dir)
+            queue_policy.max_spill_bytes = (
+                int(os.getenv("WURB_REC_SPILL_MAX_MB", "512")) * 1024 * 1024
+            )
+        # The capture stream is delivered to detection and other consumers.
+        self.stream_fan_out.set_sampling_freq_hz(sampling_freq_hz)
+        self.stream_fan_out.add_consumer(
+            "detector", queue_policy=self.from_source_policy
+        )
+
+    async def audio_feedback_handler(self, item):
+        """ Consumer of the capture stream. The shared block is released
+        by the consumer when returned. """
+        if (self.wurb_audiofeedback is None) or (
+            not self.wurb_audiofeedback.is_active()
+        ):
+            return
+        buffer_int16 = wurb_rec.get_channel_data(item.data, 0)
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(
+            self.wurb_audiofeedback.dsp_executor,
+            self.wurb_audiofeedback.add_buffer,
+            buffer_int16,
+        )
 
     async def get_notification_event(self):
         """ """
@@ -212,27 +371,365 @@ class WurbRecorder(wurb_rec.SoundStreamManager):
             self.device_name = device_name
             self.card_index = card_index
             self.sampling_freq_hz = sampling_freq_hz
+            self.select_capture_profile()
+            self.select_channels()
         except Exception as e:
             # Logging error.
             message = "Recorder: set_device: " + str(e)
             self.wurb_manager.wurb_logging.error(message, short_message=message)
 
+    def is_streaming(self):
+        """ """
+        return (self.process_task is not None) and (not self.process_task.done())
+
+    def is_capture_running(self):
+        """ """
+        return (self.source_task is not None) and (not self.source_task.done())
+
+    def is_device_lost(self):
+        """ """
+        return self.device_lost_time is not None
+
+    def get_device_lost_s(self):
+        """ Time since the microphone was lost. """
+        if self.device_lost_time is None:
+            return 0.0
+        return time.time() - self.device_lost_time
+
+    def is_hardware_device(self):
+        """ Replayed files and synthetic scenes are not watched. """
+        return self.device_name not in [
+            wurb_rec.WavFileReplay.DEVICE_NAME,
+            wurb_rec.SyntheticSoundSource.DEVICE_NAME,
+        ]
+
+    def find_device(self, device_list, same_card=False):
+        """ The card index may be changed after replug, if not same_card. """
+        for device_dict in device_list:
+            if device_dict["device_name"] != self.device_name:
+                continue
+            if same_card and (device_dict["card_index"] != self.card_index):
+                continue
+            return device_dict
+        return None
+
+    async def stop_lost_device(self):
+        """ Called by the device watch. Only this pipeline is stopped, the
+        current file is closed as usual. """
+        self.device_lost_time = time.time()
+        self.lost_block_end_time = self.last_block_end_time
+        if self.lost_block_end_time is None:
+            self.lost_block_end_time = self.device_lost_time
+        self.restart_activated = True  # No restart after the queue timeout.
+        await self.drain_streaming(float(os.getenv("WURB_REC_DRAIN_TIMEOUT_S", "5.0")))
+        await self.set_rec_status("Microphone lost.")
+        # Logging.
+        message = "Microphone lost: " + self.device_name
+        self.wurb_logging.warning(message, short_message=message)
+
+    async def drain_streaming(self, timeout_s=5.0):
+        """ Used when recording is stopped or restarted. Files in progress
+        are finished and closed, the drain time is logged. """
+        workers = [self.process_task, self.target_task]
+        if not any((task is not None) and (not task.done()) for task in workers):
+            await self.stop_streaming(stop_immediate=True)
+            return 0.0, 0.0
+        drain_s, discarded_s = await super().drain_streaming(timeout_s)
+        self.pipeline_stats.drain_counter += 1
+        self.pipeline_stats.last_drain_s = drain_s
+        self.pipeline_stats.drain_discarded_s += discarded_s
+        # Logging.
+        message = "Rec. drained in " + str(round(drain_s, 2)) + " s."
+        if discarded_s > 0.0:
+            message += " Discarded: " + str(round(discarded_s, 1)) + " s."
+            self.wurb_logging.warning(message, short_message=message)
+        else:
+            self.wurb_logging.debug(message)
+        return drain_s, discarded_s
+
+    def get_queue_policy(self, queue):
+        """ """
+        for queue_policy in [self.from_source_policy, self.to_target_policy]:
+            if queue_policy.queue is queue:
+                return queue_policy
+        return None
+
+    def get_queued_s(self):
+        """ Audio seconds waiting in the queues, including overflow. """
+        queued_s = 0.0
+        for queue_policy in [self.from_source_policy, self.to_target_policy]:
+            items = list(queue_policy.queue._queue)
+            items += [entry[0] for entry in queue_policy.overflow]
+            for item in items:
+                if isinstance(item, wurb_rec.AudioBlock):
+                    queued_s += item.get_duration_s(self.sampling_freq_hz)
+        return queued_s
+
+    def clear_device_lost(self):
+        """ Called when recording is stopped. """
+        self.device_lost_time = None
+        self.lost_block_end_time = None
+
+    async def resume_lost_device(self, device_dict):
+        """ Called by the device watch when the microphone is back. """
+        wait_s = self.last_resume_time + self.min_resume_interval_s - time.time()
+        if wait_s > 0.0:
+            # Avoid a fast restart loop if the capture fails directly.
+            await asyncio.sleep(wait_s)
+        if not self.is_device_lost():
+            return  # Stopped during the wait.
+        self.last_resume_time = time.time()
+        await self.set_device(
+            device_dict["device_name"],
+            device_dict["card_index"],
+            device_dict["sampling_freq_hz"],
+        )
+        self.device_lost_time = None
+        self.restart_activated = False
+        self.pipeline_stats.restart_counter += 1
+        await self.start_streaming()
+        # Logging.
+        message = "Microphone reconnected: " + self.device_name
+        self.wurb_logging.info(message, short_message=message)
+
+    def log_device_gap(self, adc_time):
+        """ Called for the first block after a reconnect. The gap is
+        calculated from the capture times for the blocks. """
+        gap_s = max(0.0, adc_time - self.lost_block_end_time)
+        self.lost_block_end_time = None
+        self.device_gap_counter += 1
+        self.device_gap_s += gap_s
+        # Logging.
+        message = "Microphone gap: " + str(round(gap_s, 3)) + " s."
+        self.wurb_logging.info(message, short_message=message)
+
+    def select_capture_profile(self):
+        """ Period size, block duration and USB transfer size. """
+        profile_name = os.getenv("WURB_REC_CAPTURE_PROFILE", "balanced")
+        self.capture_profile = wurb_rec.CaptureProfiles().get_profile(profile_name)
+        self.block_duration_s = self.capture_profile["block_duration_s"]
+        # Logging debug.
+        message = "Capture profile: " + self.capture_profile["name"]
+        self.wurb_logging.debug(message=message)
+
+    def select_channels(self):
+        """ Number of channels and how to store them. Only for ALSA devices. """
+        self.channels = 1
+        if self.device_name == wurb_rec.WavFileReplay.DEVICE_NAME:
+            # Same as the replayed files.
+            replay = wurb_rec.WavFileReplay(
+                replay_path=os.getenv("WURB_REC_REPLAY_PATH", "")
+            )
+            _sampling_freq_hz, self.channels = replay.get_wave_file_info()
+        elif self.device_name == wurb_rec.SyntheticSoundSource.DEVICE_NAME:
+            self.channels = 1
+        elif self.device_name != wurb_rec.PetterssonM500.DEVICE_NAME:
+            self.channels = max(1, int(os.getenv("WURB_REC_INPUT_CHANNELS", "1")))
+        # Alternatives: "multichannel-wav" or "file-per-channel".
+        self.multichannel_file_mode = os.getenv(
+            "WURB_REC_MULTICHANNEL_FILES", "multichannel-wav"
+        )
+
+    def is_capture_process_used(self):
+        """ Capture in a separate process, avoids GIL contention. """
+        # Alternatives: "thread" or "process".
+        return os.getenv("WURB_REC_CAPTURE_MODE", "thread") == "process"
+
+    def apply_capture_profile(self, sound_capture):
+        """ Used for both ALSA and M500 capture objects. """
+        sound_capture.max_batch_latency_s = self.capture_profile["max_batch_latency_s"]
+        sound_capture.queue_policy = self.stream_fan_out
+        # One thread for each microphone, the capture loop runs all the time.
+        sound_capture.executor = self.wurb_manager.executors.get_executor(
+            "capture-" + str(self.device_number)
+        )
+        if hasattr(sound_capture, "period_size"):
+            sound_capture.period_size = self.capture_profile["period_size"]
+        if hasattr(sound_capture, "usb_transfer_size"):
+            sound_capture.usb_transfer_size = self.capture_profile["usb_transfer_size"]
+        if hasattr(sound_capture, "usb_stream_buffers"):
+            # Number of transfer buffers for the M500 reader thread, 0 = not used.
+            sound_capture.usb_stream_buffers = int(
+                os.getenv("WURB_REC_M500_STREAM_BUFFERS", "0")
+            )
+
+    def get_capture_profile_stats(self):
+        """ Measured CPU load and overruns for the used capture profile. """
+        if self.capture_profile_stats:
+            return self.capture_profile_stats.get_stats()
+        return {}
+
+    def get_device_stats(self):
+        """ CPU load and dropped blocks for this microphone. """
+        stats = {
+            "device_number": self.device_number,
+            "device_name": self.device_name,
+            "sampling_freq_hz": self.sampling_freq_hz,
+            "channels": self.channels,
+            "device_gaps": self.device_gap_counter,
+            "device_gap_s": round(self.device_gap_s, 3),
+            "file_gaps": self.file_gap_counter,
+            "file_gap_s": round(self.file_gap_s, 3),
+            "source_queue": self.from_source_policy.get_stats(),
+            "target_queue": self.to_target_policy.get_stats(),
+        }
+        if (self.sound_capture is None) or (self.capture_profile_stats is None):
+            return stats
+        elapsed_s = time.time() - self.capture_profile_stats.start_time_s
+        if elapsed_s > 0.0:
+            capture_cpu_s = self.sound_capture.get_thread_cpu_s()
+            stats["capture_cpu_percent"] = round(capture_cpu_s / elapsed_s * 100, 1)
+            stats["detection_cpu_percent"] = round(
+                self.detection_cpu_s / elapsed_s * 100, 1
+            )
+            stats["cpu_percent"] = round(
+                (capture_cpu_s + self.detection_cpu_s) / elapsed_s * 100, 1
+            )
+        stats["dropped_blocks"] = (
+            self.sound_capture.get_dropped_blocks()
+            + self.from_source_policy.dropped_items
+        )
+        stats["overruns"] = self.sound_capture.overrun_counter
+        stats.update(self.sound_capture.get_gap_stats())
+        if hasattr(self.sound_capture, "get_usb_stream_stats"):
+            stats.update(self.sound_capture.get_usb_stream_stats())
+        return stats
+
+    def get_noise_floor_status(self):
+        """ Highest noise floor for all channels, and triggers suppressed
+        since the detection was started. """
+        noise_floor_dbfs = None
+        suppressed_triggers = 0
+        for sound_detector in self.sound_detectors:
+            stats = sound_detector.get_stats()
+            suppressed_triggers += stats.get("suppressed_triggers", 0)
+            channel_floor_dbfs = stats.get("noise_floor_max_dbfs", None)
+            if (channel_floor_dbfs is not None) and (
+                (noise_floor_dbfs is None) or (channel_floor_dbfs > noise_floor_dbfs)
+            ):
+                noise_floor_dbfs = channel_floor_dbfs
+        return {
+            "noise_floor_dbfs": noise_floor_dbfs,
+            "suppressed_triggers": suppressed_triggers,
+        }
+
+    def get_detection_cpu_factor(self, default_factor=1.0, min_audio_s=10.0):
+        """ Measured CPU time for the detection compared to the declared
+        cost for the used algorithm. Default until enough audio is checked. """
+        if (self.detection_audio_s < min_audio_s) or (not self.sound_detectors):
+            return default_factor
+        algorithm_name = self.sound_detectors[0].algorithm_name
+        declared_cpu_s = wurb_rec.detection_algorithms.get_cpu_s_per_audio_s(
+            algorithm_name, self.sampling_freq_hz, len(self.sound_detectors)
+        )
+        if declared_cpu_s <= 0.0:
+            return default_factor
+        measured_cpu_s = self.detection_cpu_s / self.detection_audio_s
+        return measured_cpu_s / declared_cpu_s
+
+    def get_pipeline_stats(self):
+        """ Latencies, queue depths and counters for this recorder. """
+        stats = {
+            "device_number": self.device_number,
+            "device_name": self.device_name,
+            "rec_status": self.rec_status,
+        }
+        stats.update(self.pipeline_stats.get_snapshot())
+        stats["overruns"] = 0
+        stats["capture_drops"] = 0
+        if self.sound_capture is not None:
+            stats["overruns"] = self.sound_capture.overrun_counter
+            stats["capture_drops"] = self.sound_capture.get_dropped_blocks()
+        stats["source_queue"] = self.from_source_policy.get_stats()
+        stats["target_queue"] = self.to_target_policy.get_stats()
+        stats["consumers"] = self.stream_fan_out.get_stats()
+        stats["detectors"] = [
+            sound_detector.get_stats() for sound_detector in self.sound_detectors
+        ]
+        return stats
+
+    def log_capture_profile_stats(self, sound_capture):
+        """ """
+        if self.capture_profile_stats is None:
+            return
+        self.capture_profile_stats.overrun_counter = sound_capture.overrun_counter
+        stats = self.capture_profile_stats.get_stats()
+        message = (
+            "Capture profile: "
+            + stats["profile_name"]
+            + " CPU: "
+            + str(stats["cpu_percent"])
+            + "% Overruns: "
+            + str(stats["overruns"])
+            + " Time: "
+            + str(stats["elapsed_s"])
+            + " s."
+        )
+        self.wurb_logging.info(message, short_message=message)
+        # Gaps after overruns.
+        gap_stats = sound_capture.get_gap_stats()
+        if gap_stats.get("gaps", 0) > 0:
+            message = (
+                "Capture gaps: "
+                + str(gap_stats["gaps"])
+                + " Lost: "
+                + str(gap_stats["gap_s"])
+                + " s."
+            )
+            self.wurb_logging.info(message, short_message=message)
+
     async def sound_source_worker(self):
         """ """
         self.rec_start_time = None
         loop = asyncio.get_event_loop()
         self.restart_activated = False
+        if self.capture_profile is None:
+            self.select_capture_profile()
+        self.detection_cpu_s = 0.0
+        self.detection_audio_s = 0.0
+
+        # Replay of WAV files.
+        if self.device_name == wurb_rec.WavFileReplay.DEVICE_NAME:
+            replay = wurb_rec.WavFileReplay(
+                data_queue=self.from_source_queue,
+                replay_path=os.getenv("WURB_REC_REPLAY_PATH", ""),
+            )
+            await self.replay_source(replay)
+            return
+
+        # Synthetic scenes, deterministic from the seed.
+        if self.device_name == wurb_rec.SyntheticSoundSource.DEVICE_NAME:
+            synthetic = wurb_rec.SyntheticSoundSource(
+                data_queue=self.from_source_queue,
+                scene_name=os.getenv("WURB_REC_SYNTHETIC_SCENE", ""),
+                seed=int(os.getenv("WURB_REC_SYNTHETIC_SEED", "0")),
+            )
+            synthetic.duration_s = float(
+                os.getenv("WURB_REC_SYNTHETIC_DURATION_S", "0")
+            )
+            await self.replay_source(synthetic)
+            return
 
         # Pettersson M500, not compatible with ALSA.
-        pettersson_m500 = wurb_rec.PetterssonM500(
-            data_queue=self.from_source_queue,
-            direct_target=self.wurb_audiofeedback,
-        )
-        if self.device_name == pettersson_m500.get_device_name():
+        if self.device_name == wurb_rec.PetterssonM500.DEVICE_NAME:
+            pettersson_m500 = wurb_rec.PetterssonM500(
+                data_queue=self.from_source_queue,
+            )
+            if self.is_capture_process_used():
+                pettersson_m500 = wurb_rec.ProcessSoundCapture(
+                    data_queue=self.from_source_queue,
+                    device_type="m500",
+                )
+            self.sound_capture = pettersson_m500
             # Logging.
             await self.set_rec_status("Microphone is on.")
+            is_cancelled = False
             try:
-                buffer_size = int(self.sampling_freq_hz / 2)  # 0.5 sec.
+                buffer_size = int(self.sampling_freq_hz * self.block_duration_s)
+                self.apply_capture_profile(pettersson_m500)
+                self.capture_profile_stats = wurb_rec.CaptureProfileStats(
+                    self.capture_profile["name"]
+                )
                 await pettersson_m500.initiate_capture(
                     card_index=self.card_index,
                     sampling_freq=self.sampling_freq_hz,
@@ -240,6 +737,7 @@ class WurbRecorder(wurb_rec.SoundStreamManager):
                 )
                 await pettersson_m500.start_capture_in_executor()
             except asyncio.CancelledError:
+                is_cancelled = True
                 await pettersson_m500.stop_capture()
             except Exception as e:
                 # Logging error.
@@ -247,18 +745,33 @@ class WurbRecorder(wurb_rec.SoundStreamManager):
                 self.wurb_manager.wurb_logging.error(message, short_message=message)
             finally:
                 await pettersson_m500.stop_capture()
+                self.log_capture_profile_stats(pettersson_m500)
                 await self.set_rec_status("Recording finished.")
+                if not is_cancelled:
+                    # Ended by itself, the microphone may be lost.
+                    self.wurb_manager.request_device_check()
             return
 
         # Standard ASLA microphones.
         recorder_alsa = wurb_rec.AlsaSoundCapture(
             data_queue=self.from_source_queue,
-            direct_target=self.wurb_audiofeedback,
         )
+        if self.is_capture_process_used():
+            recorder_alsa = wurb_rec.ProcessSoundCapture(
+                data_queue=self.from_source_queue,
+                device_type="alsa",
+            )
+        self.sound_capture = recorder_alsa
         # Logging.
         await self.set_rec_status("Microphone is on.")
+        is_cancelled = False
         try:
-            buffer_size = int(self.sampling_freq_hz / 2)  # 0.5 sec.
+            buffer_size = int(self.sampling_freq_hz * self.block_duration_s)
+            self.apply_capture_profile(recorder_alsa)
+            recorder_alsa.channels = self.channels
+            self.capture_profile_stats = wurb_rec.CaptureProfileStats(
+                self.capture_profile["name"]
+            )
             await recorder_alsa.initiate_capture(
                 card_index=self.card_index,
                 sampling_freq=self.sampling_freq_hz,
@@ -266,6 +779,7 @@ class WurbRecorder(wurb_rec.SoundStreamManager):
             )
             await recorder_alsa.start_capture_in_executor()
         except asyncio.CancelledError:
+            is_cancelled = True
             await recorder_alsa.stop_capture()
         except Exception as e:
             # Logging error.
@@ -273,9 +787,71 @@ class WurbRecorder(wurb_rec.SoundStreamManager):
             self.wurb_manager.wurb_logging.error(message, short_message=message)
         finally:
             await recorder_alsa.stop_capture()
+            self.log_capture_profile_stats(recorder_alsa)
             await self.set_rec_status("Recording finished.")
+            if not is_cancelled:
+                # Ended by itself, the microphone may be lost.
+                self.wurb_manager.request_device_check()
         return
 
+    async def replay_source(self, replay):
+        """ Replays WAV files or synthetic scenes through detection and file
+        writing. The pipeline is terminated when the replay is finished and the
+        throughput is logged as audio seconds per CPU second for the whole
+        process. """
+        self.sound_capture = replay
+        await self.set_rec_status("Microphone is on.")
+        try:
+            buffer_size = int(self.sampling_freq_hz * self.block_duration_s)
+            self.apply_capture_profile(replay)
+            replay.channels = self.channels
+            # Alternatives: "real-time" or "as-fast-as-possible".
+            replay.replay_mode = os.getenv("WURB_REC_REPLAY_MODE", "real-time")
+            self.capture_profile_stats = wurb_rec.CaptureProfileStats(
+                self.capture_profile["name"]
+            )
+            start_cpu_s = self.capture_profile_stats.get_cpu_time_s()
+            await replay.initiate_capture(
+                card_index=None,
+                sampling_freq=self.sampling_freq_hz,
+                buffer_size=buffer_size,
+            )
+            await replay.start_capture_in_executor()
+            # Let process and target finish their work.
+            await asyncio.sleep(0.1)
+            await self.put_sentinel(self.from_source_queue, wurb_rec.TERMINATE)
+            # Only waits for the workers. If the replay is cancelled when
+            # drained, the workers are not cancelled with it.
+            for task in [self.process_task, self.target_task]:
+                if task:
+                    await asyncio.shield(task)
+            cpu_s = self.capture_profile_stats.get_cpu_time_s() - start_cpu_s
+            replayed_s = replay.get_replayed_s()
+            message = (
+                "Replay finished: "
+                + replay.get_device_name()
+                + ". Files: "
+                + str(replay.replayed_files)
+                + " Audio: "
+                + str(round(replayed_s, 1))
+                + " s. CPU: "
+                + str(round(cpu_s, 1))
+                + " s."
+            )
+            if cpu_s > 0.0:
+                message += " Audio s per CPU s: " + str(round(replayed_s / cpu_s, 1))
+            self.wurb_logging.info(message, short_message=message)
+        except asyncio.CancelledError:
+            await replay.stop_capture()
+        except Exception as e:
+            # Logging error.
+            message = "Recorder: replay_source: " + str(e)
+            self.wurb_manager.wurb_logging.error(message, short_message=message)
+        finally:
+            await replay.stop_capture()
+            self.log_capture_profile_stats(replay)
+            await self.set_rec_status("Recording finished.")
+
     async def sound_process_worker(self):
         """ """
 
@@ -283,15 +859,27 @@ class WurbRecorder(wurb_rec.SoundStreamManager):
             # Get rec length from settings.
             self.rec_length_s = int(self.wurb_settings.get_setting("rec_length_s"))
             #
+            self.last_block_end_time = None
             self.process_deque = deque()  # Double ended queue.
             self.process_deque.clear()
-            self.process_deque_length = self.rec_length_s * 2
-            self.detection_counter_max = self.process_deque_length - 3  # 1.5 s before.
+            blocks_per_s = 1.0 / self.block_duration_s
+            self.process_deque_length = int(round(self.rec_length_s * blocks_per_s))
+            pre_trigger_blocks = int(round(1.5 * blocks_per_s))  # 1.5 s before.
+            self.detection_counter_max = (
+                self.process_deque_length - pre_trigger_blocks
+            )
             #
             first_sound_detected = False
             sound_detected = False
             sound_detected_counter = 0
-            sound_detector = wurb_rec.SoundDetection(self.wurb_manager).get_detection()
+            # One detector for each channel.
+            sound_detectors = []
+            for _channel in range(self.channels):
+                sound_detectors.append(
+                    wurb_rec.SoundDetection(self.wurb_manager, self).get_detection()
+                )
+            self.sound_detectors = sound_detectors
+            self.next_sample_index = None
             max_peak_freq_hz = None
             max_peak_dbfs = None
 
@@ -301,7 +889,7 @@ class WurbRecorder(wurb_rec.SoundStreamManager):
                         # item = await self.from_source_queue.get()
                         try:
                             item = await asyncio.wait_for(
-                                self.from_source_queue.get(),
+                                self.from_source_policy.get(),
                                 timeout=self.rec_timeout_before_restart_s,
                             )
                         except asyncio.TimeoutError:
@@ -315,77 +903,72 @@ class WurbRecorder(wurb_rec.SoundStreamManager):
                             self.wurb_logging.warning(message, short_message=message)
                             # Restart recording.
                             self.restart_activated = True
+                            self.pipeline_stats.restart_counter += 1
                             loop = asyncio.get_event_loop()
                             asyncio.run_coroutine_threadsafe(
                                 self.wurb_manager.restart_rec(),
                                 loop,
                             )
-                            await self.remove_items_from_queue(self.from_source_queue)
-                            await self.from_source_queue.put(False)  # Flush.
+                            await self.flush_queue(self.from_source_queue)
                             return
                         #
                         try:
-                            # print("REC PROCESS: ", item["adc_time"], item["data"][:5])
-                            if item == None:
+                            if item is wurb_rec.TERMINATE:
+                                if first_sound_detected:
+                                    # Stopped during a detection, shorter file.
+                                    await self.send_process_deque(
+                                        max_peak_freq_hz, max_peak_dbfs
+                                    )
                                 first_sound_detected == False
                                 sound_detected_counter = 0
-                                self.process_deque.clear()
-                                await self.to_target_queue.put(None)  # Terminate.
+                                self.clear_process_deque()
+                                await self.put_sentinel(
+                                    self.to_target_queue, wurb_rec.TERMINATE
+                                )
                                 break
-                            elif item == False:
+                            elif item is wurb_rec.FLUSH:
                                 first_sound_detected == False
                                 sound_detected_counter = 0
-                                self.process_deque.clear()
-                                await self.remove_items_from_queue(self.to_target_queue)
-                                await self.to_target_queue.put(False)  # Flush.
+                                self.reset_sound_detectors(sound_detectors)
+                                self.pipeline_stats.flush_counter += 1
+                                self.clear_process_deque()
+                                await self.flush_queue(self.to_target_queue)
                             else:
-                                # Compare real time and stream time.
-                                adc_time = item["adc_time"]
-                                detector_time = item["detector_time"]
-                                # Restart if it differ too much.
-                                if (
-                                    abs(adc_time - detector_time)
-                                    > self.max_adc_time_diff_s
-                                ):
-                                    # Check if restart already is requested.
-                                    if self.restart_activated:
-                                        return
-                                    # Logging.
-                                    message = "Warning: Time diff. detected. Rec. will be restarted."
-                                    self.wurb_logging.info(
-                                        message, short_message=message
-                                    )
-                                    # Restart recording.
-                                    self.restart_activated = True
-                                    loop = asyncio.get_event_loop()
-                                    asyncio.run_coroutine_threadsafe(
-                                        self.wurb_manager.restart_rec(),
-                                        loop,
-                                    )
-                                    await self.remove_items_from_queue(
-                                        self.from_source_queue
-                                    )
-                                    await self.from_source_queue.put(False)  # Flush.
-                                    return
-
-                                # Store in list-
-                                new_item = {}
-                                new_item["status"] = "data-Counter-" + str(
-                                    sound_detected_counter
+                                # Time drift and gaps after overruns are handled
+                                # by the sample based capture clock, no restart.
+                                if self.lost_block_end_time is not None:
+                                    self.log_device_gap(item.adc_time)
+                                self.last_block_end_time = item.get_end_time(
+                                    self.sampling_freq_hz
                                 )
-                                new_item["adc_time"] = item["adc_time"]
-                                new_item["data"] = item["data"]
 
-                                self.process_deque.append(new_item)
+                                # Store in list. Passed on without copy, the
+                                # shared block is owned by the item in the deque.
+                                self.process_deque.append(item)
                                 # Remove oldest items if the list is too long.
                                 while (
                                     len(self.process_deque) > self.process_deque_length
                                 ):
-                                    self.process_deque.popleft()
+                                    self.release_item(self.process_deque.popleft())
 
                                 # Check for sound.
-                                detection_result = sound_detector.check_for_sound(
-                                    (item["adc_time"], item["data"])
+                                detection_start_cpu_s = time.thread_time()
+                                detection_start_s = time.perf_counter()
+                                detection_result = self.check_channels_for_sound(
+                                    sound_detectors, item
+                                )
+                                self.detection_cpu_s += (
+                                    time.thread_time() - detection_start_cpu_s
+                                )
+                                self.detection_audio_s += item.get_duration_s(
+                                    self.sampling_freq_hz
+                                )
+                                self.pipeline_stats.add_detection(
+                                    time.perf_counter() - detection_start_s,
+                                    self.last_block_end_time,
+                                )
+                                self.pipeline_stats.add_queue_depth(
+                                    "from_source_queue", self.from_source_queue.qsize()
                                 )
                                 (
                                     sound_detected,
@@ -398,6 +981,10 @@ class WurbRecorder(wurb_rec.SoundStreamManager):
                                     sound_detected_counter = 0
                                     max_peak_freq_hz = peak_freq_hz
                                     max_peak_dbfs = peak_dbfs
+                                    if self.trigger_sample_index is not None:
+                                        self.pipeline_stats.add_trigger(
+                                            self.trigger_sample_index
+                                        )
                                     # Log first detected sound.
                                     if max_peak_dbfs and peak_dbfs:
                                         # Logging.
@@ -429,41 +1016,17 @@ class WurbRecorder(wurb_rec.SoundStreamManager):
                                         first_sound_detected = False
                                         sound_detected_counter = 0
                                         # Send to target.
-                                        for index in range(
-                                            0, self.process_deque_length
-                                        ):
-                                            to_file_item = self.process_deque.popleft()
-                                            #
-                                            if index == 0:
-                                                to_file_item["status"] = "new_file"
-                                                to_file_item[
-                                                    "max_peak_freq_hz"
-                                                ] = max_peak_freq_hz
-                                                to_file_item[
-                                                    "max_peak_dbfs"
-                                                ] = max_peak_dbfs
-                                            if index == (self.process_deque_length - 1):
-                                                to_file_item["status"] = "close_file"
-                                            #
-                                            if not self.to_target_queue.full():
-                                                await self.to_target_queue.put(
-                                                    to_file_item
-                                                )
-
-                                            # await asyncio.sleep(0)
-
-                            # status = item.get('status', '')
-                            # adc_time = item.get('time', '')
-                            # data = item.get('data', '')
-                            # print("DEBUG: Process status:", status, " time:", adc_time, " data: ", len(data))
+                                        await self.send_process_deque(
+                                            max_peak_freq_hz, max_peak_dbfs
+                                        )
+
                         finally:
                             self.from_source_queue.task_done()
                             await asyncio.sleep(0)
 
                     except asyncio.QueueFull:
-                        await self.remove_items_from_queue(self.to_target_queue)
-                        self.process_deque.clear()
-                        await self.to_target_queue.put(False)  # Flush.
+                        self.clear_process_deque()
+                        await self.flush_queue(self.to_target_queue)
                 except asyncio.CancelledError:
                     break
                 except Exception as e:
@@ -478,45 +1041,162 @@ class WurbRecorder(wurb_rec.SoundStreamManager):
             message = "Recorder: sound_process_worker(2): " + str(e)
             self.wurb_manager.wurb_logging.error(message, short_message=message)
         finally:
-            pass
+            await self.from_source_policy.close()
+
+    async def send_process_deque(self, max_peak_freq_hz, max_peak_dbfs):
+        """ All blocks in the deque are sent to target as one file. """
+        length = len(self.process_deque)
+        for index in range(0, length):
+            to_file_item = self.process_deque.popleft()
+            if index == 0:
+                to_file_item.flags |= wurb_rec.BlockFlags.NEW_FILE
+                to_file_item.max_peak_freq_hz = max_peak_freq_hz
+                to_file_item.max_peak_dbfs = max_peak_dbfs
+            if index == (length - 1):
+                to_file_item.flags |= wurb_rec.BlockFlags.CLOSE_FILE
+            await self.to_target_policy.put(to_file_item)
+
+    def reset_sound_detectors(self, sound_detectors):
+        """ The detectors are continuous between blocks, until reset. """
+        for sound_detector in sound_detectors:
+            sound_detector.reset()
+        self.next_sample_index = None
+
+    def check_channels_for_sound(self, sound_detectors, item):
+        """ Sound is detected if any channel triggers. Peak from the loudest. """
+        # Dropped blocks and overruns are found from the sample index.
+        if (self.next_sample_index is not None) and (
+            (item.sample_index != self.next_sample_index) or (item.gap_before_s > 0.0)
+        ):
+            self.reset_sound_detectors(sound_detectors)
+        self.next_sample_index = item.sample_index + len(item.data)
+        self.trigger_sample_index = None
+        sound_detected = False
+        peak_freq_hz = None
+        peak_dbfs = None
+        for channel, sound_detector in enumerate(sound_detectors):
+            channel_data = wurb_rec.get_channel_data(item.data, channel)
+            (
+                channel_detected,
+                channel_peak_freq_hz,
+                channel_peak_dbfs,
+            ) = sound_detector.check_for_sound((item.adc_time, channel_data))
+            if channel_detected:
+                sound_detected = True
+                # First sample for the frames that triggered, in the stream.
+                if sound_detector.trigger_sample_offset is not None:
+                    trigger_sample_index = (
+                        item.sample_index + sound_detector.trigger_sample_offset
+                    )
+                    if (self.trigger_sample_index is None) or (
+                        trigger_sample_index < self.trigger_sample_index
+                    ):
+                        self.trigger_sample_index = trigger_sample_index
+                if (channel_peak_dbfs is not None) and (
+                    (peak_dbfs is None) or (channel_peak_dbfs > peak_dbfs)
+                ):
+                    peak_freq_hz = channel_peak_freq_hz
+                    peak_dbfs = channel_peak_dbfs
+        return sound_detected, peak_freq_hz, peak_dbfs
+
+    async def run_in_writer_pool(self, function, *args):
+        """ File writing is done in a pool shared by all recorders. """
+        loop = asyncio.get_running_loop()
+        executor = self.wurb_manager.wave_writer_executor
+        return await loop.run_in_executor(executor, function, *args)
+
+    def clear_process_deque(self):
+        """ Release shared blocks and clear. """
+        while self.process_deque:
+            self.release_item(self.process_deque.popleft())
 
     async def sound_target_worker(self):
         """Worker for sound targets. Mainly files or streams."""
         wave_file_writer = None
+        max_peak_freq_hz = None
+        max_peak_dbfs = None
         try:
             while True:
                 try:
-                    item = await self.to_target_queue.get()
+                    item = await self.to_target_policy.get()
                     try:
-                        if item == None:
-                            # Terminated by process.
+                        if item is wurb_rec.TERMINATE:
                             break
-                        elif item == False:
+                        elif item is wurb_rec.FLUSH:
                             await self.remove_items_from_queue(self.to_target_queue)
                             if wave_file_writer:
-                                wave_file_writer.close()
+                                await self.run_in_writer_pool(wave_file_writer.close)
+                                wave_file_writer = None
                         else:
+                            # The last block in the earlier file was dropped.
+                            if item.flags & wurb_rec.BlockFlags.CLOSE_BEFORE:
+                                if wave_file_writer:
+                                    await self.run_in_writer_pool(wave_file_writer.close)
+                                    wave_file_writer = None
+                            # Gap, blocks are dropped. Continued in a new file.
+                            is_new_file = item.flags & wurb_rec.BlockFlags.NEW_FILE
+                            gap_s = item.gap_before_s
+                            if (gap_s > 0.0) and (not is_new_file):
+                                message = "Sound file closed at gap: "
+                                if wave_file_writer:
+                                    await self.run_in_writer_pool(wave_file_writer.close)
+                                else:
+                                    # The first block in the file was dropped.
+                                    message = "Sound file started after gap: "
+                                    max_peak_freq_hz = item.max_peak_freq_hz
+                                    max_peak_dbfs = item.max_peak_dbfs
+                                self.file_gap_counter += 1
+                                self.file_gap_s += gap_s
+                                # Logging.
+                                message += str(round(gap_s, 3)) + " s."
+                                self.wurb_logging.warning(
+                                    message, short_message=message
+                                )
+                                wave_file_writer = WaveFileWriter(
+                                    self.wurb_manager, self
+                                )
+                                await self.run_in_writer_pool(
+                                    wave_file_writer.create,
+                                    item.adc_time,
+                                    max_peak_freq_hz,
+                                    max_peak_dbfs,
+                                )
                             # New.
-                            if item["status"] == "new_file":
+                            if is_new_file:
                                 if wave_file_writer:
-                                    wave_file_writer.close()
+                                    await self.run_in_writer_pool(wave_file_writer.close)
 
-                                wave_file_writer = WaveFileWriter(self.wurb_manager)
-                                max_peak_freq_hz = item.get("max_peak_freq_hz", None)
-                                max_peak_dbfs = item.get("max_peak_dbfs", None)
-                                wave_file_writer.create(
-                                    item["adc_time"], max_peak_freq_hz, max_peak_dbfs
+                                wave_file_writer = WaveFileWriter(
+                                    self.wurb_manager, self
+                                )
+                                max_peak_freq_hz = item.max_peak_freq_hz
+                                max_peak_dbfs = item.max_peak_dbfs
+                                await self.run_in_writer_pool(
+                                    wave_file_writer.create,
+                                    item.adc_time,
+                                    max_peak_freq_hz,
+                                    max_peak_dbfs,
                                 )
                             # Data.
                             if wave_file_writer:
-                                data_array = item["data"]
-                                wave_file_writer.write(data_array)
+                                write_start_s = time.perf_counter()
+                                await self.run_in_writer_pool(
+                                    wave_file_writer.write, item.data
+                                )
+                                self.pipeline_stats.add_write(
+                                    time.perf_counter() - write_start_s,
+                                    item.get_end_time(self.sampling_freq_hz),
+                                )
+                                self.pipeline_stats.add_queue_depth(
+                                    "to_target_queue", self.to_target_queue.qsize()
+                                )
                             # File.
-                            if item["status"] == "close_file":
+                            if item.flags & wurb_rec.BlockFlags.CLOSE_FILE:
                                 if wave_file_writer:
-                                    wave_file_writer.close()
+                                    await self.run_in_writer_pool(wave_file_writer.close)
                                     wave_file_writer = None
                     finally:
+                        self.release_item(item)
                         self.to_target_queue.task_done()
                         await asyncio.sleep(0)
 
@@ -531,27 +1211,41 @@ class WurbRecorder(wurb_rec.SoundStreamManager):
             message = "Recorder: sound_target_worker: " + str(e)
             self.wurb_manager.wurb_logging.error(message, short_message=message)
         finally:
-            pass
+            # Stopped during a file, the header is updated when closed.
+            if wave_file_writer:
+                try:
+                    await self.run_in_writer_pool(wave_file_writer.close)
+                except Exception as e:
+                    # Logging error.
+                    message = "Recorder: sound_target_worker, close: " + str(e)
+                    self.wurb_manager.wurb_logging.error(
+                        message, short_message=message
+                    )
+            await self.to_target_policy.close()
 
 
 class WaveFileWriter:
     """Each file is connected to a separate file writer object
     to avoid concurrency problems."""
 
-    def __init__(self, wurb_manager):
-        """ """
+    def __init__(self, wurb_manager, wurb_recorder=None):
+        """ The recorder is needed when more than one microphone is used. """
         self.wurb_manager = wurb_manager
-        self.wurb_recorder = wurb_manager.wurb_recorder
+        self.wurb_recorder = wurb_recorder or wurb_manager.wurb_recorder
         self.wurb_settings = wurb_manager.wurb_settings
         self.wurb_logging = wurb_manager.wurb_logging
         self.wurb_rpi = wurb_manager.wurb_rpi
         self.rec_target_dir_path = None
-        self.wave_file = None
+        self.wave_files = []
+        self.file_per_channel = False
+        # A cancelled write may still run in the pool, close must wait.
+        self.lock = threading.Lock()
         # self.size_counter = 0
 
     def create(self, start_time, max_peak_freq_hz, max_peak_dbfs):
         """ """
         rec_file_prefix = self.wurb_settings.get_setting("filename_prefix")
+        rec_file_prefix += self.wurb_recorder.filename_prefix_suffix
         rec_type = self.wurb_settings.get_setting("rec_type")
         sampling_freq_hz = self.wurb_recorder.sampling_freq_hz
         if rec_type == "TE":
@@ -573,7 +1267,7 @@ class WaveFileWriter:
             peak_info_str += "dB"
 
         if self.rec_target_dir_path is None:
-            self.wave_file = None
+            self.wave_files = []
             return
 
         # Filename example: "WURB1_20180420T205942+0200_N00.00E00.00_TE384.wav"
@@ -585,17 +1279,31 @@ class WaveFileWriter:
         filename += "_"
         filename += rec_type_str
         filename += peak_info_str
-        filename += ".wav"
 
         # Create directories.
         if not self.rec_target_dir_path.exists():
             self.rec_target_dir_path.mkdir(parents=True)
-        # Open wave file for writing.
-        filenamepath = pathlib.Path(self.rec_target_dir_path, filename)
-        self.wave_file = wave.open(str(filenamepath), "wb")
-        self.wave_file.setnchannels(1)  # 1=Mono.
-        self.wave_file.setsampwidth(2)  # 2=16 bits.
-        self.wave_file.setframerate(sampling_freq_hz)
+        # Open wave files for writing. One multi-channel file or one per channel.
+        channels = self.wurb_recorder.channels
+        self.file_per_channel = (channels > 1) and (
+            self.wurb_recorder.multichannel_file_mode == "file-per-channel"
+        )
+        if self.file_per_channel:
+            filenames = []
+            for channel in range(channels):
+                filenames.append(filename + "_Ch" + str(channel + 1) + ".wav")
+            channels_in_file = 1
+        else:
+            filenames = [filename + ".wav"]
+            channels_in_file = channels
+        self.wave_files = []
+        for wave_filename in filenames:
+            filenamepath = pathlib.Path(self.rec_target_dir_path, wave_filename)
+            wave_file = wave.open(str(filenamepath), "wb")
+            wave_file.setnchannels(channels_in_file)  # 1=Mono.
+            wave_file.setsampwidth(2)  # 2=16 bits.
+            wave_file.setframerate(sampling_freq_hz)
+            self.wave_files.append(wave_file)
         # Logging.
         target_path_str = str(self.rec_target_dir_path)
         target_path_str = target_path_str.replace("/media/pi/", "USB:")
@@ -606,20 +1314,28 @@ class WaveFileWriter:
         message = "Sound file " + message_rec_type + "to: " + target_path_str
         self.wurb_logging.info(message, short_message=message)
         # Logging debug.
-        message = "Filename: " + filename
+        message = "Filename: " + ", ".join(filenames)
         self.wurb_logging.debug(message=message)
 
     def write(self, buffer):
-        """ """
-        if self.wave_file is not None:
-            self.wave_file.writeframes(buffer)
-            # self.size_counter += len(buffer) / 2  # Count frames.
+        """ Multi-channel buffers are stored as (frames, channels). """
+        with self.lock:
+            if self.file_per_channel:
+                for channel, wave_file in enumerate(self.wave_files):
+                    # Channels are strided views, must be copied before writing.
+                    channel_data = wurb_rec.get_channel_data(buffer, channel)
+                    wave_file.writeframes(numpy.ascontiguousarray(channel_data))
+            else:
+                for wave_file in self.wave_files:
+                    wave_file.writeframes(buffer)
+                # self.size_counter += len(buffer) / 2  # Count frames.
 
     def close(self):
         """ """
-        if self.wave_file is not None:
-            self.wave_file.close()
-            self.wave_file = None
+        with self.lock:
+            for wave_file in self.wave_files:
+                wave_file.close()
+            self.wave_files = []
         # Copy settings to target directory.
         try:
             if self.rec_target_dir_path is not None:
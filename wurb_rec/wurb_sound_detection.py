@@ -4,50 +4,131 @@
 # Copyright (c) 2020-present Arnold Andreasson
 # License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
 
+import os
+import time
 import logging
 import numpy as np
 import scipy.signal
 
+# CloudedBats.
+import wurb_rec
+
+try:
+    # Keeps float32, numpy.fft converts to float64.
+    import scipy.fft as fft_module
+except ImportError:
+    fft_module = np.fft
+
 
 class SoundDetection(object):
     """ """
 
-    def __init__(self, wurb_manager):
-        """ """
+    def __init__(self, wurb_manager, wurb_recorder=None):
+        """ The recorder is needed when more than one microphone is used. """
         self.wurb_manager = wurb_manager
-        self.wurb_recorder = wurb_manager.wurb_recorder
+        self.wurb_recorder = wurb_recorder or wurb_manager.wurb_recorder
         self.wurb_settings = wurb_manager.wurb_settings
         self.wurb_logging = wurb_manager.wurb_logging
 
     def get_detection(self):
-        """ Select detection algorithm. """
+        """ Select detection algorithm. Unknown names gives the default. """
         algorithm = self.wurb_settings.get_setting("detection_algorithm")
-        if algorithm == "detection-none":
-            detection_object = SoundDetectionNone(self.wurb_manager)
-        elif algorithm == "detection-simple":
-            detection_object = SoundDetectionSimple(self.wurb_manager)
-        else:
-            # Use the most common as default.
-            detection_object = SoundDetectionSimple(self.wurb_manager)
+        detector_class = detection_algorithms.get_detector_class(algorithm)
+        detection_object = detector_class(self.wurb_manager, self.wurb_recorder)
         #
         detection_object.config()
         return detection_object
 
 
+class DetectionAlgorithms:
+    """Registry for detection algorithms, by name. Detectors in other
+    modules are added with register(), the factory above is not changed.
+    Each detector class declares its CPU cost per second of audio for one
+    channel at the reference sampling frequency. The cost is scaled with
+    the sampling frequency and used to warn when a detector is too
+    expensive for the connected microphone.
+    """
+
+    def __init__(self):
+        """ """
+        self.default_algorithm_name = "detection-simple"
+        self.reference_freq_hz = 384000
+        self.algorithms = {}
+
+    def register(self, detector_class):
+        """ Replaces an earlier detector with the same name. """
+        self.algorithms[detector_class.algorithm_name] = detector_class
+
+    def get_algorithm_names(self):
+        """ """
+        return list(self.algorithms.keys())
+
+    def get_detector_class(self, algorithm_name):
+        """ """
+        if algorithm_name not in self.algorithms:
+            algorithm_name = self.default_algorithm_name
+        return self.algorithms[algorithm_name]
+
+    def get_cpu_s_per_audio_s(self, algorithm_name, sampling_freq_hz, channels=1):
+        """ Declared cost, scaled to the sampling frequency. """
+        detector_class = self.get_detector_class(algorithm_name)
+        freq_factor = sampling_freq_hz / self.reference_freq_hz
+        return detector_class.cpu_cost_per_audio_s * freq_factor * channels
+
+    def get_algorithm_list(
+        self, sampling_freq_hz, channels=1, cpu_factor=1.0, cpu_limit_percent=50.0
+    ):
+        """Name, description and CPU load for each detector. The factor
+        is used when the CPU is faster or slower than the reference."""
+        algorithm_list = []
+        for algorithm_name, detector_class in self.algorithms.items():
+            cpu_s = self.get_cpu_s_per_audio_s(
+                algorithm_name, sampling_freq_hz, channels
+            )
+            cpu_percent = cpu_s * cpu_factor * 100
+            algorithm_list.append(
+                {
+                    "algorithm_name": algorithm_name,
+                    "description": detector_class.description,
+                    "cpu_percent": round(cpu_percent, 1),
+                    "too_expensive": cpu_percent > cpu_limit_percent,
+                }
+            )
+        return algorithm_list
+
+
 class SoundDetectionBase:
     """ """
 
-    def __init__(self, wurb_manager):
+    # Declared by each detector, used in the registry. CPU cost is
+    # in seconds per second of audio, one channel at 384 kHz.
+    algorithm_name = ""
+    description = ""
+    cpu_cost_per_audio_s = 0.0
+
+    def __init__(self, wurb_manager, wurb_recorder=None):
         """ """
         self.wurb_manager = wurb_manager
-        self.wurb_recorder = wurb_manager.wurb_recorder
+        self.wurb_recorder = wurb_recorder or wurb_manager.wurb_recorder
         self.wurb_settings = wurb_manager.wurb_settings
         self.wurb_logging = wurb_manager.wurb_logging
+        # Offset for the frame that triggered, related to the first sample
+        # in the last block. Negative if the frame started in an earlier block.
+        self.trigger_sample_offset = None
 
     def config(self, _time_and_data):
         """ Abstract. """
         pass  # Should be overridden.
 
+    def reset(self):
+        """ Called when the stream is not continuous, after gaps and flush.
+        State from earlier blocks is removed. """
+        self.trigger_sample_offset = None
+
+    def get_stats(self):
+        """ Counters for the status API. """
+        return {"detection_algorithm": self.algorithm_name}
+
     def check_for_sound(self, time_and_data):
         """ Abstract. """
         # Returns "is sound", "freq. at peak", "dBFS at peak".
@@ -74,9 +155,13 @@ class SoundDetectionBase:
 class SoundDetectionNone(SoundDetectionBase):
     """ Used for continuous recordings, including silence. """
 
-    def __init__(self, wurb_manager):
+    algorithm_name = "detection-none"
+    description = "None (everything is recorded)"
+    cpu_cost_per_audio_s = 0.0
+
+    def __init__(self, wurb_manager, wurb_recorder=None):
         """ """
-        super(SoundDetectionNone, self).__init__(wurb_manager)
+        super(SoundDetectionNone, self).__init__(wurb_manager, wurb_recorder)
 
     def config(self):
         """ """
@@ -94,11 +179,23 @@ class SoundDetectionNone(SoundDetectionBase):
 class SoundDetectionSimple(SoundDetectionBase):
     """ """
 
-    def __init__(self, wurb_manager):
+    algorithm_name = "detection-simple"
+    description = "Simple (single trigging event)"
+    cpu_cost_per_audio_s = 0.004
+
+    def __init__(self, wurb_manager, wurb_recorder=None):
         """ """
-        super(SoundDetectionSimple, self).__init__(wurb_manager)
+        super(SoundDetectionSimple, self).__init__(wurb_manager, wurb_recorder)
         # Config.
+        self.window_size = 2048
+        self.jump_size = 1000
+        self.use_detection_gate = True
+        self.use_noise_floor = True
         self.sound_detected_counter_min = 3
+        self.screening_margin = 0.01  # Relative, power. About 0.04 dB.
+        # Frames above threshold are counted within this time, also
+        # between blocks. Was the length of a block.
+        self.hit_window_s = 0.5
 
     def config(self):
         """ """
@@ -109,8 +206,6 @@ class SoundDetectionSimple(SoundDetectionBase):
         self.sampling_freq = float(sampling_freq)
         self.filter_min_hz = float(filter_min_khz) * 1000.0
         self.threshold_dbfs = float(threshold_dbfs)
-        self.window_size = 2048
-        self.jump_size = 1000
 
         # self.window_function = scipy.signal.blackmanharris(self.window_size)
         self.window_function = scipy.signal.windows.hann(self.window_size)
@@ -119,6 +214,57 @@ class SoundDetectionSimple(SoundDetectionBase):
         self.freq_bins_hz = np.arange((self.window_size / 2) + 1) / (
             self.window_size / self.sampling_freq
         )
+        # For the batched screening, float32 and linear power.
+        self.window_function_float32 = (self.window_function / 32768.0).astype(
+            np.float32
+        )
+        self.first_filter_bin = int(np.argmax(self.freq_bins_hz >= self.filter_min_hz))
+        if self.freq_bins_hz[-1] < self.filter_min_hz:
+            self.first_filter_bin = len(self.freq_bins_hz)
+        threshold_amplitude = 10.0 ** (self.threshold_dbfs / 20.0)
+        threshold_power = (threshold_amplitude * self.window_function_dbfs_max) ** 2
+        # Frames close to the threshold are checked again with float64.
+        self.screening_power = threshold_power * (1.0 - self.screening_margin)
+        self.filter_floor_power = 0.000000001 ** 2  # Value used in the filter.
+        self.hit_window_frames = int(
+            self.hit_window_s * self.sampling_freq / self.jump_size
+        )
+        # Optional gate, only frames with sound are used in the FFT.
+        gate_mode = "off"
+        if self.use_detection_gate:
+            gate_mode = os.getenv("WURB_REC_DETECTION_GATE", "off")
+        self.detection_gate = wurb_rec.DetectionGate(
+            gate_mode,
+            float(os.getenv("WURB_REC_DETECTION_GATE_MARGIN_DB", "6.0")),
+        )
+        self.detection_gate.config(
+            self.sampling_freq, self.filter_min_hz, self.threshold_dbfs
+        )
+        if self.detection_gate.is_used():
+            # CPU time per frame for the FFT, used for the saved CPU time.
+            test_data = np.random.default_rng(0).integers(
+                -100, 100, 100 * self.jump_size + self.window_size, dtype=np.int16
+            )
+            test_frames = self.get_frames(test_data)
+            self.get_screening_power(test_frames)  # First call is slower.
+            start_cpu_s = time.thread_time()
+            self.get_screening_power(test_frames)
+            cpu_s = time.thread_time() - start_cpu_s
+            self.detection_gate.add_fft_cpu(cpu_s, len(test_frames))
+        # Running floor for each bin, constant noise is not detected.
+        noise_floor_mode = "off"
+        if self.use_noise_floor:
+            noise_floor_mode = os.getenv("WURB_REC_NOISE_FLOOR", "off")
+        self.noise_floor = wurb_rec.NoiseFloor(
+            noise_floor_mode,
+            float(os.getenv("WURB_REC_NOISE_FLOOR_MARGIN_DB", "25.0")),
+        )
+        self.noise_floor.config(
+            self.freq_bins_hz[self.first_filter_bin :],
+            self.window_function_dbfs_max,
+            self.filter_floor_power,
+        )
+        self.reset()
 
         # print(
         #     "DEBUG: Detection: Freq: ",
@@ -129,69 +275,268 @@ class SoundDetectionSimple(SoundDetectionBase):
         #     self.threshold_dbfs,
         # )
 
-    def check_for_sound(self, time_and_data):
+    def reset(self):
         """ """
-        _rec_time, raw_data = time_and_data
-        # data_int16 = np.fromstring(raw_data, dtype=np.int16) # To ndarray.
-        data_int16 = raw_data
-        # self.work_buffer = np.concatenate([self._work_buffer, data_int16])
-        self.work_buffer = data_int16
-        #
+        super().reset()
+        # Samples not used in the last frame, first in the next block.
+        self.overlap_buffer = np.zeros(0, dtype=np.int16)
+        # Frame numbers for hits last in the earlier blocks.
+        self.frame_counter = 0
+        self.last_hit_frames = []
+        # Power for each bin, floor and margin, for the last block.
+        self.floor_limit_power = None
+
+    def get_frames(self, data_int16):
+        """ Overlapping frames as a strided view, without copy. """
+        number_of_frames = 0
+        if len(data_int16) >= self.window_size:
+            number_of_frames = (len(data_int16) - self.window_size) // self.jump_size
+            number_of_frames += 1
+        stride = data_int16.strides[0]
+        return np.lib.stride_tricks.as_strided(
+            data_int16,
+            shape=(number_of_frames, self.window_size),
+            strides=(stride * self.jump_size, stride),
+            writeable=False,
+        )
+
+    def get_continuous_frames(self, block_int16):
+        """Frames for the block, continued from the earlier block. Returns
+        data, frames, overlap length and number for the first frame."""
+        overlap_length = len(self.overlap_buffer)
+        data_int16 = block_int16
+        if overlap_length > 0:
+            data_int16 = np.concatenate([self.overlap_buffer, block_int16])
+        frames = self.get_frames(data_int16)
+        number_of_frames = len(frames)
+        # Copy, the block may be reused by the capture.
+        self.overlap_buffer = data_int16[number_of_frames * self.jump_size :].copy()
+        # Frame numbers are counted from the start of the stream.
+        first_frame = self.frame_counter
+        self.frame_counter += number_of_frames
+        return data_int16, frames, overlap_length, first_frame
+
+    def get_band_power(self, frames):
+        """ Power for bins above the filter limit. All frames in one
+        transform, float32. """
+        signals = frames.astype(np.float32)
+        signals *= self.window_function_float32
+        spectra = fft_module.rfft(signals, axis=1)
+        spectra = spectra[:, self.first_filter_bin :]
+        return spectra.real ** 2 + spectra.imag ** 2
+
+    def get_screening_power(self, frames):
+        """ Max power above the filter limit for each frame. """
+        return self.get_max_power(self.get_band_power(frames))
+
+    def get_max_power(self, band_power):
+        """ Max for each frame, not below the value used in the filter. """
+        if band_power.shape[1] == 0:
+            return np.full(len(band_power), self.filter_floor_power)
+        return np.maximum(band_power.max(axis=1), self.filter_floor_power)
+
+    def get_gated_screening_power(self, data_int16, frames):
+        """ As get_screening_power(), for frames passed by the gate. The
+        other frames are set to the value used in the filter. """
+        number_of_frames = len(frames)
+        gate = self.detection_gate
+        frame_mask = gate.get_frame_mask(
+            data_int16, number_of_frames, self.window_size, self.jump_size
+        )
+        screening_power = np.full(number_of_frames, self.filter_floor_power)
+        start_cpu_s = time.thread_time()
+        if gate.mode == "verify":
+            screening_power = self.get_screening_power(frames)
+            gate.add_fft_cpu(time.thread_time() - start_cpu_s, number_of_frames)
+            # Frames above threshold, missed by the gate.
+            missed_frames = 0
+            candidates = screening_power >= self.screening_power
+            for frame_index in np.flatnonzero(candidates & ~frame_mask):
+                if self.is_frame_hit(frames, screening_power, frame_index):
+                    missed_frames += 1
+            gate.add_missed_frames(missed_frames)
+        else:
+            frame_indexes = np.flatnonzero(frame_mask)
+            if len(frame_indexes) > 0:
+                screening_power[frame_indexes] = self.get_screening_power(
+                    frames[frame_indexes]
+                )
+                cpu_s = time.thread_time() - start_cpu_s
+                gate.add_fft_cpu(cpu_s, len(frame_indexes))
+        return screening_power
+
+    def get_floor_power(self, frames, candidates, screening_power, band_power=None):
+        """Max power for bins above the noise floor by the margin, for each
+        candidate. Other frames get the value used in the filter. The floor
+        is updated from every few frames, also for blocks without candidates
+        if the band power is calculated for all frames. With the gate it is
+        only calculated here, for blocks with candidates. Without floor the
+        screening power is returned."""
+        self.floor_limit_power = None
+        if not self.noise_floor.is_used():
+            return screening_power
+        if (len(candidates) == 0) and (band_power is None):
+            return screening_power
+        noise_floor = self.noise_floor
+        block_s = len(frames) * self.jump_size / self.sampling_freq
+        if band_power is None:
+            sampled_power = self.get_band_power(frames[:: noise_floor.frame_step])
+        else:
+            sampled_power = band_power[:: noise_floor.frame_step]
+        floor = noise_floor.update(sampled_power, block_s)
+        if floor is None:
+            return screening_power
+        self.floor_limit_power = noise_floor.get_limit(floor, self.screening_power)
+        floor_power = np.full(len(frames), self.filter_floor_power)
+        if band_power is None:
+            candidate_power = self.get_band_power(frames[candidates])
+        else:
+            candidate_power = band_power[candidates]
+        candidate_power = np.where(
+            candidate_power >= self.floor_limit_power, candidate_power, 0.0
+        )
+        floor_power[candidates] = self.get_max_power(candidate_power)
+        return floor_power
+
+    def get_stats(self):
+        """ """
+        stats = super().get_stats()
+        if self.detection_gate.is_used():
+            stats.update(self.detection_gate.get_stats())
+        if self.noise_floor.is_used():
+            stats.update(self.noise_floor.get_stats())
+        return stats
+
+    def get_frame_peak(self, data_frame, limit_power=None):
+        """ Peak dBFS and bin for one frame, float64. Used for frames close
+        to or above the threshold, gives the same values as before. Only
+        bins above limit_power are used, if given. """
+        # Transform to intervall -1 to 1 and apply window function.
+        signal = data_frame / 32768.0 * self.window_function
+        # From time domain to frequency domain.
+        spectrum = np.fft.rfft(signal)
+        # High pass filter. Unit Hz. Cut below 15 kHz.
+        # log10 does not like zero.
+        spectrum[self.freq_bins_hz < self.filter_min_hz] = 0.000000001
+        if limit_power is not None:
+            # Bins not above the noise floor.
+            band_spectrum = spectrum[self.first_filter_bin :]
+            band_power = band_spectrum.real ** 2 + band_spectrum.imag ** 2
+            band_spectrum[band_power < limit_power] = 0.000000001
+        # Convert spectrum to dBFS (bin values related to maximal possible value).
+        if self.window_function_dbfs_max > 0.0:
+            dbfs_spectrum = 20 * np.log10(
+                np.abs(spectrum) / self.window_function_dbfs_max
+            )
+            # Find peak and dBFS value for the peak.
+            bin_peak_index = dbfs_spectrum.argmax()
+            return dbfs_spectrum[bin_peak_index], bin_peak_index
+        return -500.0, 0
+
+    def is_frame_hit(self, frames, screening_power, frame_index, limit_power=None):
+        """ """
+        if screening_power[frame_index] < self.screening_power:
+            return False
+        peak_db, _bin = self.get_frame_peak(frames[frame_index], limit_power)
+        return peak_db > self.threshold_dbfs
+
+    def check_for_sound(self, time_and_data):
+        """Frames are screened in one batched transform. Only frames that
+        may pass the threshold, or change the peak, are calculated again
+        with float64, therefore peak frequency and dBFS are unchanged.
+        The stream is continuous between calls. Samples after the last
+        frame are used first in the next block, and frames above threshold
+        are counted within the hit window, also when in earlier blocks.
+        Frames that are not above the noise floor are not used."""
+        _rec_time, block_int16 = time_and_data
         sound_detected = False
-        sound_detected_counter = 0
         peak_frequency_hz = None
         peak_dbfs_at_max = None
+        self.trigger_sample_offset = None
         try:
-            while len(self.work_buffer) >= self.window_size:
-                # Get frame of window size.
-                data_frame = self.work_buffer[: self.window_size]
-                # Cut the first jumped size.
-                self.work_buffer = self.work_buffer[self.jump_size :]
-                # Transform to intervall -1 to 1 and apply window function.
-                signal = data_frame / 32768.0 * self.window_function
-                # From time domain to frequency domain.
-                spectrum = np.fft.rfft(signal)
-                # High pass filter. Unit Hz. Cut below 15 kHz.
-                # log10 does not like zero.
-                spectrum[self.freq_bins_hz < self.filter_min_hz] = 0.000000001
-                # Convert spectrum to dBFS (bin values related to maximal possible value).
-                if self.window_function_dbfs_max > 0.0:
-                    dbfs_spectrum = 20 * np.log10(
-                        np.abs(spectrum) / self.window_function_dbfs_max
-                    )
-                    # Find peak and dBFS value for the peak.
-                    bin_peak_index = dbfs_spectrum.argmax()
-                    peak_db = dbfs_spectrum[bin_peak_index]
-                else:
-                    peak_db = -500.0
-                # Treshold.
+            (
+                data_int16,
+                frames,
+                overlap_length,
+                first_frame,
+            ) = self.get_continuous_frames(block_int16)
+            band_power = None
+            if self.detection_gate.is_used():
+                screening_power = self.get_gated_screening_power(data_int16, frames)
+            else:
+                band_power = self.get_band_power(frames)
+                screening_power = self.get_max_power(band_power)
+            candidates = np.flatnonzero(screening_power >= self.screening_power)
+            floor_power = self.get_floor_power(
+                frames, candidates, screening_power, band_power
+            )
+            floor_passed = floor_power >= self.screening_power
+            suppressed_frames = 0
+            hit_frames = list(self.last_hit_frames)
+            first_peak_index = None
+            for frame_index in candidates:
+                if not floor_passed[frame_index]:
+                    suppressed_frames += 1
+                    continue
+                peak_db, _bin = self.get_frame_peak(
+                    frames[frame_index], self.floor_limit_power
+                )
                 if peak_db > self.threshold_dbfs:
-                    sound_detected_counter += 1
-                    if sound_detected_counter >= self.sound_detected_counter_min:
-                        sound_detected = True
-                        if (peak_dbfs_at_max is None) or (peak_db > peak_dbfs_at_max):
-                            peak_dbfs_at_max = peak_db
-                            peak_frequency_hz = (
-                                bin_peak_index * self.sampling_freq / self.window_size
-                            )
-                            # print(
-                            #     "DEBUG: Peak freq hz: "
-                            #     + str(peak_frequency_hz)
-                            #     + "   dBFS: "
-                            #     + str(peak_db)
-                            # )
-            # # Log if sound was detected.
-            # if sound_detected:
-            #     # Logging.
-            #     message = (
-            #         "Sound peak: "
-            #         + str(round(peak_frequency_hz / 1000.0, 1))
-            #         + " kHz / "
-            #         + str(round(peak_dbfs_at_max, 1))
-            #         + " dBFS."
-            #     )
-            #     self.wurb_logging.info(message, short_message=message)
-            #
+                    hit_frames.append(first_frame + frame_index)
+                    if len(hit_frames) >= self.sound_detected_counter_min:
+                        first_hit_frame = hit_frames[-self.sound_detected_counter_min]
+                        hit_window_start = (
+                            first_frame + frame_index - self.hit_window_frames
+                        )
+                        if first_hit_frame >= hit_window_start:
+                            first_peak_index = frame_index
+                            break
+            if first_peak_index is not None:
+                sound_detected = True
+                # Hits last in the block are also needed for the next block.
+                later_hits = []
+                for frame_index in candidates[::-1]:
+                    if frame_index <= first_peak_index:
+                        break
+                    if len(later_hits) >= self.sound_detected_counter_min - 1:
+                        break
+                    if self.is_frame_hit(
+                        frames, floor_power, frame_index, self.floor_limit_power
+                    ):
+                        later_hits.insert(0, first_frame + frame_index)
+                hit_frames += later_hits
+                # First frame of the hits that triggered.
+                self.trigger_sample_offset = (
+                    first_hit_frame - first_frame
+                ) * self.jump_size - overlap_length
+                # Frames that may be the loudest, in time order. The first
+                # one is kept for equal values.
+                later_power = floor_power[first_peak_index:]
+                limit_power = later_power.max() * (1.0 - self.screening_margin)
+                peak_candidates = np.flatnonzero(later_power >= limit_power)
+                peak_candidates = peak_candidates + first_peak_index
+                if first_peak_index not in peak_candidates:
+                    peak_candidates = np.concatenate(
+                        [[first_peak_index], peak_candidates]
+                    )
+                for frame_index in peak_candidates:
+                    peak_db, bin_peak_index = self.get_frame_peak(
+                        frames[frame_index], self.floor_limit_power
+                    )
+                    if peak_db <= self.threshold_dbfs:
+                        continue
+                    if (peak_dbfs_at_max is None) or (peak_db > peak_dbfs_at_max):
+                        peak_dbfs_at_max = peak_db
+                        peak_frequency_hz = (
+                            bin_peak_index * self.sampling_freq / self.window_size
+                        )
+            elif suppressed_frames > 0:
+                # Would have triggered without the floor.
+                block_hits = len(hit_frames) - len(self.last_hit_frames)
+                if block_hits + suppressed_frames >= self.sound_detected_counter_min:
+                    self.noise_floor.add_suppressed(0, 1)
+            self.noise_floor.add_suppressed(suppressed_frames)
+            self.last_hit_frames = hit_frames[-(self.sound_detected_counter_min - 1) :]
         except Exception as e:
             print("DEBUG: xception in check_for_sound: ", e)
 
@@ -199,3 +544,192 @@ class SoundDetectionSimple(SoundDetectionBase):
         sound_detected = self.manual_triggering_check(sound_detected)
 
         return sound_detected, peak_frequency_hz, peak_dbfs_at_max
+
+
+# Detectors in this module. Other modules are registered when imported.
+detection_algorithms = DetectionAlgorithms()
+detection_algorithms.register(SoundDetectionNone)
+detection_algorithms.register(SoundDetectionSimple)
+
+
+# === MAIN - for test ===
+if __name__ == "__main__":
+    """ Compares the batched detection with the earlier frame by frame
+    loop. Results must be identical. """
+    import time
+
+    class Settings:
+        def get_setting(self, key):
+            return {
+                "detection_limit_khz": "17",
+                "detection_sensitivity_dbfs": "-50",
+                "rec_mode": "mode-auto",
+            }.get(key, "")
+
+    class Recorder:
+        sampling_freq_hz = 384000
+
+    class Manager:
+        wurb_settings = Settings()
+        wurb_logging = None
+        wurb_recorder = Recorder()
+
+    def check_for_sound_loop(detector, data_int16):
+        """ The earlier implementation, one frame at a time. """
+        sound_detected_counter = 0
+        peak_frequency_hz = None
+        peak_dbfs_at_max = None
+        work_buffer = data_int16
+        while len(work_buffer) >= detector.window_size:
+            data_frame = work_buffer[: detector.window_size]
+            work_buffer = work_buffer[detector.jump_size :]
+            signal = data_frame / 32768.0 * detector.window_function
+            spectrum = np.fft.rfft(signal)
+            spectrum[detector.freq_bins_hz < detector.filter_min_hz] = 0.000000001
+            dbfs_spectrum = 20 * np.log10(
+                np.abs(spectrum) / detector.window_function_dbfs_max
+            )
+            bin_peak_index = dbfs_spectrum.argmax()
+            peak_db = dbfs_spectrum[bin_peak_index]
+            if peak_db > detector.threshold_dbfs:
+                sound_detected_counter += 1
+                if sound_detected_counter >= detector.sound_detected_counter_min:
+                    if (peak_dbfs_at_max is None) or (peak_db > peak_dbfs_at_max):
+                        peak_dbfs_at_max = peak_db
+                        peak_frequency_hz = (
+                            bin_peak_index * detector.sampling_freq / detector.window_size
+                        )
+        return peak_dbfs_at_max is not None, peak_frequency_hz, peak_dbfs_at_max
+
+    # The noise floor is tested below.
+    os.environ["WURB_REC_NOISE_FLOOR"] = "off"
+    detector = SoundDetectionSimple(Manager())
+    detector.config()
+    rng = np.random.default_rng(1)
+    block_size = 384000 // 2  # 0.5 sec.
+    times = np.arange(block_size) / 384000.0
+    blocks = {
+        "silent": np.zeros(block_size, dtype=np.int16),
+        "noise": rng.normal(0, 30, block_size).astype(np.int16),
+        "loud": rng.normal(0, 8000, block_size).astype(np.int16),
+    }
+    chirp = np.zeros(block_size)
+    for start_s in [0.05, 0.15, 0.25, 0.35]:
+        inside = (times >= start_s) & (times < start_s + 0.005)
+        pulse_times = times[inside] - start_s
+        amplitude = 2000 * np.sin(np.pi * pulse_times / 0.005)
+        chirp[inside] = amplitude * np.sin(
+            2 * np.pi * (80000 * pulse_times - 4000000 * pulse_times ** 2)
+        )
+    blocks["chirp"] = (chirp + rng.normal(0, 20, block_size)).astype(np.int16)
+    # Close to the threshold.
+    for gain in [0.4, 0.43, 0.45, 0.47, 0.5]:
+        blocks["weak-" + str(gain)] = (chirp * gain).astype(np.int16)
+
+    for name, data_int16 in blocks.items():
+        with np.errstate(divide="ignore"):
+            expected = check_for_sound_loop(detector, data_int16)
+        detector.reset()
+        start_time_s = time.perf_counter()
+        result = detector.check_for_sound((0, data_int16))
+        batched_s = time.perf_counter() - start_time_s
+        start_time_s = time.perf_counter()
+        with np.errstate(divide="ignore"):
+            check_for_sound_loop(detector, data_int16)
+        loop_s = time.perf_counter() - start_time_s
+        print(
+            name.ljust(10),
+            " Identical: ",
+            result == expected,
+            " Result: ",
+            result,
+            " Speedup: ",
+            round(loop_s / batched_s, 1),
+        )
+
+    # One 10 ms call on the border between two blocks, and shorter blocks.
+    stream = np.zeros(2 * block_size, dtype=np.int16)
+    call_times = np.arange(int(0.01 * 384000)) / 384000.0
+    call = np.sin(np.pi * call_times / 0.01) * np.sin(2 * np.pi * 45000 * call_times)
+    call *= 1000
+    call_start = block_size - len(call) // 2
+    stream[call_start : call_start + len(call)] = call
+    for block_s in [0.5, 0.1, 0.02]:
+        length = int(block_s * 384000)
+        detector.reset()
+        with np.errstate(divide="ignore"):
+            separate = [
+                check_for_sound_loop(detector, stream[index : index + length])[0]
+                for index in range(0, len(stream), length)
+            ]
+        streamed = []
+        for index in range(0, len(stream), length):
+            detected, _freq, _dbfs = detector.check_for_sound(
+                (0, stream[index : index + length])
+            )
+            if detected:
+                streamed.append(index + detector.trigger_sample_offset)
+        print(
+            "Border, block ",
+            block_s,
+            " s. Separate blocks: ",
+            sum(separate),
+            " Continuous, trigger samples: ",
+            streamed,
+        )
+
+    # Constant tone from a pinger, and bat calls after 10 s. The tone is
+    # 43 dB above the noise, louder tones are not suppressed.
+    tone = 150 * np.sin(2 * np.pi * 40000 * np.arange(40 * block_size) / 384000.0)
+    for mode in ["off", "on"]:
+        os.environ["WURB_REC_NOISE_FLOOR"] = mode
+        detector = SoundDetectionSimple(Manager())
+        detector.config()
+        detected_blocks = []
+        for block_index in range(40):
+            data = tone[block_index * block_size : (block_index + 1) * block_size]
+            if block_index >= 20:
+                data = data + chirp
+            data_int16 = (data + rng.normal(0, 20, block_size)).astype(np.int16)
+            detected, freq_hz, _dbfs = detector.check_for_sound((0, data_int16))
+            if detected:
+                detected_blocks.append((block_index, round(freq_hz / 1000)))
+        print(
+            "Pinger, noise floor ",
+            mode.ljust(3),
+            " Detected blocks: ",
+            detected_blocks,
+            " Stats: ",
+            detector.get_stats(),
+        )
+
+    # CF bat with 50 ms calls at 83 kHz, 83% duty cycle, after 2 s. All
+    # blocks with calls must be detected, also with the floor.
+    stream_times = np.arange(10 * block_size) / 384000.0
+    cf_calls = np.zeros(len(stream_times))
+    for start_s in np.arange(2.0, 5.0, 0.06):
+        inside = (stream_times >= start_s) & (stream_times < start_s + 0.05)
+        call_times = stream_times[inside] - start_s
+        envelope = np.minimum(1.0, np.minimum(call_times, 0.05 - call_times) / 0.003)
+        cf_calls[inside] = 3000 * envelope * np.sin(2 * np.pi * 83000 * call_times)
+    cf_stream = (cf_calls + rng.normal(0, 20, len(cf_calls))).astype(np.int16)
+    for mode in ["off", "on"]:
+        os.environ["WURB_REC_NOISE_FLOOR"] = mode
+        detector = SoundDetectionSimple(Manager())
+        detector.config()
+        detected_blocks = []
+        for block_index in range(10):
+            data_int16 = cf_stream[
+                block_index * block_size : (block_index + 1) * block_size
+            ]
+            detected, _freq_hz, _dbfs = detector.check_for_sound((0, data_int16))
+            if detected:
+                detected_blocks.append(block_index)
+        print(
+            "CF bat, noise floor ",
+            mode.ljust(3),
+            " Detected blocks: ",
+            detected_blocks,
+            " Expected: ",
+            list(range(4, 10)),
+        )
@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org, https://github.com/cloudedbats
+# Copyright (c) 2020-present Arnold Andreasson
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import asyncio
+import logging
+
+# CloudedBats.
+import wurb_rec
+
+
+class StreamConsumer:
+    """One consumer of a capture stream, with its own queue and policy.
+    If a handler is used the items are read from the queue by a worker
+    and the handler is called for each item, sync or async. The item is
+    only borrowed by the handler, the shared block is released by the
+    worker. Otherwise the queue is read by the owner of the consumer.
+    """
+
+    def __init__(self, name, queue_policy, handler=None):
+        """ """
+        self.name = name
+        self.queue_policy = queue_policy
+        self.queue = queue_policy.queue
+        self.handler = handler
+        self.logger = logging.getLogger("CloudedBats-WURB")
+        self.worker_task = None
+        # Counters.
+        self.handled_items = 0
+        self.handler_errors = 0
+
+    def ensure_started(self):
+        """ The worker is started when the first item is delivered. """
+        if (self.handler is not None) and (self.worker_task is None):
+            self.worker_task = asyncio.create_task(self.worker())
+
+    async def worker(self):
+        """ """
+        while True:
+            item = await self.queue_policy.get()
+            try:
+                if item is wurb_rec.TERMINATE:
+                    break
+                if item is wurb_rec.FLUSH:
+                    continue
+                result = self.handler(item)
+                if asyncio.iscoroutine(result):
+                    await result
+                self.handled_items += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.handler_errors += 1
+                self.logger.debug("Stream consumer " + self.name + ": " + str(e))
+            finally:
+                wurb_rec.release_item(item)
+                self.queue.task_done()
+
+    async def close(self):
+        """ Items left in the queue are released. """
+        if self.worker_task:
+            self.worker_task.cancel()
+            try:
+                await self.worker_task
+            except asyncio.CancelledError:
+                pass
+            self.worker_task = None
+        if self.handler is not None:
+            while not self.queue.empty():
+                wurb_rec.release_item(self.queue.get_nowait())
+                self.queue.task_done()
+        await self.queue_policy.close()
+
+    def get_stats(self):
+        """ """
+        stats = self.queue_policy.get_stats()
+        if self.handler is not None:
+            stats["handled_items"] = self.handled_items
+            stats["handler_errors"] = self.handler_errors
+        return stats
+
+
+class StreamFanOut:
+    """One capture stream delivered to several independent consumers,
+    for example detection and file writing, audio feedback or a live
+    spectrogram. Each consumer gets its own reference to the shared
+    block and has its own queue and overflow policy, so a slow consumer
+    will not stall the others. Consumers can be added and removed while
+    the capture is running.
+    The fan-out is used as queue policy by the capture objects, and it
+    takes over the reference to the shared block for each item.
+    """
+
+    def __init__(self):
+        """ """
+        self.consumers = {}
+        self.sampling_freq_hz = 0
+
+    def add_consumer(
+        self,
+        name,
+        handler=None,
+        queue_policy=None,
+        policy_name="drop-oldest",
+        queue_size=20,
+    ):
+        """ Replaces an earlier consumer with the same name. Returns the
+        consumer, the queue is found in consumer.queue. """
+        if queue_policy is None:
+            queue_policy = wurb_rec.QueuePolicy(
+                asyncio.Queue(maxsize=queue_size), policy_name, self.sampling_freq_hz
+            )
+        consumer = StreamConsumer(name, queue_policy, handler)
+        self.consumers[name] = consumer
+        return consumer
+
+    async def remove_consumer(self, name):
+        """ """
+        consumer = self.consumers.pop(name, None)
+        if consumer is not None:
+            await consumer.close()
+
+    def get_consumer(self, name):
+        """ """
+        return self.consumers.get(name, None)
+
+    def set_sampling_freq_hz(self, sampling_freq_hz):
+        """ Used to count dropped time. """
+        self.sampling_freq_hz = sampling_freq_hz
+        for consumer in self.consumers.values():
+            consumer.queue_policy.sampling_freq_hz = sampling_freq_hz
+
+    def put_nowait(self, item):
+        """ Called in the event loop, never waits. """
+        shared_block = item.shared_block
+        for consumer in list(self.consumers.values()):
+            consumer.ensure_started()
+            consumer_item = item.copy()
+            if shared_block is not None:
+                shared_block.retain()
+            consumer.queue_policy.put_nowait(consumer_item)
+        # The reference from the capture object.
+        item.release()
+        return True
+
+    def get_stats(self):
+        """ """
+        return {name: consumer.get_stats() for name, consumer in self.consumers.items()}
+
+
+# === MAIN - for test ===
+async def main():
+    """ One fast and one stalled consumer. A consumer is added later. """
+    import time
+    import numpy
+
+    block_size = 1000
+    pool = wurb_rec.AudioBufferPool(block_size)
+    fan_out = StreamFanOut()
+    fan_out.set_sampling_freq_hz(block_size * 2)
+    received = {"fast": 0, "slow": 0, "late": 0}
+
+    def fast_handler(item):
+        received["fast"] += 1
+
+    async def slow_handler(item):
+        await asyncio.sleep(1.0)
+        received["slow"] += 1
+
+    fan_out.add_consumer("fast", fast_handler, queue_size=5)
+    fan_out.add_consumer("slow", slow_handler, queue_size=5)
+    data = numpy.zeros(block_size, dtype=numpy.int16)
+    start_time_s = time.monotonic()
+    for index in range(100):
+        if index == 50:
+            fan_out.add_consumer(
+                "late", lambda item: received.update(late=received["late"] + 1)
+            )
+        block = pool.get_block(data)
+        fan_out.put_nowait(wurb_rec.AudioBlock(block.data, block))
+        await asyncio.sleep(0.005)
+    await asyncio.sleep(0.05)
+    print("Elapsed s: ", round(time.monotonic() - start_time_s, 2))
+    print("Received: ", received)
+    for name, stats in fan_out.get_stats().items():
+        print(name, stats)
+    for name in list(fan_out.consumers):
+        await fan_out.remove_consumer(name)
+    print("Pool allocated: ", pool.allocated_counter, "  Free: ", len(pool.free_buffers))
+
+
+if __name__ == "__main__":
+    """ """
+    asyncio.run(main(), debug=False)
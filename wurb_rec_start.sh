@@ -16,6 +16,29 @@ source venv/bin/activate
 # export WURB_REC_LOG_LEVEL=info
 # export WURB_REC_INPUT_DEVICE=hifiberry
 # export WURB_REC_INPUT_DEVICE_FREQ_HZ=192000
+# export WURB_REC_CAPTURE_PROFILE=balanced # Or low-latency, low-cpu.
+# export WURB_REC_CAPTURE_MODE=thread # Or process.
+# export WURB_REC_INPUT_CHANNELS=1
+# export WURB_REC_MULTICHANNEL_FILES=multichannel-wav # Or file-per-channel.
+# export WURB_REC_M500_STREAM_BUFFERS=0 # Reader thread for M500 if > 0, for example 8.
+# export WURB_REC_SOURCE_QUEUE_POLICY=drop-newest # Or block, drop-oldest, spill-to-disk.
+# export WURB_REC_TARGET_QUEUE_POLICY=block # Or drop-newest, drop-oldest, spill-to-disk.
+# export WURB_REC_SPILL_DIR=/tmp/wurb_spill
+# export WURB_REC_SPILL_MAX_MB=512
+# export WURB_REC_DRAIN_TIMEOUT_S=5.0 # Time to finish files when rec. is stopped.
+# export WURB_REC_DETECTION_GATE=off # Or on, verify. Cheap check before the FFT detection.
+# export WURB_REC_DETECTION_GATE_MARGIN_DB=6.0
+# export WURB_REC_NOISE_FLOOR=off # Or on. Sound must be above the running floor, constant noise is not detected.
+# export WURB_REC_NOISE_FLOOR_MARGIN_DB=25.0
+# export WURB_REC_DETECTION_CPU_LIMIT_PERCENT=50.0 # Warning in the web UI for slow algorithms.
+# export WURB_REC_DETECTION_CPU_FACTOR=1.0 # Slower CPU than the declared cost, used until measured.
+# export WURB_REC_DISK_IO_THREADS=2 # Threads for file writing, shared by all microphones.
+# export WURB_REC_REPLAY_PATH=/home/pi/replay # WAV file or directory, used instead of microphones.
+# export WURB_REC_REPLAY_MODE=real-time # Or as-fast-as-possible. Also for synthetic scenes.
+# export WURB_REC_SYNTHETIC_SCENE=mixed # Or fm, cf-fm, insects, noise. Used instead of microphones.
+# export WURB_REC_SYNTHETIC_FREQ_HZ=384000
+# export WURB_REC_SYNTHETIC_SEED=0
+# export WURB_REC_SYNTHETIC_DURATION_S=0 # 0 = until stopped.
 # export WURB_REC_OUTPUT_DEVICE=Headphones
 # export WURB_REC_OUTPUT_DEVICE_FREQ_HZ=48000
 